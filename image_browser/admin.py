@@ -2,7 +2,11 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 
 # Register your models here.
-from image_browser.models import ImageInstance, User, TempUrl, AppUser, PlanTier, ThumbnailSize
+from image_browser.models import ImageInstance, User, TempUrl, AppUser, PlanTier, ThumbnailSize, \
+    ThumbnailJob, UploadSession, ImageBlob
+from image_browser.encodings import get_plan_encodings
+from image_browser.thumbnails import DEFAULT_ENCODINGS, enqueue_missing_thumbnails
+from image_browser.utils import get_plan_images
 
 
 class AppUserInline(admin.StackedInline):
@@ -15,8 +19,34 @@ class UserAdmin(BaseUserAdmin):
     inlines = (AppUserInline,)
 
 
+@admin.action(description='Prerender missing thumbnails of plan images')
+def prerender_thumbnails(modeladmin, request, queryset):
+    queued = sum(enqueue_missing_thumbnails(get_plan_images(plan), plan.thumbnail_sizes.all(),
+                                            get_plan_encodings(plan) or DEFAULT_ENCODINGS)
+                 for plan in queryset)
+    modeladmin.message_user(request, f'{queued} thumbnails queued for rendering')
+
+
+class ImageInstanceAdmin(admin.ModelAdmin):
+    list_display = ('name', 'owner', 'width', 'height', 'format', 'file_size')
+    list_select_related = ('owner',)
+    readonly_fields = ('width', 'height', 'format', 'file_size', 'content_hash', 'blob')
+
+
+class ImageBlobAdmin(admin.ModelAdmin):
+    list_display = ('name', 'size', 'references')
+    readonly_fields = ('content_hash', 'name', 'size', 'references')
+
+
+class PlanTierAdmin(admin.ModelAdmin):
+    actions = [prerender_thumbnails]
+
+
 admin.site.register(User, UserAdmin)
-admin.site.register(ImageInstance)
+admin.site.register(ImageInstance, ImageInstanceAdmin)
 admin.site.register(TempUrl)
-admin.site.register(PlanTier)
+admin.site.register(PlanTier, PlanTierAdmin)
 admin.site.register(ThumbnailSize)
+admin.site.register(ThumbnailJob)
+admin.site.register(UploadSession)
+admin.site.register(ImageBlob, ImageBlobAdmin)
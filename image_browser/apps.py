@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ImageBrowserConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'image_browser'
+
+    def ready(self):
+        # connects receivers of model signals
+        from image_browser import signals  # noqa: F401
+
+        if settings.EXPIRED_LINKS_REAP_INTERVAL:
+            from image_browser.links import start_expired_links_reaper
+            start_expired_links_reaper(settings.EXPIRED_LINKS_REAP_INTERVAL)
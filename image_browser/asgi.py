@@ -0,0 +1,23 @@
+""" ASGI handler sending asynchronous streaming responses.
+    Django ASGI handler iterates streaming content synchronously, in the event loop thread,
+    so responses with async content are sent by this one. """
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler as DjangoASGIHandler
+
+
+class ASGIHandler(DjangoASGIHandler):
+
+    async def send_response(self, response, send):
+        if not getattr(response, 'is_async', False):
+            return await super().send_response(response, send)
+        headers = [(header.encode('ascii'), value.encode('latin1')) for header, value in response.items()]
+        headers += [(b'Set-Cookie', cookie.output(header='').encode('ascii').strip())
+                    for cookie in response.cookies.values()]
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        try:
+            async for chunk in response.streaming_content:
+                # ASGI server applies backpressure - send waits while the client does not read
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body'})
+        finally:
+            await sync_to_async(response.close, thread_sensitive=True)()
@@ -0,0 +1,58 @@
+""" Async versions of image list, image detail and expiring link views, used with ASGI deployment (ASYNC_VIEWS).
+    Event loop only waits for clients - database queries, serialization and thumbnail rendering run in threads
+    and files are sent by async iterator, so a slow client downloading an image does not hold a thread. """
+from typing import Callable
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+from django.http import HttpRequest, HttpResponse
+
+from image_browser.models import ImageInstance
+from image_browser.responses import get_content_etag, stream_file
+from image_browser.views import ImageInstanceDetail, ImageInstanceList, get_temp_link_cache_control, \
+    get_valid_temp_url
+
+
+async def run_in_thread(func: Callable, *args, **kwargs):
+    """ Runs blocking function in a thread of the executor, not in the one thread of sync Django code.
+        Database connections of the thread are checked and closed like at the start and end of a request. """
+    def run():
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return await sync_to_async(run, thread_sensitive=False)()
+
+
+def async_api_view(view_class) -> Callable:
+    """ Returns async view running given API view in a thread, with its response rendered there """
+    view = view_class.as_view()
+
+    def get_response(request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        response = view(request, *args, **kwargs)
+        return response.render() if hasattr(response, 'render') else response
+
+    async def async_view(request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        return await run_in_thread(get_response, request, *args, **kwargs)
+
+    # API views authenticate without CSRF check of session middleware
+    async_view.csrf_exempt = True
+    return async_view
+
+
+image_list = async_api_view(ImageInstanceList)
+image_detail = async_api_view(ImageInstanceDetail)
+
+
+async def temp_link(request: HttpRequest, hash: str) -> HttpResponse:
+    """ Async view of image file behind expiring link """
+    url = await run_in_thread(get_valid_temp_url, hash)
+    image: ImageInstance = url.image
+    # with WSGI server (e.g. development server) content has to be synchronous
+    response = await run_in_thread(stream_file, request, image.image_file, image.file_size,
+                                   get_content_etag(image.content_hash), asynchronous=isinstance(request, ASGIRequest))
+    response['Cache-Control'] = get_temp_link_cache_control(url)
+    return response
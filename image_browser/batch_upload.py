@@ -0,0 +1,206 @@
+""" Upload of many images in one request.
+    Files (sent as multiple parts or in zip/tar archive) are validated one by one, saved to the storage
+    by a bounded pool of threads and inserted into the database at once (one by one on databases which do not
+    return ids of inserted rows).
+    With deduplication every distinct content is stored once, as a blob shared by its images. """
+import os
+import tarfile
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.files import File
+from django.db import connection, transaction
+from rest_framework.exceptions import ValidationError
+
+from image_browser.models import (ImageBlob, ImageInstance, User, get_blob_name, store_blob_file,
+                                  validate_filename_extension, validate_file_signature)
+from image_browser.utils import cut_image_name
+
+# archive members bigger than that are spooled from memory to a temporary file
+SPOOL_MAX_MEMORY = 256 * 1024
+
+
+class BatchItem:
+    """ One file of a batch with its image (if valid) or errors """
+
+    def __init__(self, filename: str, file: File):
+        self.filename = filename
+        self.file = file
+        self.image: Optional[ImageInstance] = None
+        self.errors: List[str] = []
+
+
+def iter_archive(archive: File, max_files: int, max_size: int) -> Iterator[Tuple[str, File]]:
+    """ Yields (file name, file) of regular files in zip or tar archive.
+        Members are copied one by one to spooled temporary files, directories in their names are dropped.
+        Limits are checked while members are extracted, so an archive bomb is refused before it fills the disk:
+        at most `max_files` files, each of them up to UPLOAD_MAX_SIZE bytes (declared in the archive and read)
+        and all of them together up to `max_size` bytes.
+        :raises ValidationError if the archive is not valid or breaks a limit, files yielded before stay open """
+    count = total = 0
+    for name, declared_size, open_member in _iter_members(archive):
+        count += 1
+        if count > max_files:
+            raise ValidationError(f'At most {settings.BATCH_UPLOAD_MAX_FILES} images can be uploaded at once')
+        if declared_size > settings.UPLOAD_MAX_SIZE:
+            raise ValidationError(f'{name} in archive is bigger than {settings.UPLOAD_MAX_SIZE} bytes')
+        with open_member() as member:
+            file = _spool(member, name, min(settings.UPLOAD_MAX_SIZE, max_size - total))
+        if file is None:
+            if max_size - total < settings.UPLOAD_MAX_SIZE:
+                raise ValidationError(f'Files in archive are bigger than {max_size} bytes together')
+            raise ValidationError(f'{name} in archive is bigger than {settings.UPLOAD_MAX_SIZE} bytes')
+        total += file.size
+        yield name, file
+
+
+def _iter_members(archive: File) -> Iterator[Tuple[str, int, Callable]]:
+    """ Yields (file name, declared size, function opening the member) of regular files in zip or tar archive """
+    archive.seek(0)
+    if zipfile.is_zipfile(archive):
+        archive.seek(0)
+        with zipfile.ZipFile(archive) as zip_archive:
+            for info in zip_archive.infolist():
+                if not info.is_dir():
+                    yield os.path.basename(info.filename), info.file_size, partial(zip_archive.open, info)
+        return
+    archive.seek(0)
+    try:
+        tar_archive = tarfile.open(fileobj=archive, mode='r:*')
+    except tarfile.TarError:
+        raise ValidationError('Archive has to be a zip or tar file')
+    with tar_archive:
+        for info in tar_archive:
+            if info.isfile():
+                yield os.path.basename(info.name), info.size, partial(tar_archive.extractfile, info)
+
+
+def _spool(member, name: str, max_size: int) -> Optional[File]:
+    """ Copies member to spooled temporary file, None if it has more than `max_size` bytes """
+    spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    size = 0
+    while True:
+        chunk = member.read(64 * 1024)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_size:
+            # declared size can lie, the content is not read any further
+            spooled.close()
+            return None
+        spooled.write(chunk)
+    spooled.seek(0)
+    return File(spooled, name=name)
+
+
+def prepare_item(owner: User, item: BatchItem) -> None:
+    """ Validates file of the item and reads metadata of its image """
+    try:
+        validate_filename_extension(item.filename)
+        validate_file_signature(item.file)
+        image = ImageInstance(owner=owner, name=cut_image_name(item.filename))
+        image.image_file = item.file
+        image.read_file_metadata()
+    except ValidationError as e:
+        item.errors = [str(detail) for detail in e.detail]
+    except OSError:
+        item.errors = ['file content is not a valid image']
+    else:
+        item.image = image
+
+
+def store_item(item: BatchItem) -> None:
+    """ Saves file of the item to the storage, nothing is written to the database here """
+    image_file = item.image.image_file
+    try:
+        # storage is used directly - saving the field file would also create a thumbnail source row
+        name = image_file.field.generate_filename(item.image, item.filename)
+        image_file.name = image_file.storage.save(name, item.file, max_length=image_file.field.max_length)
+        image_file._committed = True
+        # uploaded file is closed below, stored one is opened when needed
+        image_file.file = None
+    except OSError as e:
+        item.errors = [f'file could not be stored: {e}']
+        item.image = None
+    finally:
+        item.file.close()
+
+
+def store_blob_item(item: BatchItem) -> None:
+    """ Saves file of the item as a blob (if it is not stored yet), the blob row is created later """
+    image = item.image
+    try:
+        store_blob_file(image.image_file.storage, get_blob_name(image.content_hash, image.format), item.file)
+    except OSError as e:
+        item.errors = [f'file could not be stored: {e}']
+        item.image = None
+
+
+def upload_batch(owner: User, files: List[Tuple[str, File]]) -> List[BatchItem]:
+    """ Creates images of all valid files.
+        Files are saved by `BATCH_UPLOAD_WORKERS` threads, rows are inserted with one bulk insert
+        (where the database returns their ids).
+        :return items in order of given files """
+    items = [BatchItem(os.path.basename(filename), file) for filename, file in files]
+    for item in items:
+        prepare_item(owner, item)
+        if not item.image:
+            # files of valid items are closed when they are stored
+            item.file.close()
+
+    if settings.IMAGE_DEDUPLICATION:
+        return _upload_deduplicated(owner, items)
+
+    with ThreadPoolExecutor(max_workers=settings.BATCH_UPLOAD_WORKERS, thread_name_prefix='batch-upload') as pool:
+        list(pool.map(store_item, [item for item in items if item.image]))
+
+    images = [item.image for item in items if item.image]
+    _insert_images(owner, images)
+    return items
+
+
+def _upload_deduplicated(owner: User, items: List[BatchItem]) -> List[BatchItem]:
+    try:
+        # every distinct content is written once, even if the batch contains it many times
+        first_items = {}
+        for item in items:
+            if item.image:
+                first_items.setdefault(item.image.content_hash, item)
+        with ThreadPoolExecutor(max_workers=settings.BATCH_UPLOAD_WORKERS, thread_name_prefix='batch-upload') as pool:
+            list(pool.map(store_blob_item, first_items.values()))
+        for item in items:
+            first = first_items.get(item.image.content_hash) if item.image else None
+            if first is not None and first.errors:
+                item.errors, item.image = first.errors, None
+
+        images = [item.image for item in items if item.image]
+        with transaction.atomic():
+            for item in items:
+                if item.image:
+                    storage = item.image.image_file.storage
+                    # file is already stored, unless its blob was deleted in the meantime
+                    ImageBlob.acquire(item.image, lambda name: store_blob_file(storage, name, item.file))
+            _insert_images(owner, images)
+    finally:
+        for item in items:
+            item.file.close()
+    return items
+
+
+def _insert_images(owner: User, images: List[ImageInstance]) -> None:
+    if not images:
+        return
+    if not connection.features.can_return_rows_from_bulk_insert:
+        # databases which do not return ids of inserted rows (like SQLite) - rows are inserted one by one,
+        # as ids of rows inserted at once could not be told from rows of concurrent batches
+        with transaction.atomic():
+            for image in images:
+                image.save()
+        return
+    ImageInstance.objects.bulk_create(images)
+    # bulk insert does not send post_save signals
+    User.bump_library_version(owner.pk)
@@ -0,0 +1,254 @@
+""" Benchmark of API endpoints.
+    Users of builtin plans are seeded with synthetic images and every endpoint is requested in process
+    (through the whole middleware and view stack) at growing library sizes. Latency, throughput, SQL queries
+    and peak memory of every endpoint are returned as a JSON-serializable report, so runs on different commits
+    can be compared. """
+import platform
+import resource
+import statistics
+import subprocess
+import time
+from io import BytesIO
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import django
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from PIL import Image, ImageDraw
+from rest_framework.test import APIClient
+
+from image_browser.batch_upload import upload_batch
+from image_browser.builtin_plans import basic_plan, enterprise_plan, premium_plan
+from image_browser.models import AppUser, ImageInstance, PlanTier, User
+
+BUILTIN_PLANS = [basic_plan.name, premium_plan.name, enterprise_plan.name]
+ENDPOINTS = ['upload', 'list', 'detail', 'make_temp', 'temp']
+
+# images are inserted in batches, like by the batch upload endpoint
+SEED_BATCH_SIZE = 200
+
+
+def create_synthetic_jpeg(base: Image.Image, number: int) -> bytes:
+    """ Returns JPEG of base image with a mark making its content unique """
+    image = base.copy()
+    draw = ImageDraw.Draw(image)
+    # every number has its own pattern of squares, so hashes of all images differ
+    for bit in range(36):
+        if number >> bit & 1:
+            x, y = bit % 6 * 16, bit // 6 * 16
+            draw.rectangle((x, y, x + 15, y + 15), fill=(255, 255, 255))
+    output = BytesIO()
+    image.save(output, 'JPEG', quality=85)
+    return output.getvalue()
+
+
+def create_base_image(width: int, height: int) -> Image.Image:
+    """ Returns photo-like (not flat colored) image, the same in every run """
+    gradient = Image.radial_gradient('L').resize((width, height)).convert('RGB')
+    pattern = Image.linear_gradient('L').rotate(30).resize((width, height)).convert('RGB')
+    return Image.blend(gradient, pattern, 0.5)
+
+
+class BenchmarkUser:
+    """ Seeded user of one plan with authenticated client """
+
+    def __init__(self, user: User, plan: str):
+        self.user = user
+        self.plan = plan
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+        self.images = 0
+
+
+def create_users(count: int) -> List[BenchmarkUser]:
+    """ Creates `count` users spread evenly over builtin plans """
+    users = []
+    for number in range(count):
+        plan = PlanTier.objects.get(name=BUILTIN_PLANS[number % len(BUILTIN_PLANS)])
+        user = User.objects.create_user(username=f'benchmark_{number}', password='benchmark')
+        AppUser.objects.create(user=user, plan=plan)
+        users.append(BenchmarkUser(user, plan.name))
+    return users
+
+
+def seed_images(user: BenchmarkUser, count: int, base: Image.Image) -> None:
+    """ Adds images to the library of the user until it has `count` images """
+    while user.images < count:
+        batch = range(user.images, min(count, user.images + SEED_BATCH_SIZE))
+        files = [(f'seed_{number}.jpg', ContentFile(create_synthetic_jpeg(base, user.user.id << 20 | number),
+                                                   name=f'seed_{number}.jpg'))
+                 for number in batch]
+        upload_batch(user.user, files)
+        user.images += len(batch)
+
+
+def get_peak_rss() -> float:
+    """ Returns peak resident memory of this process in MB """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 / 1024 if platform.system() == 'Darwin' else peak / 1024
+
+
+def measure(request: Callable[[int], int], requests: int, warmup: int) -> dict:
+    """ Sends requests one by one and returns statistics of their latencies and queries.
+        :param request: sends request number n and returns its status code """
+    for number in range(warmup):
+        request(-number - 1)
+
+    latencies, queries, query_times, statuses = [], [], [], {}
+    started = time.perf_counter()
+    for number in range(requests):
+        with CaptureQueriesContext(connection) as captured:
+            request_started = time.perf_counter()
+            status = request(number)
+            latencies.append(time.perf_counter() - request_started)
+        queries.append(len(captured.captured_queries))
+        query_times.append(sum(float(query['time']) for query in captured.captured_queries))
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'statuses': statuses,
+        'throughput_rps': round(requests / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'mean': round(statistics.mean(latencies) * 1000, 3),
+            'p50': round(statistics.median(latencies) * 1000, 3),
+            'p95': round(latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)] * 1000, 3),
+            'max': round(latencies[-1] * 1000, 3),
+        },
+        'queries': {
+            'mean': round(statistics.mean(queries), 2),
+            'max': max(queries),
+            'time_ms': round(statistics.mean(query_times) * 1000, 3),
+        },
+        'peak_rss_mb': round(get_peak_rss(), 1),
+    }
+
+
+def read_response(response) -> int:
+    """ Reads whole (possibly streamed) response, like a client would """
+    if response.streaming:
+        for _ in response.streaming_content:
+            pass
+    response.close()
+    return response.status_code
+
+
+def get_endpoint_requests(user: BenchmarkUser, upload: bytes) -> Dict[str, Callable[[int], int]]:
+    """ Returns request functions of every endpoint, sent by given user """
+    client = user.client
+    image_id = ImageInstance.objects.filter(owner=user.user).order_by('id').values_list('id', flat=True).first()
+
+    def upload_image(number: int) -> int:
+        return read_response(client.post('/images/upload', {
+            'name': f'upload_{number}', 'image_file': ContentFile(upload, name=f'upload_{number}.jpg')
+        }, format='multipart'))
+
+    def make_temp(number: int) -> int:
+        return read_response(client.post(f'/make_temp/{image_id}/', {'expires_seconds': 3000}, format='json'))
+
+    temp_path = None
+    response = client.post(f'/make_temp/{image_id}/', {'expires_seconds': 30000}, format='json')
+    if response.status_code == 201:
+        temp_path = urlsplit(response.data['expiring_link_url']).path
+
+    requests = {
+        'upload': upload_image,
+        'list': lambda number: read_response(client.get('/images/')),
+        'detail': lambda number: read_response(client.get(f'/{image_id}/')),
+    }
+    if temp_path:
+        requests['make_temp'] = make_temp
+        # anonymous client, like receivers of the link
+        requests['temp'] = lambda number: read_response(APIClient().get(temp_path))
+    return requests
+
+
+def delete_uploads(user: BenchmarkUser) -> None:
+    """ Deletes images uploaded by the benchmark, so the library keeps its seeded size """
+    seeded = set(ImageInstance.objects.filter(owner=user.user).order_by('id')
+                 .values_list('id', flat=True)[:user.images])
+    for image in ImageInstance.objects.filter(owner=user.user).exclude(id__in=seeded):
+        image.delete()
+
+
+def get_environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=settings.BASE_DIR, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'settings': {name: getattr(settings, name) for name in (
+            'THUMBNAIL_BACKGROUND_RENDERING', 'IMAGE_DEDUPLICATION', 'EXPIRING_LINK_MODE', 'IMAGE_STORAGE',
+            'IMAGE_PATH_LAYOUT', 'MEDIA_SENDFILE_BACKEND', 'PLAN_CACHE_ALIAS')},
+    }
+
+
+def run_benchmark(library_sizes: List[int], users: int, requests: int, warmup: int = 1,
+                  image_size: Tuple[int, int] = (800, 600), endpoints: Optional[List[str]] = None,
+                  log: Callable[[str], None] = lambda message: None) -> dict:
+    """ Seeds users and measures endpoints at every library size (number of images of every user).
+        Endpoints are measured for every plan separately - expiring links only for plans which can create them. """
+    base = create_base_image(*image_size)
+    upload = create_synthetic_jpeg(base, (1 << 36) - 1)
+    seeded = create_users(users)
+    results = []
+    for library_size in sorted(library_sizes):
+        started = time.perf_counter()
+        for user in seeded:
+            seed_images(user, library_size, base)
+        log('%d images per user seeded in %.1f s' % (library_size, time.perf_counter() - started))
+
+        measured = {}
+        for user in seeded:
+            if user.plan in measured:
+                continue
+            plan_results = measured[user.plan] = {}
+            endpoint_requests = get_endpoint_requests(user, upload)
+            for endpoint in endpoints or ENDPOINTS:
+                if endpoint in endpoint_requests:
+                    plan_results[endpoint] = measure(endpoint_requests[endpoint], requests, warmup)
+                    log('%6d images  %-10s  %-10s  p50 %8.2f ms  %6.1f queries'
+                        % (library_size, user.plan, endpoint, plan_results[endpoint]['latency_ms']['p50'],
+                           plan_results[endpoint]['queries']['mean']))
+            delete_uploads(user)
+        results.append({'library_size': library_size, 'users': users, 'plans': measured})
+
+    return {
+        'environment': get_environment(),
+        'parameters': {'library_sizes': sorted(library_sizes), 'users': users, 'requests': requests,
+                       'warmup': warmup, 'image_size': list(image_size)},
+        'results': results,
+    }
+
+
+def compare_reports(baseline: dict, current: dict) -> List[Tuple[int, str, str, str, float, float]]:
+    """ Returns (library size, plan, endpoint, metric, baseline value, current value) of metrics of both reports """
+    metrics = [('p50 ms', lambda result: result['latency_ms']['p50']),
+               ('p95 ms', lambda result: result['latency_ms']['p95']),
+               ('queries', lambda result: result['queries']['mean'])]
+    baseline_results = {(result['library_size'], plan, endpoint): endpoint_result
+                        for result in baseline['results']
+                        for plan, plan_results in result['plans'].items()
+                        for endpoint, endpoint_result in plan_results.items()}
+    rows = []
+    for result in current['results']:
+        for plan, plan_results in result['plans'].items():
+            for endpoint, endpoint_result in plan_results.items():
+                before = baseline_results.get((result['library_size'], plan, endpoint))
+                if before is None:
+                    continue
+                for metric, get_value in metrics:
+                    rows.append((result['library_size'], plan, endpoint, metric,
+                                 get_value(before), get_value(endpoint_result)))
+    return rows
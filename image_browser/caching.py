@@ -0,0 +1,57 @@
+""" Validators (ETags) of API responses and cache lifetimes of served files """
+import hashlib
+import re
+
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from rest_framework.request import Request
+
+from image_browser.models import PlanTier
+from image_browser.utils import get_plan_by_user
+
+# thumbnail names of hashed namer are derived from source name and options, and sources are never overwritten
+THUMBNAIL_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+MEDIA_CACHE_CONTROL = 'public, max-age=86400'
+HASHED_THUMBNAIL_RE = re.compile(r'^[\w-]{12}\.\w+$')
+
+
+def get_media_cache_control(name: str) -> str:
+    """ Returns Cache-Control header of media file with given name """
+    if HASHED_THUMBNAIL_RE.match(name.rsplit('/', 1)[-1]):
+        return THUMBNAIL_CACHE_CONTROL
+    return MEDIA_CACHE_CONTROL
+
+
+def get_plan_fingerprint(plan: PlanTier) -> str:
+    """ Returns value identifying everything of a plan which changes representations - its fields and thumbnail sizes.
+        It depends only on the plan, so it is the same in every process. """
+    fields = [getattr(plan, field.attname) for field in plan._meta.concrete_fields]
+    sizes = sorted((size.width, size.height) for size in plan.thumbnail_sizes.all())
+    return repr((fields, sizes))
+
+
+def get_library_etag(request: Request, library_version: int) -> str:
+    """ Returns ETag of image list or detail response.
+        Representation depends on images of a user (library version), plan of the user (its fields and sizes),
+        requested URL with its query, response format and accepted types (thumbnail formats). """
+    parts = (request.user.pk, library_version, get_plan_fingerprint(get_plan_by_user(request.user)),
+             request.get_host(), request.get_full_path(), request.accepted_renderer.format,
+             request.META.get('HTTP_ACCEPT', ''))
+    return '"%s"' % hashlib.md5(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+class ConditionalGetMixin:
+    """ Mixin of API views answering 304 Not Modified if user library did not change """
+
+    def get_library_version(self) -> int:
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        etag = get_library_etag(request, self.get_library_version())
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        response['ETag'] = etag
+        patch_vary_headers(response, ['Accept'])
+        # clients may keep the response, but have to revalidate it
+        response['Cache-Control'] = 'private, no-cache'
+        return response
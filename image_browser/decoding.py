@@ -0,0 +1,107 @@
+""" Decoding policy of images - limits protecting server processes from decompression bombs.
+    Dimensions are read from the image header before anything is decoded. Uploads with more pixels than the plan
+    allows (PlanTier.max_image_pixels, never more than IMAGE_MAX_PIXELS) are refused, and originals are decoded only
+    if their decoded size (after reduced resolution decoding of JPEG) fits in IMAGE_MAX_PIXELS.
+    Decoded pixels of concurrent decodings in one process are bounded by DECODE_MEMORY_BUDGET - decoding waits
+    until enough memory is released. Worker processes can also be capped by WORKER_MEMORY_LIMIT (address space),
+    so a decoding over it fails with MemoryError instead of the whole host running out of memory. """
+import resource
+import threading
+from contextlib import contextmanager
+from typing import Optional, Tuple
+
+from django.conf import settings
+from PIL import Image
+
+# decoded images are converted to RGB(A) before scaling
+BYTES_PER_PIXEL = 4
+
+
+class ImageTooLarge(ValueError):
+    """ Raised when image has more pixels than decoding policy allows """
+
+
+def get_max_pixels(plan=None) -> int:
+    """ Returns maximal number of pixels of uploaded images - limit of the plan, never above IMAGE_MAX_PIXELS """
+    if plan is not None and plan.max_image_pixels:
+        return min(plan.max_image_pixels, settings.IMAGE_MAX_PIXELS)
+    return settings.IMAGE_MAX_PIXELS
+
+
+def check_pixels(size: Tuple[int, int], max_pixels: int) -> None:
+    """ :raises ImageTooLarge if image of given size has more than `max_pixels` pixels """
+    width, height = size
+    if width * height > max_pixels:
+        raise ImageTooLarge(f'Image has {width}x{height} pixels, at most {max_pixels} pixels are allowed')
+
+
+def open_image(file) -> Image.Image:
+    """ Opens image reading only its header, pixels are decoded later by `load`.
+        Images refused already by Pillow's own decompression bomb check raise ImageTooLarge too. """
+    try:
+        return Image.open(file)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e))
+
+
+class MemoryBudget:
+    """ Bytes of decoded images which can be held at once by threads of a process.
+        Image bigger than the whole budget is decoded alone. """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.available = size
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, amount: int):
+        """ Waits until `amount` bytes are available and holds them while the block runs """
+        amount = min(amount, self.size)
+        with self._condition:
+            self._condition.wait_for(lambda: self.available >= amount)
+            self.available -= amount
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.available += amount
+                self._condition.notify_all()
+
+
+_budgets = {}
+_budgets_lock = threading.Lock()
+
+
+def get_memory_budget() -> Optional[MemoryBudget]:
+    """ Returns memory budget of decoding configured by settings, shared by threads of the process """
+    size = settings.DECODE_MEMORY_BUDGET
+    if not size:
+        return None
+    with _budgets_lock:
+        if size not in _budgets:
+            _budgets[size] = MemoryBudget(size)
+        return _budgets[size]
+
+
+@contextmanager
+def decoding_memory(image: Image.Image):
+    """ Checks size of opened image which is going to be decoded (after `draft`, if it was reduced)
+        and holds memory budget of its pixels while the block runs.
+        :raises ImageTooLarge if the image has more pixels than IMAGE_MAX_PIXELS """
+    check_pixels(image.size, settings.IMAGE_MAX_PIXELS)
+    budget = get_memory_budget()
+    if budget is None:
+        yield
+        return
+    with budget.reserve(image.size[0] * image.size[1] * BYTES_PER_PIXEL):
+        yield
+
+
+def limit_process_memory(limit: int) -> None:
+    """ Limits address space of current process to `limit` bytes (0 keeps it unlimited) """
+    if not limit:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
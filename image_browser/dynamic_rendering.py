@@ -0,0 +1,227 @@
+""" On-demand rendering of images in sizes requested by clients.
+    Requested sizes are snapped up to size buckets (RENDER_SIZE_BUCKETS, capped by plan maximum) - the larger
+    dimension is snapped and the other one keeps requested aspect ratio - so clients asking for slightly different
+    sizes share rendered files. Rendered files are kept in local disk cache (RENDER_CACHE_DIR)
+    bounded by RENDER_CACHE_MAX_SIZE - least recently used files are evicted. Concurrent misses of the same file
+    render it once, other requests wait for the lock and read the rendered file. """
+import hashlib
+import os
+import tempfile
+import threading
+from typing import List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from easy_thumbnails import engine
+from easy_thumbnails.files import get_thumbnailer
+from rest_framework.exceptions import ValidationError
+
+from image_browser.encodings import OUTPUT_FORMATS, ThumbnailEncoding
+from image_browser.locks import key_lock
+from image_browser.models import ImageInstance
+from image_browser.rendering import open_source_image
+
+# image is scaled to fit in requested box / scaled and cropped to fill it
+FIT_CONTAIN = 'contain'
+FIT_COVER = 'cover'
+FITS = (FIT_CONTAIN, FIT_COVER)
+
+# evicting cache makes it this much smaller than its limit, so it is not scanned on every following write
+EVICTION_RATIO = 0.9
+
+# output of images without plan formats - like easy_thumbnails, JPEG unless the image has transparency
+DEFAULT_OUTPUT = {'PNG': ('png', 'image/png')}
+JPEG_OUTPUT = ('jpg', 'image/jpeg')
+
+
+class RenderedFile(NamedTuple):
+    path: str
+    content_type: str
+    key: str
+    cached: bool
+
+
+def get_size_buckets(max_dimension: int) -> List[int]:
+    """ Returns dimensions requests are snapped to - buckets below plan maximum and the maximum itself """
+    return sorted({bucket for bucket in settings.RENDER_SIZE_BUCKETS if bucket < max_dimension} | {max_dimension})
+
+
+def snap_dimension(value: int, buckets: List[int]) -> int:
+    """ Returns the smallest bucket not smaller than the dimension, 0 (computed from the other one) stays 0 """
+    if value == 0:
+        return 0
+    for bucket in buckets:
+        if bucket >= value:
+            return bucket
+    raise ValidationError(f'Dimensions can be at most {buckets[-1]} in user plan')
+
+
+def snap_size(width: int, height: int, buckets: List[int]) -> Tuple[int, int]:
+    """ Snaps the larger dimension to buckets and scales the other one by the same ratio,
+        so the box (and the crop of cover) keeps requested aspect ratio """
+    if not (width and height):
+        return snap_dimension(width, buckets), snap_dimension(height, buckets)
+    larger = max(width, height)
+    scale = snap_dimension(larger, buckets) / larger
+    return max(round(width * scale), 1), max(round(height * scale), 1)
+
+
+def parse_render_request(query_params, max_dimension: int) -> Tuple[int, int, str]:
+    """ Validates requested size and fit, snaps the size to buckets.
+        :return width, height and fit to render """
+    try:
+        width, height = (int(query_params.get(name) or 0) for name in ('w', 'h'))
+    except ValueError:
+        raise ValidationError('w and h have to be whole numbers')
+    if width < 0 or height < 0 or not (width or height):
+        raise ValidationError('w or h has to be given as a positive number')
+    fit = query_params.get('fit') or FIT_CONTAIN
+    if fit not in FITS:
+        raise ValidationError(f'fit has to be one of {", ".join(FITS)}')
+    if fit == FIT_COVER and not (width and height):
+        raise ValidationError(f'fit={FIT_COVER} needs both w and h')
+    return (*snap_size(width, height, get_size_buckets(max_dimension)), fit)
+
+
+def get_output(image: ImageInstance, encoding: Optional[ThumbnailEncoding]) -> Tuple[str, str]:
+    """ Returns extension and content type of rendered image """
+    if encoding is not None:
+        return encoding.output_format.extension, encoding.output_format.content_type
+    return DEFAULT_OUTPUT.get(image.format, JPEG_OUTPUT)
+
+
+def get_render_key(image: ImageInstance, width: int, height: int, fit: str,
+                   encoding: Optional[ThumbnailEncoding]) -> str:
+    """ Returns cache key of rendered image - content of the original and all rendering parameters """
+    source = image.content_hash or f'{image.id}:{image.image_file.name}'
+    parts = (source, width, height, fit, encoding.format if encoding else '', encoding.quality if encoding else '')
+    return hashlib.sha256(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def render_image(image: ImageInstance, width: int, height: int, fit: str,
+                 encoding: Optional[ThumbnailEncoding]) -> bytes:
+    """ Renders the original in given size, JPEG decoded in the smallest resolution which is enough """
+    thumbnailer = get_thumbnailer(image.image_file)
+    if fit == FIT_COVER and image.width and image.height:
+        # covering scales by the bigger ratio - reduced decoding is limited by the dimension which needs it
+        draft_size = (width, 0) if width / image.width > height / image.height else (0, height)
+    else:
+        draft_size = (width, height)
+    options = thumbnailer.get_options({'size': (width, height), 'crop': fit == FIT_COVER})
+    with open_source_image(thumbnailer, [draft_size]) as (source, _):
+        rendered = engine.process_image(source, options, thumbnailer.thumbnail_processors)
+    extension, _ = get_output(image, encoding)
+    save_options = {'quality': encoding.quality if encoding else options['quality']}
+    if extension == OUTPUT_FORMATS['jpeg'].extension:
+        save_options['progressive'] = True
+    return engine.save_image(rendered, filename=f'rendered.{extension}', **save_options).read()
+
+
+class RenderCache:
+    """ Directory of rendered files bounded by total size, evicting least recently used files.
+        Every read touches modification time of the file, so it orders files by their last use.
+        Size is tracked per process and checked by scanning the directory when it reaches the limit. """
+
+    def __init__(self, location: str, max_size: int):
+        self.location = location
+        self.max_size = max_size
+        self._size: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def get_path(self, key: str, extension: str) -> str:
+        return os.path.join(self.location, key[:2], f'{key}.{extension}')
+
+    def get(self, key: str, extension: str) -> Optional[str]:
+        """ Returns path of cached file (marking it as used), None if it is not cached """
+        path = self.get_path(key, extension)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key: str, extension: str, data: bytes) -> str:
+        """ Stores file atomically (readers never see it partially written) and evicts old files if needed """
+        path = self.get_path(key, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.render-')
+        try:
+            with os.fdopen(descriptor, 'wb') as temporary:
+                temporary.write(data)
+            os.replace(temporary_path, path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        with self._lock:
+            if self._size is None:
+                self._size = self.get_size()
+            else:
+                self._size += len(data)
+            if self._size > self.max_size:
+                self._size = self.evict(int(self.max_size * EVICTION_RATIO))
+        return path
+
+    def _list_files(self) -> List[Tuple[float, int, str]]:
+        files = []
+        for directory, _, names in os.walk(self.location):
+            for name in names:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def get_size(self) -> int:
+        return sum(size for _, size, _ in self._list_files())
+
+    def evict(self, target_size: int) -> int:
+        """ Deletes least recently used files until cache is not bigger than target size.
+            Files being sent stay readable until they are closed.
+            :return size of cache after eviction """
+        files = sorted(self._list_files())
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= target_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # evicted by another process
+                pass
+            total -= size
+        return total
+
+
+_caches = {}
+
+
+def get_render_cache() -> RenderCache:
+    """ Returns cache of rendered files configured by settings, shared by threads of the process """
+    location = settings.RENDER_CACHE_DIR or os.path.join(settings.MEDIA_ROOT, '.render-cache')
+    key = (location, settings.RENDER_CACHE_MAX_SIZE)
+    if key not in _caches:
+        _caches[key] = RenderCache(location, settings.RENDER_CACHE_MAX_SIZE)
+    return _caches[key]
+
+
+def get_rendered_file(image: ImageInstance, width: int, height: int, fit: str,
+                      encoding: Optional[ThumbnailEncoding]) -> RenderedFile:
+    """ Returns cached rendered image, rendering it on cache miss.
+        Concurrent misses of the same image wait for the one which renders it. """
+    cache = get_render_cache()
+    key = get_render_key(image, width, height, fit, encoding)
+    extension, content_type = get_output(image, encoding)
+    path = cache.get(key, extension)
+    if path is not None:
+        return RenderedFile(path, content_type, key, True)
+    with key_lock(f'render:{key}'):
+        # rendered while this request waited for the lock
+        path = cache.get(key, extension)
+        if path is not None:
+            return RenderedFile(path, content_type, key, True)
+        path = cache.put(key, extension, render_image(image, width, height, fit, encoding))
+    return RenderedFile(path, content_type, key, False)
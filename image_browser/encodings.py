@@ -0,0 +1,94 @@
+""" Output formats of thumbnails.
+    Plan lists formats (PlanTier.thumbnail_formats) in which its thumbnails are rendered, with plan quality.
+    Every format is a separate thumbnail - with its own name and cache row. Client gets the first plan format
+    listed in its Accept header, or JPEG (which every client decodes) if it does not list any of them.
+    Plans without formats keep easy_thumbnails defaults (JPEG, or PNG for transparent images). """
+from typing import List, NamedTuple, Optional, Set
+
+from django.core.exceptions import ValidationError
+from PIL import Image
+
+
+class OutputFormat(NamedTuple):
+    image_format: str
+    extension: str
+    content_type: str
+
+
+OUTPUT_FORMATS = {
+    # optimized progressive JPEG
+    'jpeg': OutputFormat('JPEG', 'jpg', 'image/jpeg'),
+    'webp': OutputFormat('WEBP', 'webp', 'image/webp'),
+    # needs Pillow built with AVIF encoder (or pillow-avif-plugin)
+    'avif': OutputFormat('AVIF', 'avif', 'image/avif'),
+}
+FALLBACK_FORMAT = 'jpeg'
+
+
+class ThumbnailEncoding(NamedTuple):
+    """ Format and quality in which a thumbnail is rendered """
+    format: str
+    quality: int
+
+    @property
+    def output_format(self) -> OutputFormat:
+        return OUTPUT_FORMATS[self.format]
+
+    def get_options(self) -> dict:
+        """ Returns easy_thumbnails options of the encoding, they make thumbnail names of formats differ """
+        return {'format': self.format, 'quality': self.quality}
+
+
+def is_format_available(code: str) -> bool:
+    """ Tells if installed Pillow can write images in given format """
+    Image.init()
+    return code in OUTPUT_FORMATS and OUTPUT_FORMATS[code].image_format in Image.SAVE
+
+
+def parse_formats(value: str) -> List[str]:
+    return [code.strip().lower() for code in value.split(',') if code.strip()]
+
+
+def validate_thumbnail_formats(value: str) -> None:
+    """ Validates comma separated list of thumbnail formats """
+    for code in parse_formats(value):
+        if code not in OUTPUT_FORMATS:
+            raise ValidationError(f'Unknown thumbnail format "{code}", use some of {", ".join(OUTPUT_FORMATS)}')
+        if not is_format_available(code):
+            raise ValidationError(f'Thumbnail format "{code}" is not supported by installed Pillow')
+
+
+def get_plan_encodings(plan) -> List[ThumbnailEncoding]:
+    """ Returns encodings of plan thumbnails in order of preference, empty if plan keeps default formats """
+    if plan is None:
+        return []
+    return [ThumbnailEncoding(code, plan.thumbnail_quality) for code in parse_formats(plan.thumbnail_formats)
+            if is_format_available(code)]
+
+
+def get_accepted_types(accept: Optional[str]) -> Set[str]:
+    """ Returns media types listed in Accept header (without wildcards and types with q=0) """
+    accepted = set()
+    for item in (accept or '').split(','):
+        media_type, *parameters = [part.strip() for part in item.split(';')]
+        quality = next((parameter[2:] for parameter in parameters if parameter.startswith('q=')), '1')
+        try:
+            if float(quality) <= 0:
+                continue
+        except ValueError:
+            continue
+        if media_type and '*' not in media_type:
+            accepted.add(media_type.lower())
+    return accepted
+
+
+def choose_encoding(encodings: List[ThumbnailEncoding], accept: Optional[str]) -> Optional[ThumbnailEncoding]:
+    """ Returns the first encoding which content type client accepts.
+        Wildcards do not count - browsers send */* without decoding every format. """
+    if not encodings:
+        return None
+    accepted = get_accepted_types(accept)
+    for encoding in encodings:
+        if encoding.output_format.content_type in accepted:
+            return encoding
+    return next((encoding for encoding in encodings if encoding.format == FALLBACK_FORMAT), encodings[-1])
@@ -0,0 +1,93 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import List, Tuple
+
+from django.conf import settings
+from django.core import signing
+from django.db import connection
+from django.utils import timezone
+
+from image_browser.models import ImageInstance, TempUrl
+
+logger = logging.getLogger(__name__)
+
+SIGNED_LINK_SALT = 'image_browser.signed_link'
+
+# bytes of fixed size columns of TempUrl row (id, expiration date and image id)
+TEMP_URL_FIXED_BYTES = 3 * 8
+
+
+def get_signing_keys() -> List[str]:
+    """ Returns keys of signed links. First key signs new links, all of them are accepted,
+        so key can be rotated by putting a new one in front of the old ones. """
+    return settings.EXPIRING_LINK_SIGNING_KEYS or [settings.SECRET_KEY]
+
+
+def sign_image_link(image: ImageInstance, expiration_date: datetime) -> str:
+    """ Creates signed token of expiring link to given image.
+        Token keeps everything needed to serve the image, so no database row is created. """
+    payload = {
+        'i': image.id,
+        'f': image.image_file.name,
+        'e': int(expiration_date.timestamp()),
+        's': image.file_size,
+        'h': image.content_hash,
+    }
+    return signing.dumps(payload, key=get_signing_keys()[0], salt=SIGNED_LINK_SALT, compress=True)
+
+
+def unsign_image_link(token: str) -> dict:
+    """ Verifies signature and expiration date of signed link token.
+        :return payload of the token
+        :raises signing.BadSignature if token is forged, signed with unknown key or expired """
+    for key in get_signing_keys():
+        try:
+            payload = signing.loads(token, key=key, salt=SIGNED_LINK_SALT)
+        except signing.BadSignature:
+            continue
+        if payload['e'] < time.time():
+            raise signing.SignatureExpired('Link expired')
+        return payload
+    raise signing.BadSignature('Invalid link signature')
+
+
+def delete_expired_links(batch_size: int = 1000, pause: float = 0) -> Tuple[int, int]:
+    """ Deletes expired links in batches, so every delete is a short transaction
+        which does not hold locks on the table for long.
+        :return number of deleted links and bytes of their data """
+    deleted_rows = deleted_bytes = 0
+    while True:
+        batch = list(TempUrl.objects.filter(expiration_date__lt=timezone.now())
+                     .order_by('expiration_date')
+                     .values_list('id', 'url_hash')[:batch_size])
+        if not batch:
+            break
+        TempUrl.objects.filter(id__in=[link_id for link_id, _ in batch]).delete()
+        deleted_rows += len(batch)
+        deleted_bytes += sum(TEMP_URL_FIXED_BYTES + len(url_hash) for _, url_hash in batch)
+        if len(batch) < batch_size:
+            break
+        time.sleep(pause)
+    return deleted_rows, deleted_bytes
+
+
+def start_expired_links_reaper(interval: float, batch_size: int = 1000) -> threading.Thread:
+    """ Starts daemon thread which deletes expired links every `interval` seconds """
+
+    def reap():
+        while True:
+            time.sleep(interval)
+            try:
+                rows, size = delete_expired_links(batch_size)
+                if rows:
+                    logger.info('Deleted %d expired links (%d bytes)', rows, size)
+            except Exception:
+                logger.exception('Deleting expired links failed')
+            finally:
+                connection.close()
+
+    thread = threading.Thread(target=reap, name='expired-links-reaper', daemon=True)
+    thread.start()
+    return thread
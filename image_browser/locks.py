@@ -0,0 +1,67 @@
+""" Cross-process locks, so work done for a key (like rendering of a missing file) is done only once.
+    Locks are `flock` locks of files in LOCK_DIR, shared by all processes (and threads) on the host.
+    Keys are spread over a fixed number of lock files, so lock files do not pile up - keys sharing a file
+    only wait for each other. """
+import errno
+import fcntl
+import hashlib
+import os
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from django.conf import settings
+
+# number of lock files keys are spread over
+LOCK_STRIPES = 4096
+# interval of lock acquiring attempts when waiting with timeout
+POLL_INTERVAL = 0.01
+
+
+class LockTimeout(Exception):
+    """ Raised when lock is not acquired in given time """
+
+
+def get_lock_dir() -> str:
+    return settings.LOCK_DIR or os.path.join(settings.MEDIA_ROOT, '.locks')
+
+
+def get_lock_path(key: str) -> str:
+    stripe = int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:8], 16) % LOCK_STRIPES
+    return os.path.join(get_lock_dir(), f'{stripe:04x}.lock')
+
+
+@contextmanager
+def key_lock(key: str, timeout: Optional[float] = None):
+    """ Holds exclusive lock of given key.
+        :param timeout: seconds to wait for the lock, None waits until it is released, 0 tries only once
+        :raises LockTimeout if lock is not acquired in time """
+    path = get_lock_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # every acquiring opens the file, so threads of one process lock each other out too
+    descriptor = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        _acquire(descriptor, timeout)
+        try:
+            yield
+        finally:
+            fcntl.flock(descriptor, fcntl.LOCK_UN)
+    finally:
+        os.close(descriptor)
+
+
+def _acquire(descriptor: int, timeout: Optional[float]) -> None:
+    if timeout is None:
+        fcntl.flock(descriptor, fcntl.LOCK_EX)
+        return
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        if time.monotonic() >= deadline:
+            raise LockTimeout()
+        time.sleep(POLL_INTERVAL)
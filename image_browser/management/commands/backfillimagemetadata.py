@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from image_browser.models import ImageInstance
+
+METADATA_FIELDS = ['width', 'height', 'format', 'file_size', 'content_hash']
+
+
+class Command(BaseCommand):
+    help = 'Reads dimensions, format, size and hash of images uploaded before they were stored.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        images = ImageInstance.objects.filter(content_hash='').order_by('id')
+        updated = failed = 0
+        last_id = 0
+        while True:
+            batch = list(images.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            read = []
+            for image in batch:
+                try:
+                    # images stored already are not refused, even if they are too large to be rendered
+                    image.read_file_metadata(check_size=False)
+                except (OSError, ValueError) as e:
+                    # missing or broken files are left for manual check, next run will retry them
+                    print('Image %d (%s): %s' % (image.id, image.image_file.name, e))
+                    failed += 1
+                    continue
+                read.append(image)
+            ImageInstance.objects.bulk_update(read, METADATA_FIELDS)
+            updated += len(read)
+        print('Metadata of %d images stored, %d failed' % (updated, failed))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from image_browser.encodings import get_plan_encodings
+from image_browser.models import ImageInstance
+from image_browser.thumbnails import DEFAULT_ENCODINGS, get_thumbnail_names
+from image_browser.utils import get_plan_by_user
+
+
+class Command(BaseCommand):
+    help = 'Adds thumbnails rendered before manifests were introduced to manifests of images.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        images = ImageInstance.objects.select_related('owner').order_by('id')
+        listed = 0
+        last_id = 0
+        while True:
+            batch = list(images.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            # images of a batch are looked up per plan of their owners
+            plan_images = {}
+            for image in batch:
+                plan = get_plan_by_user(image.owner)
+                if plan is not None:
+                    plan_images.setdefault(plan.pk, (plan, []))[1].append(image)
+            for plan, plan_batch in plan_images.values():
+                listed += len(get_thumbnail_names(plan_batch, plan.thumbnail_sizes.all(),
+                                                  get_plan_encodings(plan) or DEFAULT_ENCODINGS))
+        print('%d thumbnails listed in manifests' % listed)
@@ -0,0 +1,74 @@
+import json
+import shutil
+import sys
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from image_browser.benchmarks import ENDPOINTS, compare_reports, run_benchmark
+from image_browser.management.commands.benchmarkthumbnails import parse_size
+
+
+def parse_sizes(value: str):
+    try:
+        return [int(size) for size in value.split(',')]
+    except ValueError:
+        raise CommandError('Library sizes have to be given as comma separated numbers, got "%s"' % value)
+
+
+class Command(BaseCommand):
+    help = ('Measures latency, throughput, SQL queries and peak memory of upload, list, detail and expiring link '
+            'endpoints at several library sizes. Runs on a fresh test database and temporary media directory, '
+            'writes JSON report which can be compared with report of another commit.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--library-sizes', type=parse_sizes, default=[10, 100, 1000],
+                            help='Comma separated numbers of images of every user.')
+        parser.add_argument('--users', type=int, default=3, help='Seeded users, spread over builtin plans.')
+        parser.add_argument('--requests', type=int, default=20, help='Measured requests of every endpoint.')
+        parser.add_argument('--warmup', type=int, default=1,
+                            help='Requests sent before measuring (e.g. the first list renders thumbnails).')
+        parser.add_argument('--image-size', type=parse_size, default=(800, 600),
+                            help='Size of synthetic images as WIDTHxHEIGHT.')
+        parser.add_argument('--endpoint', action='append', choices=ENDPOINTS, default=[],
+                            help='Endpoint to measure (all by default).')
+        parser.add_argument('--output', help='File of JSON report (standard output by default).')
+        parser.add_argument('--compare', help='JSON report of previous run, printed side by side with this one.')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as baseline_file:
+                baseline = json.load(baseline_file)
+
+        def log(message):
+            print(message, file=sys.stderr)
+
+        media_root = tempfile.mkdtemp(prefix='benchmark-media-')
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(MEDIA_ROOT=media_root, DEBUG=False):
+                report = run_benchmark(options['library_sizes'], options['users'], options['requests'],
+                                       options['warmup'], options['image_size'], options['endpoint'], log)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            shutil.rmtree(media_root, ignore_errors=True)
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+        else:
+            print(json.dumps(report, indent=2))
+
+        if baseline:
+            log('%6s  %-10s  %-10s  %-8s %10s %10s %8s' % ('images', 'plan', 'endpoint', 'metric',
+                                                          'baseline', 'current', 'change'))
+            for library_size, plan, endpoint, metric, before, after in compare_reports(baseline, report):
+                change = '%+.1f%%' % ((after - before) / before * 100) if before else '-'
+                log('%6d  %-10s  %-10s  %-8s %10.2f %10.2f %8s' % (library_size, plan, endpoint, metric,
+                                                                  before, after, change))
@@ -0,0 +1,73 @@
+import os
+import time
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from easy_thumbnails.files import Thumbnailer
+from PIL import Image
+
+from image_browser.builtin_plans import builtin_thumbnail_sizes, premium_plan
+from image_browser.models import ImageInstance
+from image_browser.rendering import generate_thumbnails
+
+
+def parse_size(value: str):
+    try:
+        width, height = (int(dimension) for dimension in value.split('x'))
+    except ValueError:
+        raise CommandError('Size has to be given as WIDTHxHEIGHT, got "%s"' % value)
+    return width, height
+
+
+def create_synthetic_jpeg(width: int, height: int) -> bytes:
+    """ Creates JPEG photo-like (not flat colored) image of given size """
+    image = Image.radial_gradient('L').resize((width, height)).convert('RGB')
+    noise = Image.effect_noise((width, height), 64).convert('RGB')
+    output = BytesIO()
+    Image.blend(image, noise, 0.5).save(output, 'JPEG', quality=90)
+    return output.getvalue()
+
+
+class Command(BaseCommand):
+    help = 'Compares CPU time of rendering every size separately with rendering them in one pass.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help='Images to render (synthetic image by default).')
+        parser.add_argument('--size', action='append', type=parse_size, default=[],
+                            help='Thumbnail size as WIDTHxHEIGHT (sizes of Premium plan by default).')
+        parser.add_argument('--synthetic', type=parse_size, default=(6000, 4000),
+                            help='Size of synthetic JPEG rendered when no paths are given.')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        sizes = options['size'] or [(builtin_thumbnail_sizes[size]['width'], builtin_thumbnail_sizes[size]['height'])
+                                    for size in premium_plan.thumbnail_sizes]
+        thumbnail_options = [ImageInstance.get_thumbnail_options(width, height) for width, height in sizes]
+        if options['paths']:
+            # files are read into memory, so only decoding and scaling is measured
+            sources = []
+            for path in options['paths']:
+                name = os.path.basename(path)
+                with open(path, 'rb') as image_file:
+                    sources.append((name, ContentFile(image_file.read(), name=name)))
+        else:
+            width, height = options['synthetic']
+            sources = [(f'synthetic {width}x{height}.jpg',
+                        ContentFile(create_synthetic_jpeg(width, height), name='synthetic.jpg'))]
+
+        print('%-30s %12s %12s %8s' % ('image', 'separate ms', 'one pass ms', 'speedup'))
+        for label, source in sources:
+            thumbnailer = Thumbnailer(file=source, name=source.name)
+            separate = self.measure(options['repeat'], lambda: [thumbnailer.generate_thumbnail(thumbnail)
+                                                                for thumbnail in thumbnail_options])
+            one_pass = self.measure(options['repeat'], lambda: generate_thumbnails(thumbnailer, thumbnail_options))
+            print('%-30s %12.1f %12.1f %7.1fx' % (label[:30], separate * 1000, one_pass * 1000, separate / one_pass))
+
+    @staticmethod
+    def measure(repeat: int, render) -> float:
+        """ Returns mean CPU time of rendering in seconds """
+        started = time.process_time()
+        for _ in range(repeat):
+            render()
+        return (time.process_time() - started) / repeat
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from image_browser.models import ImageBlob, ImageInstance, User, delete_original, store_blob_file
+
+
+class Command(BaseCommand):
+    help = ('Moves originals of images uploaded without deduplication to shared blobs and deletes their '
+            'separate copies with thumbnails. Signed expiring links of moved images stop working.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        # images without metadata are skipped, `backfillimagemetadata` reads their hashes
+        images = ImageInstance.objects.filter(blob__isnull=True).exclude(content_hash='').order_by('id')
+        moved = failed = 0
+        last_id = 0
+        while True:
+            batch = list(images.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            for image in batch:
+                old_file = image.image_file
+                try:
+                    with transaction.atomic():
+                        ImageBlob.acquire(image, lambda name: store_blob_file(old_file.storage, name, old_file))
+                        ImageInstance.objects.filter(pk=image.pk).update(image_file=image.image_file.name,
+                                                                         blob=image.blob, thumbnail_manifest={})
+                        # jobs and manifest keep names of old thumbnails, thumbnails of the blob are rendered
+                        # when needed
+                        image.thumbnail_jobs.all().delete()
+                        # URLs of the image changed
+                        User.bump_library_version(image.owner_id)
+                except OSError as e:
+                    print('Image %d (%s): %s' % (image.id, old_file.name, e))
+                    failed += 1
+                    continue
+                old_file.close()
+                delete_original(old_file.name)
+                moved += 1
+        print('%d images moved to blobs, %d failed, %d blobs stored' % (moved, failed, ImageBlob.objects.count()))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from image_browser.models import ImageInstance
+from image_browser.similarity import compute_image_perceptual_hash, store_perceptual_hash
+
+
+class Command(BaseCommand):
+    help = 'Computes perceptual hashes of images which have no thumbnail rendered since hashes were introduced.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        images = ImageInstance.objects.filter(phash_0__isnull=True).order_by('id')
+        indexed = failed = 0
+        last_id = 0
+        while True:
+            batch = list(images.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            for image in batch:
+                try:
+                    perceptual_hash = compute_image_perceptual_hash(image)
+                except (OSError, ValueError) as e:
+                    print('Image %d (%s): %s' % (image.id, image.image_file.name, e))
+                    failed += 1
+                    continue
+                store_perceptual_hash(image, perceptual_hash)
+                indexed += 1
+        print('Perceptual hashes of %d images stored, %d failed' % (indexed, failed))
@@ -0,0 +1,112 @@
+import asyncio
+import base64
+import statistics
+import time
+from typing import List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class ClientResult:
+    """ Timings of one request of a simulated client """
+
+    def __init__(self, first_byte: Optional[float] = None, total: Optional[float] = None,
+                 status: Optional[int] = None, size: int = 0, error: Optional[str] = None):
+        self.first_byte = first_byte
+        self.total = total
+        self.status = status
+        self.size = size
+        self.error = error
+
+
+class Command(BaseCommand):
+    help = ('Load test of running server by many concurrent clients, which can read responses slowly '
+            '(like clients on mobile networks). Compare WSGI and ASGI deployments by running it against both.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help='e.g. http://127.0.0.1:8000/temp/<hash>')
+        parser.add_argument('--clients', type=int, default=100)
+        parser.add_argument('--requests', type=int, default=1, help='requests sent by every client one by one')
+        parser.add_argument('--read-rate', type=int, default=0,
+                            help='bytes per second read by every client, 0 reads as fast as possible')
+        parser.add_argument('--user', help='USERNAME:PASSWORD sent with basic authentication')
+        parser.add_argument('--timeout', type=float, default=120)
+
+    def handle(self, *args, **options):
+        url = urlsplit(options['url'])
+        if url.scheme != 'http' or not url.hostname:
+            raise CommandError('Only http:// URLs are supported')
+        headers = [f'Host: {url.netloc}', 'Connection: close']
+        if options['user']:
+            headers.append('Authorization: Basic ' + base64.b64encode(options['user'].encode('utf-8')).decode('ascii'))
+        request = ('GET %s HTTP/1.1\r\n%s\r\n\r\n' % (url.path + (f'?{url.query}' if url.query else '') or '/',
+                                                     '\r\n'.join(headers))).encode('latin1')
+
+        started = time.perf_counter()
+        results = asyncio.run(self.run_clients(url.hostname, url.port or 80, request, options))
+        elapsed = time.perf_counter() - started
+        self.report(results, elapsed, options)
+
+    async def run_clients(self, host: str, port: int, request: bytes, options) -> List[ClientResult]:
+        async def client() -> List[ClientResult]:
+            return [await self.send_request(host, port, request, options) for _ in range(options['requests'])]
+
+        per_client = await asyncio.gather(*(client() for _ in range(options['clients'])))
+        return [result for results in per_client for result in results]
+
+    async def send_request(self, host: str, port: int, request: bytes, options) -> ClientResult:
+        started = time.perf_counter()
+        try:
+            return await asyncio.wait_for(self.read_response(host, port, request, started, options['read_rate']),
+                                          options['timeout'])
+        except (OSError, asyncio.TimeoutError, ValueError) as e:
+            return ClientResult(error=type(e).__name__)
+
+    @staticmethod
+    async def read_response(host: str, port: int, request: bytes, started: float, read_rate: int) -> ClientResult:
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            writer.write(request)
+            await writer.drain()
+            status_line = await reader.readline()
+            first_byte = time.perf_counter() - started
+            status = int(status_line.split()[1])
+            size = 0
+            # slow client reads a chunk per 0.1 s
+            chunk_size = max(read_rate // 10, 1) if read_rate else 64 * 1024
+            while True:
+                chunk = await reader.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if read_rate:
+                    await asyncio.sleep(len(chunk) / read_rate)
+            return ClientResult(first_byte, time.perf_counter() - started, status, size)
+        finally:
+            writer.close()
+
+    @staticmethod
+    def report(results: List[ClientResult], elapsed: float, options) -> None:
+        done = [result for result in results if result.error is None]
+        statuses = {}
+        for result in done:
+            statuses[result.status] = statuses.get(result.status, 0) + 1
+        errors = {}
+        for result in results:
+            if result.error:
+                errors[result.error] = errors.get(result.error, 0) + 1
+        print('%d clients x %d requests in %.2f s, %.1f requests/s, %.1f MB received'
+              % (options['clients'], options['requests'], elapsed, len(done) / elapsed,
+                 sum(result.size for result in done) / 1024 / 1024))
+        print('statuses: %s, errors: %s' % (statuses, errors or 'none'))
+        if done:
+            for label, values in (('first byte', [result.first_byte for result in done]),
+                                  ('total', [result.total for result in done])):
+                print('%-10s  p50 %.3f s  p95 %.3f s  max %.3f s' % ((label,) + percentiles(values)))
+
+
+def percentiles(values: List[float]) -> Tuple[float, float, float]:
+    values = sorted(values)
+    p95 = values[min(int(len(values) * 0.95), len(values) - 1)]
+    return statistics.median(values), p95, values[-1]
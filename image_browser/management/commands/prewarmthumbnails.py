@@ -0,0 +1,153 @@
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ALL_COMPLETED, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from django.core.management.base import BaseCommand, CommandError
+
+from image_browser.encodings import get_plan_encodings
+from image_browser.models import PlanTier, ImageInstance, User
+from image_browser.thumbnails import DEFAULT_ENCODINGS, get_missing_thumbnails
+from image_browser.utils import get_plan_images, get_plan_by_user
+from image_browser.workers import init_worker, prerender_image
+
+
+class InlineExecutor(Executor):
+    """ Executor rendering in current process, used when no worker processes are requested """
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class Command(BaseCommand):
+    help = 'Renders missing thumbnails of plan sizes for existing images.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--plan', action='append', default=[],
+                            help='Name of plan which images are prerendered (all plans by default).')
+        parser.add_argument('--user', action='append', default=[],
+                            help='Username which images are prerendered (e.g. after plan change).')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of rendering processes (0 - render in this process).')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='Maximum number of images rendered per second (0 - no limit).')
+        parser.add_argument('--batch-size', type=int, default=200)
+        parser.add_argument('--checkpoint',
+                            help='File keeping ids of the last processed images, used to resume interrupted run.')
+
+    def handle(self, *args, **options):
+        targets = self.get_targets(options['plan'], options['user'])
+        checkpoint = self.read_checkpoint(options['checkpoint'])
+
+        if options['workers'] > 0:
+            executor = ProcessPoolExecutor(max_workers=options['workers'], initializer=init_worker,
+                                           mp_context=multiprocessing.get_context('spawn'))
+        else:
+            executor = InlineExecutor()
+        with executor:
+            for key, images, plan in targets:
+                if checkpoint.get(key):
+                    print('%s: resuming after image %d' % (key, checkpoint[key]))
+                self.prerender(executor, key, images.filter(id__gt=checkpoint.get(key, 0)), plan.thumbnail_sizes.all(),
+                               get_plan_encodings(plan) or DEFAULT_ENCODINGS, checkpoint, options)
+
+    @staticmethod
+    def get_targets(plan_names, usernames):
+        """ Returns (checkpoint key, images, plan) of every plan and user to prerender """
+        targets = []
+        for username in usernames:
+            try:
+                user = User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError('User "%s" does not exist' % username)
+            targets.append((f'user:{username}', ImageInstance.objects.filter(owner=user), get_plan_by_user(user)))
+        plans = PlanTier.objects.filter(name__in=plan_names) if plan_names else PlanTier.objects.all()
+        if plan_names and len(plans) != len(set(plan_names)):
+            raise CommandError('Unknown plan in %s' % ', '.join(plan_names))
+        if plan_names or not usernames:
+            targets += [(f'plan:{plan.name}', get_plan_images(plan), plan) for plan in plans]
+        return targets
+
+    @staticmethod
+    def read_checkpoint(path) -> dict:
+        if not path or not os.path.exists(path):
+            return {}
+        with open(path) as checkpoint:
+            return json.load(checkpoint)
+
+    @staticmethod
+    def write_checkpoint(path, checkpoint: dict) -> None:
+        if path:
+            with open(path, 'w') as checkpoint_file:
+                json.dump(checkpoint, checkpoint_file)
+
+    def prerender(self, executor, key, images, sizes, encodings, checkpoint, options):
+        sizes = list(sizes)
+        if not sizes:
+            return
+        total = images.count()
+        max_pending = options['workers'] * 2
+        interval = 1 / options['rate'] if options['rate'] else 0
+        pending = {}
+        checked = rendered = failed = 0
+        last_id = 0
+        started = last_report = next_submit = time.monotonic()
+
+        def collect(return_when):
+            nonlocal rendered, failed
+            done, _ = wait(pending, return_when=return_when)
+            for future in done:
+                image_id = pending.pop(future)
+                try:
+                    rendered += future.result()
+                except BrokenProcessPool:
+                    raise
+                except Exception as e:
+                    # missing or broken original, original refused by decoding policy (or over worker memory
+                    # limit) - the image counts as done, so resumed run does not stop at it again
+                    print('Image %d: %s' % (image_id, e or type(e).__name__))
+                    failed += 1
+
+        def save_progress():
+            # every image before the oldest pending one is done
+            checkpoint[key] = min(pending.values()) - 1 if pending else last_id
+            self.write_checkpoint(options['checkpoint'], checkpoint)
+
+        while True:
+            batch = list(images.filter(id__gt=last_id).order_by('id')[:options['batch_size']])
+            if not batch:
+                break
+            missing = get_missing_thumbnails(batch, sizes, encodings)
+            for image in batch:
+                checked += 1
+                if image.id not in missing:
+                    continue
+                if len(pending) >= max_pending:
+                    collect(FIRST_COMPLETED)
+                if interval:
+                    time.sleep(max(0.0, next_submit - time.monotonic()))
+                    next_submit = max(next_submit, time.monotonic()) + interval
+                future = executor.submit(prerender_image, image.id,
+                                         [(size.width, size.height) for size in missing[image.id]],
+                                         [tuple(encoding) if encoding else None for encoding in encodings])
+                pending[future] = image.id
+            last_id = batch[-1].id
+            save_progress()
+
+            now = time.monotonic()
+            if now - last_report >= 5:
+                last_report = now
+                print('%s: %d/%d images checked, %d thumbnails rendered (%.1f thumbnails/s)'
+                      % (key, checked, total, rendered, rendered / (now - started)))
+        collect(ALL_COMPLETED)
+        save_progress()
+        elapsed = time.monotonic() - started
+        print('%s: %d images checked, %d thumbnails rendered in %.1fs (%.1f thumbnails/s), %d images failed'
+              % (key, checked, rendered, elapsed, rendered / elapsed if elapsed else 0, failed))
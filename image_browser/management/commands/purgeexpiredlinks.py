@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from image_browser.links import delete_expired_links
+
+
+class Command(BaseCommand):
+    help = 'Deletes expired links in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Seconds to wait between batches.')
+
+    def handle(self, *args, **options):
+        rows, size = delete_expired_links(options['batch_size'], options['pause'])
+        print('Deleted %d expired links (%d bytes reclaimed)' % (rows, size))
@@ -0,0 +1,18 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from image_browser.uploads import delete_stale_sessions
+
+
+class Command(BaseCommand):
+    help = 'Deletes unfinished upload sessions with their partially received files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=settings.UPLOAD_SESSION_MAX_AGE,
+                            help='Seconds after which unfinished session is deleted.')
+
+    def handle(self, *args, **options):
+        deleted = delete_stale_sessions(timedelta(seconds=options['max_age']))
+        print('Deleted %d upload sessions' % deleted)
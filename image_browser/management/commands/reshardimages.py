@@ -0,0 +1,54 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from image_browser.models import ImageInstance, User, delete_original
+from image_browser.storage import get_image_path, is_local
+from image_browser.uploads import move_into_storage
+
+
+class Command(BaseCommand):
+    help = ('Moves originals to paths of current IMAGE_PATH_LAYOUT and deletes their thumbnails, which are rendered '
+            'again next to them. Signed expiring links of moved images stop working.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        # deduplicated originals have their own layout
+        images = ImageInstance.objects.filter(blob__isnull=True).select_related('owner').order_by('id')
+        moved = failed = 0
+        last_id = 0
+        while True:
+            batch = list(images.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            for image in batch:
+                old_name = image.image_file.name
+                target_name = get_image_path(image.owner.username, os.path.basename(old_name))
+                if os.path.dirname(old_name) == os.path.dirname(target_name):
+                    continue
+                try:
+                    new_name = self.copy_file(image.image_file.storage, old_name, target_name)
+                except OSError as e:
+                    print('Image %d (%s): %s' % (image.id, old_name, e))
+                    failed += 1
+                    continue
+                with transaction.atomic():
+                    ImageInstance.objects.filter(pk=image.pk).update(image_file=new_name, thumbnail_manifest={})
+                    # jobs and manifest keep names of old thumbnails
+                    image.thumbnail_jobs.all().delete()
+                    User.bump_library_version(image.owner_id)
+                delete_original(old_name)
+                moved += 1
+        print('%d images moved, %d failed' % (moved, failed))
+
+    @staticmethod
+    def copy_file(storage, old_name: str, target_name: str) -> str:
+        """ Stores the file under target name (or available name next to it), local file is linked, not copied """
+        if is_local(storage):
+            return move_into_storage(storage, storage.path(old_name), target_name)
+        with storage.open(old_name, 'rb') as old_file:
+            return storage.save(target_name, old_file)
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from image_browser.thumbnails import render_pending_jobs
+
+
+class Command(BaseCommand):
+    help = 'Renders pending thumbnails from the database job queue.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Process pending jobs once and exit.')
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--poll-interval', type=float, default=2.0,
+                            help='Seconds to wait when there are no pending jobs.')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = render_pending_jobs(options['batch_size'])
+            if processed:
+                print('Rendered %d thumbnail(s)' % processed)
+            if options['once']:
+                break
+            if not processed:
+                time.sleep(options['poll_interval'])
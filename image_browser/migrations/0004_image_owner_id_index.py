@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_browser', '0003_thumbnailjob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='imageinstance',
+            index=models.Index(fields=['owner', 'id'], name='image_owner_id_idx'),
+        ),
+    ]
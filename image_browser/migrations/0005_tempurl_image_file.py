@@ -0,0 +1,32 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    """ Expiring links point to stored image file instead of keeping its binary in database.
+        Existing links keep only decoded pixel buffer (without size or mode of an image),
+        which can neither be served as an image file nor linked back to ImageInstance,
+        so they are removed. They would expire within 30000 seconds anyway. """
+
+    dependencies = [
+        ('image_browser', '0004_image_owner_id_index'),
+    ]
+
+    def delete_binary_links(apps, schema_editor):
+        TempUrl = apps.get_model('image_browser', 'TempUrl')
+        TempUrl.objects.all().delete()
+
+    operations = [
+        migrations.RunPython(delete_binary_links, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='tempurl',
+            name='image',
+        ),
+        migrations.AddField(
+            model_name='tempurl',
+            name='image',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='temp_urls',
+                                    to='image_browser.imageinstance'),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_browser', '0005_tempurl_image_file'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='tempurl',
+            name='expiration_date',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
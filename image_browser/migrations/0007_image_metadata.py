@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_browser', '0006_tempurl_expiration_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageinstance',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='imageinstance',
+            name='file_size',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageinstance',
+            name='format',
+            field=models.CharField(blank=True, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='imageinstance',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageinstance',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
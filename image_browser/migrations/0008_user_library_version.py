@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_browser', '0007_image_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='library_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:32
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import easy_thumbnails.fields
+import image_browser.models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_browser', '0008_user_library_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='imageinstance',
+            name='image_file',
+            field=easy_thumbnails.fields.ThumbnailerImageField(upload_to=image_browser.models.user_directory_path, validators=[image_browser.models.validate_file_extension, image_browser.models.validate_file_signature]),
+        ),
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('name', models.CharField(blank=True, max_length=50)),
+                ('filename', models.CharField(max_length=255, validators=[image_browser.models.validate_filename_extension])),
+                ('size', models.PositiveBigIntegerField()),
+                ('received', models.PositiveBigIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
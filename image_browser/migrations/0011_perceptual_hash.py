@@ -0,0 +1,49 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_browser', '0010_imageblob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageinstance',
+            name='phash_0',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageinstance',
+            name='phash_1',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageinstance',
+            name='phash_2',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageinstance',
+            name='phash_3',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='imageinstance',
+            index=models.Index(fields=['owner', 'phash_0'], name='image_owner_phash_0_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imageinstance',
+            index=models.Index(fields=['owner', 'phash_1'], name='image_owner_phash_1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imageinstance',
+            index=models.Index(fields=['owner', 'phash_2'], name='image_owner_phash_2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imageinstance',
+            index=models.Index(fields=['owner', 'phash_3'], name='image_owner_phash_3_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:43
+
+from django.db import migrations
+import easy_thumbnails.fields
+import image_browser.models
+import image_browser.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_browser', '0011_perceptual_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='imageinstance',
+            name='image_file',
+            field=easy_thumbnails.fields.ThumbnailerImageField(storage=image_browser.storage.get_image_storage, upload_to=image_browser.models.user_directory_path, validators=[image_browser.models.validate_file_extension, image_browser.models.validate_file_signature]),
+        ),
+    ]
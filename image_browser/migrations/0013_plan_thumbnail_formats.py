@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:57
+
+import django.core.validators
+from django.db import migrations, models
+import image_browser.encodings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_browser', '0012_image_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='plantier',
+            name='thumbnail_formats',
+            field=models.CharField(blank=True, default='', help_text='Comma separated thumbnail formats: jpeg, webp, avif', max_length=50, validators=[image_browser.encodings.validate_thumbnail_formats]),
+        ),
+        migrations.AddField(
+            model_name='plantier',
+            name='thumbnail_quality',
+            field=models.PositiveSmallIntegerField(default=85, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(100)]),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_browser', '0013_plan_thumbnail_formats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='plantier',
+            name='render_max_dimension',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_browser', '0014_plan_render_max_dimension'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageinstance',
+            name='thumbnail_manifest',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_browser', '0015_thumbnail_manifest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='plantier',
+            name='max_image_pixels',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -1,19 +1,28 @@
 # Create your models here.
 import hashlib
+import uuid
 from datetime import datetime
+from functools import partial
+from typing import Callable, Optional
 
-from PIL import Image
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.core.files.uploadedfile import InMemoryUploadedFile
-from django.db import models
+from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db import models, transaction
 from easy_thumbnails.fields import ThumbnailerImageField
 from easy_thumbnails.files import get_thumbnailer
 from rest_framework.exceptions import ValidationError
 
+from image_browser import decoding
+from image_browser.encodings import ThumbnailEncoding, validate_thumbnail_formats
+from image_browser.rendering import get_oriented_size
+from image_browser.storage import get_image_path, get_image_storage, image_storage
 
-# setting file path to MEDIA_ROOT/user_<user_id>/<filename> for links readability
+
+# setting file path to user_<username>/<filename> (or to its shard of the user directory) for links readability
 def user_directory_path(instance, filename):
-    return f'user_{instance.owner.username}/{filename}'
+    return get_image_path(instance.owner.username, filename)
 
 
 class ThumbnailSize(models.Model):
@@ -32,6 +41,16 @@ class PlanTier(models.Model):
     thumbnail_sizes = models.ManyToManyField(ThumbnailSize)
     show_original_link = models.BooleanField(null=False)
     create_expiring_link = models.BooleanField(null=False)
+    # formats of thumbnails in order of preference (e.g. "webp,jpeg"), empty keeps format of easy_thumbnails
+    thumbnail_formats = models.CharField(max_length=50, blank=True, default='',
+                                         validators=[validate_thumbnail_formats],
+                                         help_text='Comma separated thumbnail formats: jpeg, webp, avif')
+    thumbnail_quality = models.PositiveSmallIntegerField(default=85,
+                                                         validators=[MinValueValidator(1), MaxValueValidator(100)])
+    # maximal dimension of images rendered on demand in requested sizes, 0 disables on demand rendering
+    render_max_dimension = models.PositiveIntegerField(default=0)
+    # maximal number of pixels of uploaded images, 0 allows IMAGE_MAX_PIXELS (which is never exceeded)
+    max_image_pixels = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return self.name
@@ -39,7 +58,12 @@ class PlanTier(models.Model):
 
 class User(AbstractUser):
     """ User class used to authentication"""
-    pass
+    # increased on every change of user images, validates cached image lists of the user
+    library_version = models.PositiveIntegerField(default=0)
+
+    @staticmethod
+    def bump_library_version(user_id: int) -> None:
+        User.objects.filter(pk=user_id).update(library_version=models.F('library_version') + 1)
 
 
 class AppUser(models.Model):
@@ -50,25 +74,197 @@ class AppUser(models.Model):
 
 def validate_file_extension(image_object: InMemoryUploadedFile) -> None:
     """ Validates if image extension is one of .jpg or .png """
-    value = image_object.name
+    validate_filename_extension(image_object.name)
+
+
+def validate_filename_extension(value: str) -> None:
+    """ Validates if file name extension is one of .jpg or .png """
     whitelist = ['.jpg', '.jpeg', '.png']
     if not any(value.endswith(extension) for extension in whitelist):
         raise ValidationError('image extension has to be one of .jpg and .png')
 
 
+# leading bytes of allowed image formats
+IMAGE_SIGNATURES = {
+    'JPEG': b'\xff\xd8\xff',
+    'PNG': b'\x89PNG\r\n\x1a\n',
+}
+
+
+def get_image_signature_format(header: bytes) -> Optional[str]:
+    """ Returns format of image starting with given bytes, None if it is not an allowed format """
+    return next((image_format for image_format, signature in IMAGE_SIGNATURES.items()
+                 if header.startswith(signature)), None)
+
+
+def validate_file_signature(image_object: InMemoryUploadedFile) -> None:
+    """ Validates if file content starts like .jpg or .png file, not only its name """
+    image_object.seek(0)
+    header = image_object.read(8)
+    image_object.seek(0)
+    if get_image_signature_format(header) is None:
+        raise ValidationError('file content is not a .jpg or .png image')
+
+
+# file name extensions of deduplicated originals by image format
+BLOB_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png'}
+
+
+def get_blob_name(content_hash: str, image_format: str) -> str:
+    """ Returns storage name of original with given content, two levels of directories keep them small """
+    return f'blobs/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}{BLOB_EXTENSIONS.get(image_format, "")}'
+
+
+def store_blob_file(storage, name: str, content) -> None:
+    """ Saves content under blob name unless it is already stored - content of a blob never changes """
+    if storage.exists(name):
+        return
+    saved_name = storage.save(name, content)
+    if saved_name != name:
+        # the same content was stored concurrently, so the copy saved under another name is not needed
+        storage.delete(saved_name)
+
+
+def delete_original(name: str) -> None:
+    """ Deletes stored original with given name, its thumbnails and their easy_thumbnails cache rows """
+    ImageInstance(image_file=name).image_file.delete(save=False)
+
+
+class ImageBlob(models.Model):
+    """ Model responsible for deduplicated originals.
+        File with given content is stored (and its thumbnails rendered) once, images with the same content
+        share it. Blob counts images referring to it and is deleted with its files by the last one. """
+    content_hash = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    references = models.PositiveIntegerField(default=0)
+
+    @staticmethod
+    def acquire(image: 'ImageInstance', store: Callable[[str], None]) -> 'ImageBlob':
+        """ Points image (with read metadata) to the blob of its content, creating the blob if needed.
+            `store` is called with blob name to save the file when it is not stored yet.
+            Image has to be saved in the same transaction. """
+        with transaction.atomic():
+            blob, created = ImageBlob.objects.select_for_update().get_or_create(
+                content_hash=image.content_hash,
+                defaults={'name': get_blob_name(image.content_hash, image.format), 'size': image.file_size})
+            # blob left without references may have its files deleted already
+            if created or not blob.references:
+                store(blob.name)
+            ImageBlob.objects.filter(pk=blob.pk).update(references=models.F('references') + 1)
+        image.blob = blob
+        # like saved field file, image refers to the stored file by its name
+        image.image_file = blob.name
+        return blob
+
+    @staticmethod
+    def release(blob_id: int) -> None:
+        """ Drops reference of deleted image. Blob of the last one is purged (with its file and thumbnails)
+            after the surrounding transaction commits, so rolled back deletion keeps the files. """
+        with transaction.atomic():
+            blob = ImageBlob.objects.select_for_update().filter(pk=blob_id).first()
+            if blob is None or not blob.references:
+                return
+            ImageBlob.objects.filter(pk=blob_id).update(references=models.F('references') - 1)
+            if blob.references == 1:
+                transaction.on_commit(partial(ImageBlob.purge, blob_id))
+
+    @staticmethod
+    def purge(blob_id: int) -> None:
+        """ Deletes blob without references with its file and thumbnails.
+            Blob acquired again in the meantime is kept. """
+        with transaction.atomic():
+            blob = ImageBlob.objects.select_for_update().filter(pk=blob_id, references=0).first()
+            if blob is None:
+                return
+            # files are deleted while the row is locked - upload of the same content waits and stores them again
+            delete_original(blob.name)
+            blob.delete()
+
+    def __str__(self):
+        return self.name
+
+
+# columns of 16 bit chunks of 64 bit perceptual hash, each one indexed for near-duplicate search
+PERCEPTUAL_HASH_FIELDS = ['phash_0', 'phash_1', 'phash_2', 'phash_3']
+
+
 class ImageInstance(models.Model):
     """ Model responsible for image management """
     image_file = ThumbnailerImageField(upload_to=user_directory_path,
+                                       # originals and their thumbnails are kept in the same storage
+                                       storage=get_image_storage,
+                                       thumbnail_storage=image_storage,
                                        null=False,
                                        # image has to be .jpg or .png
-                                       validators=[validate_file_extension])
+                                       validators=[validate_file_extension, validate_file_signature])
     name = models.CharField(max_length=50, default='No name')
     owner = models.ForeignKey(User, on_delete=models.CASCADE)
 
-    def get_binary(self):
-        """ Returns binary of an image."""
-        img = Image.open(self.image_file)
-        return img.tobytes()
+    # metadata of image file read at upload, so the file does not have to be opened to get them
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    format = models.CharField(max_length=10, blank=True)
+    file_size = models.PositiveBigIntegerField(null=True, blank=True)
+    content_hash = models.CharField(max_length=64, blank=True)
+    # shared original, if deduplication is enabled
+    blob = models.ForeignKey(ImageBlob, on_delete=models.PROTECT, null=True, blank=True, related_name='images')
+    # perceptual hash (dHash) computed from the first rendered thumbnail
+    phash_0 = models.PositiveIntegerField(null=True, blank=True)
+    phash_1 = models.PositiveIntegerField(null=True, blank=True)
+    phash_2 = models.PositiveIntegerField(null=True, blank=True)
+    phash_3 = models.PositiveIntegerField(null=True, blank=True)
+    # names of rendered thumbnails by manifest key (size and encoding), so their URLs are built without any lookup
+    thumbnail_manifest = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        # images are listed per owner in id order, similar images are looked up per owner by hash chunks
+        indexes = [models.Index(fields=['owner', 'id'], name='image_owner_id_idx')] + [
+            models.Index(fields=['owner', field], name=f'image_owner_{field}_idx') for field in PERCEPTUAL_HASH_FIELDS]
+
+    def save(self, *args, **kwargs):
+        # newly uploaded file is still local here, before it is sent to the storage
+        if self.image_file and not self.image_file._committed:
+            self.read_file_metadata()
+            if settings.IMAGE_DEDUPLICATION:
+                uploaded = self.image_file.file
+                with transaction.atomic():
+                    ImageBlob.acquire(self, lambda name: store_blob_file(self.image_file.storage, name, uploaded))
+                    super().save(*args, **kwargs)
+                return
+        super().save(*args, **kwargs)
+
+    def read_file_metadata(self, check_size: bool = True) -> None:
+        """ Sets dimensions (after EXIF orientation), format, byte size and SHA-256 hash of image file.
+            Pillow reads only the image header, the content is read once, in chunks, for the hash.
+            :param check_size: refuse image with more pixels than plan of the owner allows, before it is decoded """
+        image_file = self.image_file
+        image_file.open('rb')
+        try:
+            try:
+                image = decoding.open_image(image_file)
+                if check_size:
+                    decoding.check_pixels(image.size, self.get_max_pixels())
+            except decoding.ImageTooLarge as e:
+                raise ValidationError(str(e))
+            self.width, self.height = get_oriented_size(image)
+            self.format = image.format or ''
+            content_hash = hashlib.sha256()
+            self.file_size = 0
+            for chunk in image_file.chunks():
+                content_hash.update(chunk)
+                self.file_size += len(chunk)
+            self.content_hash = content_hash.hexdigest()
+        finally:
+            # uploaded file is still needed to save it to the storage
+            if image_file._committed:
+                image_file.close()
+
+    def get_max_pixels(self) -> int:
+        """ Returns maximal number of pixels of the image allowed by plan of its owner """
+        # utils import models, so plan resolving is imported here
+        from image_browser.utils import get_plan_by_user
+        return decoding.get_max_pixels(get_plan_by_user(self.owner) if self.owner_id else None)
 
     def get_hash(self):
         """ Returns hash based on ImageInstance properties.
@@ -78,21 +274,92 @@ class ImageInstance(models.Model):
         text_enc = hashlib.sha256(text.encode('utf-8'))
         return text_enc.hexdigest()
 
-    def get_thumbnail_url(self, width: int, height: int):
-        """ Returns a URL of thumbnail with given width and height.
+    @staticmethod
+    def get_thumbnail_options(width: int, height: int, encoding: Optional[ThumbnailEncoding] = None) -> dict:
+        """ Returns easy_thumbnails options for thumbnail with given width and height (and encoding) """
+        options = {'size': (width, height), 'crop': False}
+        if encoding is not None:
+            options.update(encoding.get_options())
+        return options
+
+    @staticmethod
+    def get_manifest_key(width: int, height: int, encoding: Optional[ThumbnailEncoding] = None) -> str:
+        """ Returns key of thumbnail in the manifest - quality is a part of it, as it changes thumbnail name """
+        key = f'{width}x{height}'
+        if encoding is not None:
+            key += f':{encoding.format}:{encoding.quality}'
+        return key
+
+    def get_thumbnail(self, width: int, height: int):
+        """ Returns a thumbnail file with given width and height, rendering it if needed.
             If sizes change image proportions - only bigger value is taken into process
             and the other is adjusted so proportions stays the same as in original file"""
-        options = {'size': (width, height), 'crop': False}
-        return get_thumbnailer(self.image_file).get_thumbnail(options).url
+        options = self.get_thumbnail_options(width, height)
+        return get_thumbnailer(self.image_file).get_thumbnail(options)
+
+    def get_thumbnail_url(self, width: int, height: int):
+        """ Returns a URL of thumbnail with given width and height.
+            URL of thumbnail listed in the manifest is built without checking the storage. """
+        name = self.thumbnail_manifest.get(self.get_manifest_key(width, height))
+        if name:
+            return self.image_file.thumbnail_storage.url(name)
+        return self.get_thumbnail(width, height).url
 
     def __str__(self):
         return self.name
 
 
+class ThumbnailJob(models.Model):
+    """ Model responsible for background thumbnail rendering.
+        Keeps rendering status of one thumbnail size of an image. """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    READY = 'ready'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (READY, 'Ready'),
+        (FAILED, 'Failed'),
+    ]
+
+    image = models.ForeignKey(ImageInstance, on_delete=models.CASCADE, related_name='thumbnail_jobs')
+    width = models.IntegerField()
+    height = models.IntegerField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    thumbnail_name = models.CharField(max_length=255, blank=True)
+    error = models.TextField(blank=True)
+    # failed jobs are retried until they reach THUMBNAIL_JOB_MAX_ATTEMPTS
+    attempts = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('image', 'width', 'height')
+
+    def __str__(self):
+        return f'{self.image} {self.height}x{self.width} ({self.status})'
+
+
 class TempUrl(models.Model):
     """ Model responsible for expiring links management.
-        Keeps binary of an image and link expiration time.
+        Keeps image which link leads to and link expiration time.
         Hash is used for URL creation. """
     url_hash = models.CharField(blank=False, max_length=100, unique=True)
-    expiration_date = models.DateTimeField()
-    image = models.BinaryField()
+    expiration_date = models.DateTimeField(db_index=True)
+    image = models.ForeignKey(ImageInstance, on_delete=models.CASCADE, related_name='temp_urls')
+
+
+class UploadSession(models.Model):
+    """ Model responsible for resumable uploads.
+        Received part of the file is kept on disk until the upload is finalized into ImageInstance. """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE)
+    name = models.CharField(max_length=50, blank=True)
+    filename = models.CharField(max_length=255, validators=[validate_filename_extension])
+    size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f'{self.filename} ({self.received}/{self.size})'
+
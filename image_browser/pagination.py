@@ -0,0 +1,13 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class ImageCursorPagination(CursorPagination):
+    """ Cursor pagination of images ordered by id.
+        Position is kept in the cursor, so deep pages cost the same as the first one. """
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+
+    @property
+    def max_page_size(self) -> int:
+        return settings.IMAGE_LIST_MAX_PAGE_SIZE
@@ -29,3 +29,11 @@ class CanCreateExpiringLink(permissions.BasePermission):
         user = request.user
         plan = get_plan_by_user(user)
         return plan.create_expiring_link
+
+
+class CanSeeOriginal(permissions.BasePermission):
+    """ Custom permission to only allow users that have original links
+        in their plans """
+    def has_permission(self, request, view):
+        plan = get_plan_by_user(request.user)
+        return plan.show_original_link
@@ -0,0 +1,117 @@
+""" Cache of resolved user plans.
+    Plans (with their thumbnail sizes) and plan names of users are kept in per process LRU cache
+    and in shared cache backend (PLAN_CACHE_ALIAS). Cached values are versioned by a generation number kept
+    in the shared cache, which is increased on every change of plans, thumbnail sizes or user plans.
+    Without shared cache plans are not cached - other processes could not learn about their changes,
+    and stale plans would keep revoked rights. """
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from image_browser.models import AppUser, PlanTier
+
+GENERATION_KEY = 'image_browser:plans:generation'
+
+
+class LRUCache:
+    """ Thread safe dictionary which drops least recently used items above `max_size` """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default=None) -> Any:
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return default
+            return self._items[key]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+_local_cache = LRUCache(settings.PLAN_CACHE_SIZE)
+
+
+def _shared_cache():
+    return caches[settings.PLAN_CACHE_ALIAS] if settings.PLAN_CACHE_ALIAS else None
+
+
+def get_generation() -> int:
+    """ Returns current generation of cached plans (0 without shared cache, when plans are not cached) """
+    shared = _shared_cache()
+    if shared is None:
+        return 0
+    generation = shared.get(GENERATION_KEY)
+    if generation is None:
+        # generation starts from current time, so values cached before the key was evicted are not reused
+        shared.add(GENERATION_KEY, int(time.time() * 1000), timeout=None)
+        generation = shared.get(GENERATION_KEY)
+    return generation
+
+
+def invalidate_plans() -> None:
+    """ Makes all cached plans stale.
+        It is repeated after commit, so a plan cached by other request before the commit is not kept. """
+    _invalidate()
+    transaction.on_commit(_invalidate)
+
+
+def _invalidate() -> None:
+    _local_cache.clear()
+    shared = _shared_cache()
+    if shared is not None:
+        try:
+            shared.incr(GENERATION_KEY)
+        except ValueError:
+            shared.add(GENERATION_KEY, int(time.time() * 1000), timeout=None)
+
+
+def _get_cached(key: str, load: Callable[[], Any]) -> Any:
+    shared = _shared_cache()
+    if shared is None:
+        return load()
+    generation = get_generation()
+    value = _local_cache.get((generation, key))
+    if value is not None:
+        return value
+    shared_key = f'image_browser:plans:{generation}:{key}'
+    value = shared.get(shared_key)
+    if value is None:
+        value = load()
+        shared.set(shared_key, value, settings.PLAN_CACHE_TIMEOUT)
+    _local_cache.set((generation, key), value)
+    return value
+
+
+def get_plan(name: str) -> PlanTier:
+    """ Returns plan with given name with its thumbnail sizes prefetched.
+        Returned plan is shared between requests, so it must not be modified. """
+    return _get_cached(f'plan:{name}',
+                       lambda: PlanTier.objects.prefetch_related('thumbnail_sizes').get(name=name))
+
+
+def get_user_plan_name(user_id: int) -> str:
+    """ Returns name of plan of user with given id
+        :raises AppUser.DoesNotExist if user has no plan """
+    return _get_cached(f'user:{user_id}',
+                       lambda: AppUser.objects.values_list('plan_id', flat=True).get(user_id=user_id))
@@ -0,0 +1,241 @@
+""" Opt-in profiling of requests and hot paths (PROFILING setting).
+    Timed sections (SQL queries, storage reads and writes, thumbnail decoding, scaling and encoding, plan resolving,
+    serialization) are summed per request and in process-wide counters. Counters are exposed in Prometheus
+    text format at /metrics and per request timings in Server-Timing header (PROFILING_SERVER_TIMING).
+    Timings of a request include only work done before its response is returned - streamed file contents
+    are read later. """
+import asyncio
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# labels of a counter as sorted (name, value) pairs
+Labels = Tuple[Tuple[str, str], ...]
+
+METRIC_PREFIX = 'image_browser'
+
+
+class Metrics:
+    """ Thread safe process-wide counters """
+
+    def __init__(self):
+        self._counters: Dict[str, Dict[Labels, float]] = OrderedDict()
+        self._help: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, value: float, help_text: str = '', **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counter = self._counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+            if help_text:
+                self._help.setdefault(name, help_text)
+
+    def get(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._counters.clear()
+
+    def render(self) -> str:
+        """ Returns counters in Prometheus text exposition format """
+        lines = []
+        with self._lock:
+            for name, values in self._counters.items():
+                metric = f'{METRIC_PREFIX}_{name}'
+                if name in self._help:
+                    lines.append(f'# HELP {metric} {self._help[name]}')
+                lines.append(f'# TYPE {metric} counter')
+                for labels, value in values.items():
+                    label_text = ','.join('%s="%s"' % (label, _escape(value)) for label, value in labels)
+                    lines.append('%s%s %s' % (metric, '{%s}' % label_text if label_text else '', repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+metrics = Metrics()
+
+
+class RequestProfile:
+    """ Timings of one request - number of calls and total seconds of every section, and byte counts """
+
+    def __init__(self):
+        self.sections: Dict[str, list] = OrderedDict()
+        self.bytes: Dict[str, int] = {}
+
+    def add(self, section: str, seconds: float, size: Optional[int] = None) -> None:
+        calls_and_seconds = self.sections.setdefault(section, [0, 0.0])
+        calls_and_seconds[0] += 1
+        calls_and_seconds[1] += seconds
+        if size is not None:
+            self.bytes[section] = self.bytes.get(section, 0) + size
+
+    def get_server_timing(self, total: float) -> str:
+        """ Returns value of Server-Timing header, durations in milliseconds """
+        entries = []
+        for section, (calls, seconds) in self.sections.items():
+            description = f'{calls} calls'
+            if section in self.bytes:
+                description += f', {self.bytes[section]} bytes'
+            entries.append('%s;dur=%.2f;desc="%s"' % (re.sub(r'[^\w-]', '-', section), seconds * 1000, description))
+        entries.append('total;dur=%.2f' % (total * 1000))
+        return ', '.join(entries)
+
+
+# profile of request being handled in current thread or task (propagated to threads of sync_to_async)
+_current_profile: ContextVar[Optional[RequestProfile]] = ContextVar('request_profile', default=None)
+
+
+def is_enabled() -> bool:
+    return settings.PROFILING
+
+
+def record(section: str, seconds: float, size: Optional[int] = None) -> None:
+    """ Adds duration (and processed bytes) of a section to the current request and to process counters """
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.add(section, seconds, size)
+    metrics.add('section_calls_total', 1, 'Number of calls of profiled sections', section=section)
+    metrics.add('section_seconds_total', seconds, 'Seconds spent in profiled sections', section=section)
+    if size is not None:
+        metrics.add('section_bytes_total', size, 'Bytes processed by profiled sections', section=section)
+
+
+@contextmanager
+def timed(section: str):
+    """ Measures duration of enclosed code (or decorated function) as given section, if profiling is enabled """
+    if not is_enabled():
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(section, time.perf_counter() - started)
+
+
+class CountingFile:
+    """ File object proxy recording reads as 'storage_read' section.
+        Files sent by `os.sendfile` of the server are not read through it, so they are not counted. """
+
+    def __init__(self, file):
+        self._file = file
+
+    def read(self, *args):
+        started = time.perf_counter()
+        data = self._file.read(*args)
+        record('storage_read', time.perf_counter() - started, len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+
+def count_reads(file):
+    """ Makes reads of opened storage file recorded, if profiling is enabled """
+    if is_enabled() and file.file is not None:
+        file.file = CountingFile(file.file)
+    return file
+
+
+def get_content_size(content) -> Optional[int]:
+    try:
+        return content.size
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _execute_wrapper(execute, sql, params, many, context):
+    if not is_enabled():
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        record('sql', time.perf_counter() - started)
+
+
+def install_sql_wrapper(connection) -> None:
+    if _execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_execute_wrapper)
+
+
+@receiver(connection_created)
+def connection_opened(connection, **kwargs):
+    # connections of other threads (e.g. async views or rendering workers) are profiled too
+    if is_enabled():
+        install_sql_wrapper(connection)
+
+
+class ProfilingMiddleware:
+    """ Collects timings of every request (if PROFILING is enabled) into process counters
+        and, with PROFILING_SERVER_TIMING, into Server-Timing header of its response.
+        Under ASGI it stays asynchronous, so requests are not serialized in the thread of sync middleware. """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self._async = asyncio.iscoroutinefunction(get_response)
+        if self._async:
+            # makes handler see the middleware as a coroutine function, like django.utils.deprecation.MiddlewareMixin
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self._async:
+            return self.__acall__(request)
+        if not is_enabled():
+            return self.get_response(request)
+        profile, token, started = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_profile.reset(token)
+        return self.finish(request, response, profile, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        if not is_enabled():
+            return await self.get_response(request)
+        profile, token, started = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_profile.reset(token)
+        return self.finish(request, response, profile, time.perf_counter() - started)
+
+    @staticmethod
+    def start():
+        for connection in connections.all():
+            install_sql_wrapper(connection)
+        profile = RequestProfile()
+        return profile, _current_profile.set(profile), time.perf_counter()
+
+    @staticmethod
+    def finish(request, response, profile: RequestProfile, total: float):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'
+        metrics.add('requests_total', 1, 'Number of handled requests', view=view, status=str(response.status_code))
+        metrics.add('request_seconds_total', total, 'Seconds spent handling requests', view=view)
+        for section, (calls, seconds) in profile.sections.items():
+            metrics.add('request_section_seconds_total', seconds, 'Seconds of profiled sections by view',
+                        view=view, section=section)
+        if settings.PROFILING_SERVER_TIMING:
+            response['Server-Timing'] = profile.get_server_timing(total)
+        return response
@@ -0,0 +1,122 @@
+""" Rendering of all thumbnail sizes of an image in one pass.
+    Original is decoded only once (JPEG in reduced resolution if thumbnails are much smaller),
+    the biggest thumbnail is scaled from it and every next one from the previous, smaller result. """
+import os
+from contextlib import contextmanager
+from typing import List, Sequence, Tuple
+
+from django.core.files.base import ContentFile
+from easy_thumbnails import engine, processors, utils
+from easy_thumbnails.files import Thumbnailer, ThumbnailFile
+from PIL import Image, ImageFile
+
+from image_browser import decoding, profiling
+from image_browser.encodings import OUTPUT_FORMATS
+
+# EXIF orientations which swap width and height of an image
+TRANSPOSING_ORIENTATIONS = (5, 6, 7, 8)
+EXIF_ORIENTATION_TAG = 0x0112
+
+
+def get_target_size(source_size: Tuple[int, int], size: Tuple[int, int]) -> Tuple[int, int]:
+    """ Returns size of thumbnail which easy_thumbnails renders from image of `source_size`
+        (without cropping and upscaling). Zero dimension is adjusted to keep proportions. """
+    source_x, source_y = source_size
+    target_x, target_y = size
+    if not target_x or not target_y:
+        scale = max(target_x / source_x, target_y / source_y)
+    else:
+        scale = min(target_x / source_x, target_y / source_y)
+    if scale >= 1:
+        return source_size
+    return max(round(source_x * scale), 1), max(round(source_y * scale), 1)
+
+
+def get_oriented_size(image: Image.Image) -> Tuple[int, int]:
+    """ Returns size of opened (not necessarily decoded) image after applying its EXIF orientation """
+    width, height = image.size
+    if image.getexif().get(EXIF_ORIENTATION_TAG) in TRANSPOSING_ORIENTATIONS:
+        return height, width
+    return width, height
+
+
+@contextmanager
+def open_source_image(thumbnailer: Thumbnailer, sizes: Sequence[Tuple[int, int]]):
+    """ Decodes source image of thumbnailer, oriented according to its EXIF data.
+        JPEG is decoded with reduced DCT scale (1/2 to 1/8) if the biggest of `sizes` allows it.
+        Decoded size is checked and its memory is reserved (see image_browser.decoding) until the block ends.
+        :return (as context value) decoded image and full size of the original
+        :raises ImageTooLarge if decoded image would have more pixels than IMAGE_MAX_PIXELS """
+    thumbnailer.open()
+    try:
+        image = decoding.open_image(thumbnailer)
+        original_size = get_oriented_size(image)
+        transposed = original_size != image.size
+        if image.format == 'JPEG' and sizes:
+            targets = [get_target_size(original_size, size) for size in sizes]
+            needed = (max(x for x, _ in targets), max(y for _, y in targets))
+            # draft keeps image at least as big as requested, so thumbnails are not upscaled
+            image.draft(image.mode, needed[::-1] if transposed else needed)
+        with decoding.decoding_memory(image):
+            try:
+                ImageFile.LOAD_TRUNCATED_IMAGES = True
+                with profiling.timed('thumbnail_decode'):
+                    image.load()
+            finally:
+                ImageFile.LOAD_TRUNCATED_IMAGES = False
+            yield utils.exif_orientation(image), original_size
+    finally:
+        thumbnailer.close()
+
+
+def generate_thumbnail_images(thumbnailer: Thumbnailer, options_list: Sequence[dict]) -> List[Image.Image]:
+    """ Generates thumbnail images for every options (as returned by `Thumbnailer.get_options`).
+        Source is decoded once and scaled from the biggest thumbnail to the smallest, each one from the previous.
+        Sizes are counted from the full size original, so they are the same as when rendered separately.
+        :return images in order of given options """
+    if not options_list:
+        return []
+    with open_source_image(thumbnailer, [options['size'] for options in options_list]) as (source, original_size):
+        targets = [get_target_size(original_size, options['size']) for options in options_list]
+        # mode is converted once, so every scaling works on RGB(A) instead of palette
+        current = processors.colorspace(source, **options_list[0])
+        images = [None] * len(options_list)
+        for i in sorted(range(len(options_list)), key=lambda i: targets[i], reverse=True):
+            with profiling.timed('thumbnail_resize'):
+                if current.size != targets[i]:
+                    current = current.resize(targets[i], resample=Image.LANCZOS)
+                # image already has thumbnail size, so processors do not scale it again
+                images[i] = engine.process_image(current, options_list[i], thumbnailer.thumbnail_processors)
+    return images
+
+
+def get_thumbnail_name(thumbnailer: Thumbnailer, options: dict, transparent: bool = False) -> str:
+    """ Returns name of thumbnail the way easy_thumbnails names it.
+        Thumbnail with output format in options gets extension of the format, whether it is transparent or not. """
+    name = thumbnailer.get_thumbnail_name(options, transparent=transparent)
+    if options.get('format'):
+        name = '%s.%s' % (os.path.splitext(name)[0], OUTPUT_FORMATS[options['format']].extension)
+    return name
+
+
+def encode_thumbnail(thumbnailer: Thumbnailer, options: dict, thumbnail_image: Image.Image) -> ThumbnailFile:
+    """ Encodes thumbnail image into unsaved file named the way easy_thumbnails names it """
+    filename = get_thumbnail_name(thumbnailer, options, transparent=utils.is_transparent(thumbnail_image))
+    save_options = {'quality': options['quality'], 'subsampling': options['subsampling']}
+    if options.get('format') == 'jpeg':
+        # progressive JPEG is smaller and shows early, even for small thumbnails
+        save_options['progressive'] = True
+    with profiling.timed('thumbnail_encode'):
+        data = engine.save_image(thumbnail_image, filename=filename, **save_options).read()
+    thumbnail = ThumbnailFile(filename, file=ContentFile(data), storage=thumbnailer.thumbnail_storage,
+                              thumbnail_options=options)
+    thumbnail.image = thumbnail_image
+    thumbnail._committed = False
+    return thumbnail
+
+
+def generate_thumbnails(thumbnailer: Thumbnailer, options_list: Sequence[dict]) -> List[ThumbnailFile]:
+    """ Generates unsaved thumbnail files for every options, decoding the source only once """
+    options_list = [thumbnailer.get_options(options) for options in options_list]
+    images = generate_thumbnail_images(thumbnailer, options_list)
+    return [encode_thumbnail(thumbnailer, options, image) for options, image in zip(options_list, images)]
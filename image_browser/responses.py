@@ -0,0 +1,193 @@
+import mimetypes
+import re
+from datetime import datetime
+from typing import AsyncIterator, Iterator, Optional, Tuple
+from urllib.parse import quote
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import Storage
+from django.db.models.fields.files import FieldFile
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.request import Request
+
+from image_browser.storage import is_local
+
+# size of chunks in which files are sent to the client
+CHUNK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# headers of internal redirects - front-end server sends the file in place of the response
+X_ACCEL_REDIRECT = 'x-accel-redirect'
+X_SENDFILE = 'x-sendfile'
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class AsyncStreamingHttpResponse(StreamingHttpResponse):
+    """ Streaming response with asynchronous content, sent by `image_browser.asgi.ASGIHandler`.
+        Sending it does not hold a thread, so a slow client costs only a coroutine. """
+    is_async = True
+
+    @property
+    def streaming_content(self):
+        return self._aiter_content()
+
+    @streaming_content.setter
+    def streaming_content(self, value):
+        self._iterator = value
+
+    async def _aiter_content(self):
+        async for chunk in self._iterator:
+            yield self.make_bytes(chunk)
+
+    def __iter__(self):
+        raise TypeError('Asynchronous response can be sent only by ASGI handler')
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """ Parses single byte range of Range header.
+        :return (first byte, last byte) or None if whole file should be sent
+        :raises RangeNotSatisfiable if range lies outside of the file """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match:
+        # multiple or malformed ranges are ignored, as allowed by RFC 7233
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # suffix range - last `end` bytes of the file
+        length = int(end)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def _read_range(file, length: int) -> Iterator[bytes]:
+    while length > 0:
+        chunk = file.read(min(CHUNK_SIZE, length))
+        if not chunk:
+            break
+        length -= len(chunk)
+        yield chunk
+
+
+async def _aread_range(file, length: int) -> AsyncIterator[bytes]:
+    # only reads of the file block, in threads of the executor
+    read = sync_to_async(file.read, thread_sensitive=False)
+    while length > 0:
+        chunk = await read(min(CHUNK_SIZE, length))
+        if not chunk:
+            break
+        length -= len(chunk)
+        yield chunk
+
+
+def get_content_etag(content_hash: Optional[str]) -> Optional[str]:
+    """ Returns ETag of file with given content hash (None if hash is not known) """
+    return f'"{content_hash}"' if content_hash else None
+
+
+def stream_file(request: Request, field_file: FieldFile, size: Optional[int] = None,
+                etag: Optional[str] = None, asynchronous: bool = False) -> HttpResponse:
+    """ Streams file of model field, see `stream_stored_file` """
+    return stream_stored_file(request, field_file.storage, field_file.name, size, etag, asynchronous=asynchronous)
+
+
+def get_internal_redirect(storage: Storage, name: str) -> Optional[Tuple[str, str]]:
+    """ Returns internal redirect header (name and value) which makes front-end server send stored file,
+        None if files are sent by Django (MEDIA_SENDFILE_BACKEND is not set or cannot serve the storage) """
+    backend = settings.MEDIA_SENDFILE_BACKEND
+    if not backend:
+        return None
+    if backend == X_ACCEL_REDIRECT:
+        # internal location of the prefix maps names to files (or proxies them from an object store)
+        return 'X-Accel-Redirect', settings.MEDIA_SENDFILE_PREFIX + quote(name)
+    if backend == X_SENDFILE:
+        # only local files have paths to send
+        return ('X-Sendfile', storage.path(name)) if is_local(storage) else None
+    raise ImproperlyConfigured(f'Unknown MEDIA_SENDFILE_BACKEND {backend}')
+
+
+def stream_stored_file(request: Request, storage: Storage, name: str, size: Optional[int] = None,
+                       etag: Optional[str] = None, last_modified: Optional[datetime] = None,
+                       asynchronous: bool = False) -> HttpResponse:
+    """ Streams stored file in chunks, without reading it into memory.
+        With MEDIA_SENDFILE_BACKEND Django only answers with internal redirect header
+        and the file (or its range) is sent by front-end server.
+        `asynchronous` content is read by async iterator, for views of ASGI deployment.
+        Single byte range requests are answered with partial content.
+        With validators (ETag or modification time) conditional requests are answered with 304 Not Modified.
+        File size is taken from the storage unless it is given. """
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    if etag or timestamp:
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is not None:
+            return _set_validators(response, etag, timestamp)
+
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    redirect = get_internal_redirect(storage, name)
+    if redirect is not None:
+        response = HttpResponse(content_type=content_type)
+        header, value = redirect
+        response[header] = value
+        return _set_validators(response, etag, timestamp)
+
+    if size is None:
+        size = storage.size(name)
+    try:
+        byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+    except RangeNotSatisfiable:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag:
+        # file changed since client got its part (or If-Range holds a date) - whole file is sent
+        byte_range = None
+
+    file = storage.open(name, 'rb')
+    if asynchronous:
+        start, end = byte_range or (0, size - 1)
+        file.seek(start)
+        response = AsyncStreamingHttpResponse(_aread_range(file, end - start + 1), status=206 if byte_range else 200,
+                                              content_type=content_type)
+        response._resource_closers.append(file.close)
+        if byte_range:
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(end - start + 1)
+    elif byte_range is None:
+        # WSGI server sends file response with os.sendfile, if the file has a descriptor
+        response = FileResponse(file, content_type=content_type)
+        response.block_size = CHUNK_SIZE
+        response['Content-Length'] = str(size)
+    else:
+        start, end = byte_range
+        file.seek(start)
+        response = StreamingHttpResponse(_read_range(file, end - start + 1), status=206,
+                                         content_type=content_type)
+        response._resource_closers.append(file.close)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(end - start + 1)
+    response['Accept-Ranges'] = 'bytes'
+    return _set_validators(response, etag, timestamp)
+
+
+def _set_validators(response: HttpResponse, etag: Optional[str], timestamp: Optional[int]) -> HttpResponse:
+    if etag:
+        response['ETag'] = etag
+    if timestamp:
+        response['Last-Modified'] = http_date(timestamp)
+    return response
@@ -1,13 +1,56 @@
+from typing import List, Optional
+
+from django.conf import settings
+from django.db import models
 from django.urls import reverse
 from rest_framework import serializers
 
-from image_browser.models import ImageInstance, TempUrl, PlanTier
+from image_browser import profiling
+from image_browser.decoding import ImageTooLarge
+from image_browser.encodings import ThumbnailEncoding, choose_encoding, get_plan_encodings
+from image_browser.locks import LockTimeout
+from image_browser.models import ImageInstance, TempUrl, PlanTier, ThumbnailJob, UploadSession
+from image_browser.thumbnails import DEFAULT_ENCODINGS, get_format_code, get_thumbnail_names, \
+    get_thumbnail_statuses, render_thumbnails_once
 from image_browser.utils import get_plan_by_user, create_expiring_link
 
 
+class ArbitraryPlanListSerializer(serializers.ListSerializer):
+    """ List serializer which resolves user plan and thumbnails once for all listed images. """
+
+    def to_representation(self, data):
+        images = list(data.all() if isinstance(data, models.Manager) else data)
+        self.child.prepare(images)
+        return super().to_representation(images)
+
+
 class ArbitraryPlanSerializer(serializers.HyperlinkedModelSerializer):
     """ Serializer for any type of plan created by admin on admin site. """
 
+    _prepared = False
+
+    def prepare(self, images: List[ImageInstance]) -> None:
+        """ Resolves user plan and already rendered thumbnails of all given images at once,
+            so representation of single image does not have to query for them. """
+        request = self.context.get('request')
+        self._plan: Optional[PlanTier] = get_plan_by_user(request.user)
+        self._thumb_sizes = list(self._plan.thumbnail_sizes.all()) if self._plan else []
+        # thumbnails are rendered in all plan formats, URL field shows the one negotiated by Accept header
+        self._encodings = get_plan_encodings(self._plan)
+        self._encoding = choose_encoding(self._encodings, request.META.get('HTTP_ACCEPT'))
+        self._thumbnail_names = {}
+        self._thumbnail_statuses = {}
+        # ids of images which thumbnails are rendered by another request for too long (or cannot be rendered)
+        self._pending_images = set()
+        if self._thumb_sizes:
+            if settings.THUMBNAIL_BACKGROUND_RENDERING:
+                self._thumbnail_statuses = get_thumbnail_statuses(images)
+            else:
+                # URLs of thumbnails listed in image manifests are built without any query
+                self._thumbnail_names = get_thumbnail_names(images, self._thumb_sizes,
+                                                            self._encodings or DEFAULT_ENCODINGS)
+        self._prepared = True
+
     def get_create_expiring_link(self, image_instance: ImageInstance) -> str:
         """ Method for dispatching 'create_expiring_link' serializer field.
             It keeps link for expiring link creation. """
@@ -15,38 +58,89 @@ class ArbitraryPlanSerializer(serializers.HyperlinkedModelSerializer):
         return create_expiring_link(image_instance, request)
 
     def get_image_url(self, image_instance: ImageInstance) -> str:
-        """ Method to get original image absolute URL """
+        """ Method to get original image absolute URL.
+            With MEDIA_SENDFILE_BACKEND originals are not public - URL points to view checking access. """
         request = self.context.get('request')
-        image_url = image_instance.image_file.url
+        if settings.MEDIA_SENDFILE_BACKEND:
+            image_url = reverse('original', kwargs={'pk': image_instance.id})
+        else:
+            image_url = image_instance.image_file.url
         return request.build_absolute_uri(image_url)
 
-    def get_arbitrary_url_field(self, image_instance: ImageInstance, height: int, width: int) -> str:
-        """ Method to get absolute  URL of thumbnail with size given in arguments """
+    def render_missing_thumbnails(self, image_instance: ImageInstance) -> None:
+        """ Renders all plan thumbnails of an image which are not rendered yet at once,
+            so the original is decoded only one time - and only by one of concurrent requests.
+            If another request renders them for too long, the image gets URLs of pending thumbnails,
+            like an original which is too large to be decoded (its background job fails). """
+        encodings = self._encodings or DEFAULT_ENCODINGS
+        missing = [size for size in self._thumb_sizes
+                   if any((image_instance.id, size.width, size.height, get_format_code(encoding))
+                          not in self._thumbnail_names for encoding in encodings)]
+        try:
+            names = render_thumbnails_once(image_instance, missing, encodings,
+                                           timeout=settings.THUMBNAIL_RENDER_WAIT)
+        except (LockTimeout, ImageTooLarge):
+            self._pending_images.add(image_instance.id)
+            return
+        for (width, height, code), name in names.items():
+            self._thumbnail_names[(image_instance.id, width, height, code)] = name
+
+    def get_arbitrary_url_field(self, image_instance: ImageInstance, height: int, width: int,
+                                encoding: Optional[ThumbnailEncoding] = None) -> str:
+        """ Method to get absolute  URL of thumbnail with size (and output format) given in arguments.
+            With background rendering URL points to view which redirects to thumbnail when it is ready. """
         request = self.context.get('request')
-        image_url = image_instance.get_thumbnail_url(width, height)
+        key = (image_instance.id, width, height, get_format_code(encoding))
+        if not settings.THUMBNAIL_BACKGROUND_RENDERING and key not in self._thumbnail_names \
+                and image_instance.id not in self._pending_images:
+            self.render_missing_thumbnails(image_instance)
+        if key in self._thumbnail_names:
+            # thumbnail is already rendered, its URL does not need any lookup
+            image_url = image_instance.image_file.thumbnail_storage.url(self._thumbnail_names[key])
+        else:
+            # view redirecting to thumbnail when it is ready (rendered in background or by another request)
+            image_url = reverse('thumbnail', kwargs={'pk': image_instance.id, 'width': width, 'height': height})
+            if encoding is not None:
+                image_url += f'?output={encoding.format}'
         return request.build_absolute_uri(image_url)
 
+    def get_thumbnails_status(self, image_instance: ImageInstance) -> dict:
+        """ Method to get rendering status of every thumbnail size in the plan """
+        return {str(size): self._thumbnail_statuses.get((image_instance.id, size.width, size.height),
+                                                        ThumbnailJob.PENDING)
+                for size in self._thumb_sizes}
+
     class Meta:
         model = ImageInstance
         fields = ('name',)
+        list_serializer_class = ArbitraryPlanListSerializer
 
+    @profiling.timed('serialize')
     def to_representation(self, instance: ImageInstance):
         """ Overriding method to create representation based on user plan.
             Plan is taken based on user creating a request.
             In this method fields for representation are added if they should be
             based on thumbnail sizes in the plan."""
         data = super().to_representation(instance)
-        user = self.context.get('request').user
-        plan: PlanTier = get_plan_by_user(user)
+        if not self._prepared:
+            self.prepare([instance])
+        plan = self._plan
         if plan:
             if plan.create_expiring_link:
                 data['create_expiring_link'] = self.get_create_expiring_link(instance)
             if plan.show_original_link:
                 data['image_url'] = self.get_image_url(instance)
-            thumb_sizes = plan.thumbnail_sizes.all()
-            for thumbnail_size in thumb_sizes:
+            for thumbnail_size in self._thumb_sizes:
                 data[f'thumbnail_{thumbnail_size}_url'] = self.get_arbitrary_url_field(instance, thumbnail_size.height,
-                                                                                       thumbnail_size.width)
+                                                                                       thumbnail_size.width,
+                                                                                       self._encoding)
+                if self._encodings:
+                    data[f'thumbnail_{thumbnail_size}_variants'] = {
+                        encoding.format: self.get_arbitrary_url_field(instance, thumbnail_size.height,
+                                                                      thumbnail_size.width, encoding)
+                        for encoding in self._encodings}
+            if settings.THUMBNAIL_BACKGROUND_RENDERING and self._thumb_sizes:
+                data['thumbnails_status'] = self.get_thumbnails_status(instance)
         return data
 
 
@@ -58,6 +152,31 @@ class PostImageInstanceSerializer(serializers.ModelSerializer):
         fields = ('image_file', 'name')
 
 
+class UploadSessionSerializer(serializers.ModelSerializer):
+    """ Serializer of resumable upload session. """
+    upload_url = serializers.SerializerMethodField()
+    finalize_url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'name', 'filename', 'size', 'received', 'upload_url', 'finalize_url']
+        read_only_fields = ['id', 'received']
+
+    def validate_size(self, size: int) -> int:
+        if not 0 < size <= settings.UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError(f'Size must be value between 1 and {settings.UPLOAD_MAX_SIZE}.')
+        return size
+
+    def get_upload_url(self, session: UploadSession) -> str:
+        """ URL to which ranges of the file are sent with PUT """
+        request = self.context.get('request')
+        return request.build_absolute_uri(reverse('upload_session', kwargs={'pk': session.id}))
+
+    def get_finalize_url(self, session: UploadSession) -> str:
+        request = self.context.get('request')
+        return request.build_absolute_uri(reverse('finalize_upload', kwargs={'pk': session.id}))
+
+
 class TempLinkSerializer(serializers.HyperlinkedModelSerializer):
     """ Serializer for expiring link creation. """
 
@@ -84,8 +203,11 @@ class ShowTempLinkSerializer(serializers.HyperlinkedModelSerializer):
         fields = ['url_hash', 'expiration_date', 'expiring_link_url']
 
     def get_expiring_link_url(self, temp_url: TempUrl) -> str:
-        """ Creates expiring link based on hash"""
+        """ Creates expiring link based on hash (or token of signed link)"""
         request = self.context.get('request')
         image_url = temp_url.url_hash
-        uri = reverse('temp_link', kwargs={'hash': image_url})
+        if settings.EXPIRING_LINK_MODE == 'signed':
+            uri = reverse('signed_temp_link', kwargs={'token': image_url})
+        else:
+            uri = reverse('temp_link', kwargs={'hash': image_url})
         return f'http://{request.get_host()}{uri}'
@@ -0,0 +1,36 @@
+""" Receivers invalidating cached plans when plans, their thumbnail sizes or user plans change
+    and library versions of users when their images change.
+    Deleted image also drops its reference of shared original. """
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from image_browser.models import AppUser, ImageBlob, ImageInstance, PlanTier, ThumbnailSize, User
+from image_browser.plans import invalidate_plans
+
+
+@receiver(post_save, sender=PlanTier)
+@receiver(post_delete, sender=PlanTier)
+@receiver(post_save, sender=AppUser)
+@receiver(post_delete, sender=AppUser)
+@receiver(post_save, sender=ThumbnailSize)
+@receiver(post_delete, sender=ThumbnailSize)
+def plan_changed(sender, **kwargs):
+    invalidate_plans()
+
+
+@receiver(m2m_changed, sender=PlanTier.thumbnail_sizes.through)
+def plan_sizes_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_plans()
+
+
+@receiver(post_save, sender=ImageInstance)
+@receiver(post_delete, sender=ImageInstance)
+def image_changed(sender, instance, **kwargs):
+    User.bump_library_version(instance.owner_id)
+
+
+@receiver(post_delete, sender=ImageInstance)
+def image_deleted(sender, instance, **kwargs):
+    if instance.blob_id:
+        ImageBlob.release(instance.blob_id)
@@ -0,0 +1,111 @@
+""" Near-duplicate search by perceptual hashes.
+    64 bit difference hash (dHash) of every image is stored as four 16 bit chunks in indexed columns.
+    Hashes within distance d have at least one chunk within distance d // 4 (pigeonhole principle),
+    so candidates are found by index lookups of chunk values around the chunks of searched hash
+    (multi-index hashing) and only they are compared by full Hamming distance. """
+from itertools import combinations
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from django.db.models import Q
+from easy_thumbnails.files import get_thumbnailer
+from PIL import Image
+
+from image_browser.models import PERCEPTUAL_HASH_FIELDS, ImageInstance
+from image_browser.rendering import open_source_image
+
+HASH_WIDTH, HASH_HEIGHT = 9, 8
+CHUNK_BITS = 16
+
+# perceptual hash as values of PERCEPTUAL_HASH_FIELDS
+PerceptualHash = Tuple[int, ...]
+
+
+def compute_perceptual_hash(image: Image.Image) -> PerceptualHash:
+    """ Returns dHash of an image - every bit tells if a pixel of 9x8 grayscale version is brighter than its left
+        neighbour. Hash does not change with scaling, recompression or small color changes of the image. """
+    gray = image.convert('L').resize((HASH_WIDTH, HASH_HEIGHT), resample=Image.BOX)
+    pixels = np.asarray(gray, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return tuple(int(chunk) for chunk in np.packbits(bits).view('>u2'))
+
+
+def compute_image_perceptual_hash(image: ImageInstance) -> PerceptualHash:
+    """ Returns dHash of original of the image, JPEG is decoded in the smallest possible resolution """
+    with open_source_image(get_thumbnailer(image.image_file), [(HASH_WIDTH, HASH_HEIGHT)]) as (source, _):
+        return compute_perceptual_hash(source)
+
+
+def store_perceptual_hash(image: ImageInstance, perceptual_hash: PerceptualHash) -> None:
+    """ Saves hash of the image, also for other images with the same content which do not have it yet """
+    values = dict(zip(PERCEPTUAL_HASH_FIELDS, perceptual_hash))
+    images = ImageInstance.objects.filter(pk=image.pk)
+    if image.content_hash:
+        images = images | ImageInstance.objects.filter(content_hash=image.content_hash, phash_0__isnull=True)
+    images.update(**values)
+    for field, value in values.items():
+        setattr(image, field, value)
+
+
+def store_thumbnail_perceptual_hash(image: ImageInstance, thumbnails: Sequence[Image.Image]) -> None:
+    """ Computes hash of the image from the smallest of just rendered thumbnails which is bigger than the hash """
+    if image.phash_0 is not None or not thumbnails:
+        return
+    big_enough = [thumbnail for thumbnail in thumbnails
+                  if thumbnail.width >= HASH_WIDTH and thumbnail.height >= HASH_HEIGHT]
+    if big_enough:
+        thumbnail = min(big_enough, key=lambda thumbnail: thumbnail.width * thumbnail.height)
+    else:
+        thumbnail = max(thumbnails, key=lambda thumbnail: thumbnail.width * thumbnail.height)
+    store_perceptual_hash(image, compute_perceptual_hash(thumbnail))
+
+
+def get_perceptual_hash(image: ImageInstance) -> Optional[PerceptualHash]:
+    values = tuple(getattr(image, field) for field in PERCEPTUAL_HASH_FIELDS)
+    return None if None in values else values
+
+
+def get_chunk_neighbours(chunk: int, radius: int) -> List[int]:
+    """ Returns all chunk values within Hamming distance `radius` of given chunk """
+    neighbours = [chunk]
+    for distance in range(1, radius + 1):
+        for bits in combinations(range(CHUNK_BITS), distance):
+            value = chunk
+            for bit in bits:
+                value ^= 1 << bit
+            neighbours.append(value)
+    return neighbours
+
+
+def get_hamming_distances(perceptual_hash: PerceptualHash, candidates: np.ndarray) -> np.ndarray:
+    """ Returns Hamming distances between hash and every row of (n, 4) array of candidate hash chunks """
+    differences = np.bitwise_xor(candidates.astype('>u2'), np.array(perceptual_hash, dtype='>u2'))
+    return np.unpackbits(differences.view(np.uint8), axis=1).sum(axis=1)
+
+
+def find_similar_images(image: ImageInstance, distance: int, limit: int) -> List[Tuple[ImageInstance, int]]:
+    """ Finds images of the same owner with perceptual hash within given Hamming distance of the image hash.
+        :return up to `limit` images with their distances, the most similar first """
+    perceptual_hash = get_perceptual_hash(image)
+    if perceptual_hash is None:
+        perceptual_hash = compute_image_perceptual_hash(image)
+        store_perceptual_hash(image, perceptual_hash)
+
+    radius = distance // len(PERCEPTUAL_HASH_FIELDS)
+    lookup = Q()
+    for field, chunk in zip(PERCEPTUAL_HASH_FIELDS, perceptual_hash):
+        lookup |= Q(**{f'{field}__in': get_chunk_neighbours(chunk, radius)})
+    candidates = list(ImageInstance.objects.filter(lookup, owner_id=image.owner_id)
+                      .exclude(pk=image.pk)
+                      .order_by('id')
+                      .values_list('id', *PERCEPTUAL_HASH_FIELDS))
+    if not candidates:
+        return []
+
+    rows = np.array(candidates, dtype=np.int64)
+    distances = get_hamming_distances(perceptual_hash, rows[:, 1:])
+    matching = np.flatnonzero(distances <= distance)
+    # stable sort keeps older images first among equally similar ones
+    matching = matching[np.argsort(distances[matching], kind='stable')][:limit]
+    images = ImageInstance.objects.in_bulk([int(rows[i, 0]) for i in matching])
+    return [(images[int(rows[i, 0])], int(distances[i])) for i in matching]
@@ -0,0 +1,181 @@
+""" Storage layer of originals and thumbnails.
+    Files are kept in the storage configured by IMAGE_STORAGE (local filesystem by default),
+    under names laid out by IMAGE_PATH_LAYOUT. """
+import hashlib
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+from urllib.parse import quote, unquote, urljoin
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.storage import Storage
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.deconstruct import deconstructible
+from django.utils.functional import LazyObject, empty
+from django.utils.module_loading import import_string
+from easy_thumbnails.utils import get_storage_hash as get_thumbnail_storage_hash
+
+from image_browser import profiling
+
+# all files of a user in one directory
+FLAT_LAYOUT = 'flat'
+# files of a user spread over 65536 directories by hash of their names, so no directory grows big
+SHARDED_LAYOUT = 'sharded'
+
+
+def get_image_path(username: str, filename: str) -> str:
+    """ Returns storage name of original uploaded by user, according to IMAGE_PATH_LAYOUT """
+    directory = f'user_{username}'
+    if settings.IMAGE_PATH_LAYOUT == SHARDED_LAYOUT:
+        shard = hashlib.md5(f'{username}/{filename}'.encode('utf-8')).hexdigest()
+        directory = f'{directory}/{shard[:2]}/{shard[2:4]}'
+    elif settings.IMAGE_PATH_LAYOUT != FLAT_LAYOUT:
+        raise ImproperlyConfigured(f'Unknown IMAGE_PATH_LAYOUT {settings.IMAGE_PATH_LAYOUT}')
+    return f'{directory}/{filename}'
+
+
+class ImageStorage(LazyObject):
+    """ Storage of originals and thumbnails - instance of IMAGE_STORAGE class created with IMAGE_STORAGE_OPTIONS.
+        Model fields keep the proxy, so the storage can be replaced when settings change. """
+
+    def _setup(self):
+        self._wrapped = import_string(settings.IMAGE_STORAGE)(**settings.IMAGE_STORAGE_OPTIONS)
+
+    # reads and writes of files are profiled here, wrapping the storage would change its easy_thumbnails hash
+    def open(self, name, mode='rb'):
+        with profiling.timed('storage_open'):
+            file = LazyObject.__getattr__(self, 'open')(name, mode)
+        return profiling.count_reads(file)
+
+    def save(self, name, content, max_length=None):
+        if not profiling.is_enabled():
+            return LazyObject.__getattr__(self, 'save')(name, content, max_length=max_length)
+        started = time.perf_counter()
+        name = LazyObject.__getattr__(self, 'save')(name, content, max_length=max_length)
+        profiling.record('storage_write', time.perf_counter() - started, profiling.get_content_size(content))
+        return name
+
+
+image_storage = ImageStorage()
+
+
+def get_image_storage() -> ImageStorage:
+    """ Returns storage of originals and thumbnails.
+        It is set up right away - easy_thumbnails identifies lazy storage by its class only after that. """
+    if image_storage._wrapped is empty:
+        image_storage._setup()
+    return image_storage
+
+
+@receiver(setting_changed)
+def image_storage_changed(setting, **kwargs):
+    if setting in ('IMAGE_STORAGE', 'IMAGE_STORAGE_OPTIONS'):
+        image_storage._setup()
+
+
+def get_storage_hash(storage) -> str:
+    """ Returns hash identifying storage in easy_thumbnails cache tables """
+    # easy_thumbnails hashes lazy storage correctly only after it has been set up
+    if isinstance(storage, LazyObject) and storage._wrapped is empty:
+        storage._setup()
+    return get_thumbnail_storage_hash(storage)
+
+
+def is_local(storage) -> bool:
+    """ Tells if files of the storage have local paths """
+    try:
+        storage.path('')
+    except NotImplementedError:
+        return False
+    return True
+
+
+def get_file_stat(storage, name: str) -> Optional[Tuple[int, datetime]]:
+    """ Returns size and modification time of stored file, None if there is no such file """
+    if is_local(storage):
+        path = storage.path(name)
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        return stat.st_size, datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)
+    if not storage.exists(name):
+        return None
+    return storage.size(name), storage.get_modified_time(name)
+
+
+@deconstructible
+class LocalObjectStorage(Storage):
+    """ Object store stand-in keeping objects as files in one local directory (bucket).
+        Like remote object stores it has flat keys (slashes are just part of names), atomic writes
+        and no local paths, so code working with it works with remote storages too - and can be tested offline. """
+
+    def __init__(self, location: Optional[str] = None, base_url: Optional[str] = None):
+        self._location = location
+        self._base_url = base_url
+
+    @property
+    def location(self) -> str:
+        return os.path.abspath(self._location or os.path.join(settings.MEDIA_ROOT, 'objects'))
+
+    @property
+    def base_url(self) -> str:
+        return self._base_url or settings.MEDIA_URL
+
+    def _object_path(self, name: str) -> str:
+        return os.path.join(self.location, quote(name, safe=''))
+
+    def _open(self, name, mode='rb'):
+        return File(open(self._object_path(name), mode))
+
+    def _save(self, name, content):
+        os.makedirs(self.location, exist_ok=True)
+        # object appears at once, readers never see it partially written
+        descriptor, temporary_path = tempfile.mkstemp(dir=self.location, prefix='.upload-')
+        try:
+            with os.fdopen(descriptor, 'wb') as temporary:
+                for chunk in content.chunks():
+                    temporary.write(chunk)
+            os.replace(temporary_path, self._object_path(name))
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        return name
+
+    def delete(self, name):
+        try:
+            os.remove(self._object_path(name))
+        except FileNotFoundError:
+            pass
+
+    def exists(self, name):
+        return os.path.isfile(self._object_path(name))
+
+    def listdir(self, path):
+        prefix = path.rstrip('/') + '/' if path else ''
+        directories, files = set(), []
+        if os.path.isdir(self.location):
+            for key in os.listdir(self.location):
+                name = unquote(key)
+                if key.startswith('.') or not name.startswith(prefix):
+                    continue
+                rest = name[len(prefix):]
+                if '/' in rest:
+                    directories.add(rest.split('/', 1)[0])
+                else:
+                    files.append(rest)
+        return sorted(directories), sorted(files)
+
+    def size(self, name):
+        return os.path.getsize(self._object_path(name))
+
+    def url(self, name):
+        return urljoin(self.base_url, quote(name))
+
+    def get_modified_time(self, name):
+        return datetime.fromtimestamp(os.path.getmtime(self._object_path(name)), tz=timezone.utc)
@@ -1,17 +1,62 @@
+import asyncio
+import base64
+import errno
+import hashlib
+import json
+import os
+import re
 import shutil
+import struct
+import threading
+import zipfile
+import zlib
 import time
-from datetime import datetime
-from unittest import skip
-
-from django.test import TestCase, override_settings
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from io import BytesIO
+from unittest import mock, skip
+
+import numpy as np
+from asgiref.sync import async_to_sync
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import Http404, HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
+from easy_thumbnails.files import get_thumbnailer
+from PIL import Image
 from rest_framework.response import Response
 from rest_framework.test import APIClient
 
-from image_browser.models import PlanTier, ThumbnailSize, User, AppUser, ImageInstance
+from image_browser.benchmarks import compare_reports, run_benchmark
+from image_browser.decoding import ImageTooLarge, MemoryBudget
+from image_browser.dynamic_rendering import RenderCache, get_rendered_file
+from image_browser.encodings import ThumbnailEncoding, choose_encoding, get_plan_encodings
+from image_browser.links import sign_image_link, delete_expired_links
+from image_browser.locks import key_lock
+from image_browser.models import PlanTier, ThumbnailSize, User, AppUser, ImageInstance, ThumbnailJob, TempUrl, \
+    UploadSession, ImageBlob
+from image_browser.rendering import generate_thumbnails, get_target_size, open_source_image
+from image_browser.similarity import compute_perceptual_hash, get_chunk_neighbours, get_hamming_distances
+from image_browser.thumbnails import render_pending_jobs, get_missing_thumbnails, enqueue_missing_thumbnails, \
+    enqueue_thumbnails, render_thumbnails
+from image_browser.uploads import get_part_path, get_upload_dir
+from image_browser import batch_upload, plans, profiling, views
+from image_browser.asgi import ASGIHandler
+from image_browser.caching import MEDIA_CACHE_CONTROL, THUMBNAIL_CACHE_CONTROL
+from image_browser.utils import get_plan_images, get_plan_by_user
+from image_browser.views import media
+from image_browser_app import urls
 
 TEST_DIR = 'test_data'
 
+# URLs of ASGI deployment with async views (ASYNC_VIEWS), used by AsyncViews tests
+urlpatterns = urls.async_urlpatterns + urls.urlpatterns
+
 username = 'test'
 password = 'Krowadzika'
 
@@ -114,14 +159,15 @@ class CanSeeOriginalLink(TestCase):
         upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
         upload_image_request('staticfiles/rabbit.png', 'rabbit', self.client)
         response = self.client.get('/images/')
+        results = response.data['results']
         self.assertEquals(response.status_code, 200)
-        self.assertEquals(response.data[0]['name'], 'macara')
-        self.assertIn('/media/user_test/macara.jpg', response.data[0]['image_url'])
+        self.assertEquals(results[0]['name'], 'macara')
+        self.assertIn('/media/user_test/macara.jpg', results[0]['image_url'])
 
-        self.assertEquals(response.data[1]['name'], 'rabbit')
-        self.assertIn('/media/user_test/rabbit.png', response.data[1]['image_url'])
-        self.assertEquals(len(response.data), 2)
-        self.assertEquals(len(response.data[0]), 2)
+        self.assertEquals(results[1]['name'], 'rabbit')
+        self.assertIn('/media/user_test/rabbit.png', results[1]['image_url'])
+        self.assertEquals(len(results), 2)
+        self.assertEquals(len(results[0]), 2)
 
 
 class CanSeeGivenOneThumbnail(TestCase):
@@ -155,14 +201,15 @@ class CanSeeGivenOneThumbnail(TestCase):
         upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
         upload_image_request('staticfiles/rabbit.png', 'rabbit', self.client)
         response = self.client.get('/images/')
+        results = response.data['results']
         self.assertEquals(response.status_code, 200)
-        self.assertEquals(response.data[0]['name'], 'macara')
-        self.assertIn('/media/user_test/macara.jpg.50x0_q85.jpg', response.data[0]['thumbnail_0x50_url'])
+        self.assertEquals(results[0]['name'], 'macara')
+        self.assertIn('/media/user_test/macara.jpg.50x0_q85.jpg', results[0]['thumbnail_0x50_url'])
 
-        self.assertEquals(response.data[1]['name'], 'rabbit')
-        self.assertIn('/media/user_test/rabbit.png.50x0_q85.jpg', response.data[1]['thumbnail_0x50_url'])
-        self.assertEquals(len(response.data), 2)
-        self.assertEquals(len(response.data[0]), 2)
+        self.assertEquals(results[1]['name'], 'rabbit')
+        self.assertIn('/media/user_test/rabbit.png.50x0_q85.jpg', results[1]['thumbnail_0x50_url'])
+        self.assertEquals(len(results), 2)
+        self.assertEquals(len(results[0]), 2)
 
 
 class CanSeeManyThumbnails(TestCase):
@@ -198,16 +245,17 @@ class CanSeeManyThumbnails(TestCase):
         upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
         upload_image_request('staticfiles/rabbit.png', 'rabbit', self.client)
         response = self.client.get('/images/')
+        results = response.data['results']
         self.assertEquals(response.status_code, 200)
-        self.assertEquals(response.data[0]['name'], 'macara')
-        self.assertIn('/media/user_test/macara.jpg.50x0_q85.jpg', response.data[0]['thumbnail_0x50_url'])
-        self.assertIn('/media/user_test/macara.jpg.50x100_q85.jpg', response.data[0]['thumbnail_100x50_url'])
+        self.assertEquals(results[0]['name'], 'macara')
+        self.assertIn('/media/user_test/macara.jpg.50x0_q85.jpg', results[0]['thumbnail_0x50_url'])
+        self.assertIn('/media/user_test/macara.jpg.50x100_q85.jpg', results[0]['thumbnail_100x50_url'])
 
-        self.assertEquals(response.data[1]['name'], 'rabbit')
-        self.assertIn('/media/user_test/rabbit.png.50x0_q85.jpg', response.data[1]['thumbnail_0x50_url'])
-        self.assertIn('/media/user_test/rabbit.png.50x100_q85.jpg', response.data[1]['thumbnail_100x50_url'])
-        self.assertEquals(len(response.data), 2)
-        self.assertEquals(len(response.data[0]), 3)
+        self.assertEquals(results[1]['name'], 'rabbit')
+        self.assertIn('/media/user_test/rabbit.png.50x0_q85.jpg', results[1]['thumbnail_0x50_url'])
+        self.assertIn('/media/user_test/rabbit.png.50x100_q85.jpg', results[1]['thumbnail_100x50_url'])
+        self.assertEquals(len(results), 2)
+        self.assertEquals(len(results[0]), 3)
 
 
 class CanCreateExpiringLink(TestCase):
@@ -239,14 +287,15 @@ class CanCreateExpiringLink(TestCase):
         upload_image_request('staticfiles/rabbit.png', 'rabbit', self.client)
         rabbit_id = ImageInstance.objects.get(name='rabbit').id
         response = self.client.get('/images/')
+        results = response.data['results']
         self.assertEquals(response.status_code, 200)
-        self.assertEquals(response.data[0]['name'], 'macara')
-        self.assertIn(f'/make_temp/{macara_id}', response.data[0]['create_expiring_link'])
+        self.assertEquals(results[0]['name'], 'macara')
+        self.assertIn(f'/make_temp/{macara_id}', results[0]['create_expiring_link'])
 
-        self.assertEquals(response.data[1]['name'], 'rabbit')
-        self.assertIn(f'/make_temp/{rabbit_id}', response.data[1]['create_expiring_link'])
-        self.assertEquals(len(response.data), 2)
-        self.assertEquals(len(response.data[0]), 2)
+        self.assertEquals(results[1]['name'], 'rabbit')
+        self.assertIn(f'/make_temp/{rabbit_id}', results[1]['create_expiring_link'])
+        self.assertEquals(len(results), 2)
+        self.assertEquals(len(results[0]), 2)
 
     @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
     def test_create_expiring_link(self):
@@ -330,6 +379,47 @@ class ExpiringLink(TestCase):
         response = self.client.get(self.link)
         self.assertEquals(response.status_code, 200)
 
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_link_streams_image_file(self):
+        response = self.client.get(self.link)
+        with open('staticfiles/macara.jpg', 'rb') as image:
+            content = image.read()
+        self.assertEquals(response['Content-Type'], 'image/jpeg')
+        self.assertEquals(int(response['Content-Length']), len(content))
+        self.assertEquals(b''.join(response.streaming_content), content)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_link_serves_byte_range(self):
+        with open('staticfiles/macara.jpg', 'rb') as image:
+            content = image.read()
+        response = self.client.get(self.link, HTTP_RANGE='bytes=10-19')
+        self.assertEquals(response.status_code, 206)
+        self.assertEquals(response['Content-Range'], f'bytes 10-19/{len(content)}')
+        self.assertEquals(b''.join(response.streaming_content), content[10:20])
+
+        response = self.client.get(self.link, HTTP_RANGE='bytes=-5')
+        self.assertEquals(b''.join(response.streaming_content), content[-5:])
+
+        response = self.client.get(self.link, HTTP_RANGE=f'bytes={len(content)}-')
+        self.assertEquals(response.status_code, 416)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_link_answers_not_modified(self):
+        response = self.client.get(self.link)
+        etag = '"%s"' % ImageInstance.objects.get(name='macara').content_hash
+        self.assertEquals(response['ETag'], etag)
+        self.assertTrue(response['Cache-Control'].startswith('private, max-age='))
+        response = self.client.get(self.link, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'), MEDIA_SENDFILE_BACKEND='x-accel-redirect')
+    def test_link_is_sent_by_front_end_server(self):
+        response = self.client.get(self.link)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['X-Accel-Redirect'], '/protected-media/user_test/macara.jpg')
+        self.assertEquals(response['Content-Type'], 'image/jpeg')
+        self.assertEquals(response.content, b'')
+
     @skip('This test takes 5 minutes and should be run when needed')
     @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
     def test_cannot_see_after_expiration(self):
@@ -340,3 +430,1521 @@ class ExpiringLink(TestCase):
         self.assertEquals(response.status_code, 404)
 
 
+class BackgroundThumbnailRendering(TestCase):
+    client = None
+
+    def setUp(self) -> None:
+        plan: PlanTier = PlanTier.objects.create(name='Thumbs', show_original_link=False,
+                                                 create_expiring_link=False)
+        ts = ThumbnailSize.objects.create(height=0, width=50)
+        plan.thumbnail_sizes.set([ts])
+
+        user = create_test_user_with_plan(plan)
+        self.client = APIClient()
+        self.client.force_authenticate(user=user)
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    @override_settings(THUMBNAIL_BACKGROUND_RENDERING=True)
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_upload_does_not_render_thumbnail(self):
+        response = upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        image_id = ImageInstance.objects.get(name='macara').id
+        self.assertEquals(response.status_code, 201)
+        self.assertIn(f'/{image_id}/thumbnails/0x50/', response.data['thumbnail_0x50_url'])
+        self.assertEquals(response.data['thumbnails_status'], {'0x50': 'pending'})
+        self.assertEquals(ThumbnailJob.objects.get(image_id=image_id).status, ThumbnailJob.PENDING)
+
+        response = self.client.get(f'/{image_id}/thumbnails/0x50/')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Type'], 'image/gif')
+        self.assertEquals(response['X-Thumbnail-Status'], 'pending')
+
+    @override_settings(THUMBNAIL_BACKGROUND_RENDERING=True)
+    @override_settings(THUMBNAIL_NAMER='easy_thumbnails.namers.default')
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_redirects_to_rendered_thumbnail(self):
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        image_id = ImageInstance.objects.get(name='macara').id
+        self.assertEquals(render_pending_jobs(), 1)
+
+        response = self.client.get(f'/{image_id}/thumbnails/0x50/')
+        self.assertEquals(response.status_code, 302)
+        self.assertIn('/media/user_test/macara.jpg.50x0_q85.jpg', response['Location'])
+
+        response = self.client.get(f'/{image_id}/')
+        self.assertEquals(response.data['thumbnails_status'], {'0x50': 'ready'})
+
+    @override_settings(THUMBNAIL_BACKGROUND_RENDERING=True, THUMBNAIL_JOB_MAX_ATTEMPTS=2)
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_failed_jobs_are_retried(self):
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        job = ThumbnailJob.objects.get()
+
+        def claimed_render(image, *args):
+            # job is claimed before it is rendered
+            self.assertEquals(ThumbnailJob.objects.get().status, ThumbnailJob.RUNNING)
+            raise OSError('storage is not available')
+
+        with mock.patch('image_browser.thumbnails.render_thumbnails_once', claimed_render):
+            self.assertEquals(render_pending_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEquals((job.status, job.attempts, job.error), (ThumbnailJob.FAILED, 1, 'storage is not available'))
+
+        # failed job waits for retry delay
+        self.assertEquals(render_pending_jobs(), 0)
+        with override_settings(THUMBNAIL_JOB_RETRY_DELAY=-1):
+            with mock.patch('image_browser.thumbnails.render_thumbnails_once', claimed_render):
+                self.assertEquals(render_pending_jobs(), 1)
+            # the last attempt failed
+            self.assertEquals(render_pending_jobs(), 0)
+            job.refresh_from_db()
+            self.assertEquals((job.status, job.attempts), (ThumbnailJob.FAILED, 2))
+
+            # enqueued again (e.g. by a plan change) it gets all attempts again
+            enqueue_thumbnails(job.image, [ThumbnailSize(width=50, height=0)])
+            self.assertEquals(render_pending_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEquals((job.status, job.attempts), (ThumbnailJob.READY, 1))
+
+    @override_settings(THUMBNAIL_BACKGROUND_RENDERING=True, THUMBNAIL_JOB_TIMEOUT=60)
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_abandoned_running_jobs_are_retried(self):
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        ThumbnailJob.objects.update(status=ThumbnailJob.RUNNING, attempts=1, updated=timezone.now())
+        self.assertEquals(render_pending_jobs(), 0)
+        ThumbnailJob.objects.update(updated=timezone.now() - timedelta(minutes=2))
+        self.assertEquals(render_pending_jobs(), 1)
+        self.assertEquals(ThumbnailJob.objects.get().status, ThumbnailJob.READY)
+
+    @override_settings(THUMBNAIL_BACKGROUND_RENDERING=True)
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_size_outside_plan_not_found(self):
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        image_id = ImageInstance.objects.get(name='macara').id
+        response = self.client.get(f'/{image_id}/thumbnails/0x500/')
+        self.assertEquals(response.status_code, 404)
+        self.assertFalse(ThumbnailJob.objects.filter(width=500).exists())
+
+
+class ImageListQueryCount(TestCase):
+    client = None
+
+    def setUp(self) -> None:
+        plan: PlanTier = PlanTier.objects.create(name='Queries', show_original_link=True,
+                                                 create_expiring_link=True)
+        ts = ThumbnailSize.objects.create(height=0, width=50)
+        ts1 = ThumbnailSize.objects.create(height=100, width=50)
+        plan.thumbnail_sizes.set([ts, ts1])
+
+        user = create_test_user_with_plan(plan)
+        self.client = APIClient()
+        self.client.force_authenticate(user=user)
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def count_list_queries(self) -> int:
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/images/')
+        self.assertEquals(response.status_code, 200)
+        return len(context.captured_queries)
+
+    # plans are cached only with shared cache
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'), PLAN_CACHE_ALIAS='default',
+                       CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_list_queries_do_not_depend_on_library_size(self):
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        few_images_queries = self.count_list_queries()
+
+        for i in range(5):
+            upload_image_request('staticfiles/rabbit.png', f'rabbit{i}', self.client)
+        self.assertEquals(self.count_list_queries(), few_images_queries)
+        self.assertLessEqual(few_images_queries, 5)
+
+
+class ThumbnailManifest(TestCase):
+    client = None
+    image = None
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def setUp(self) -> None:
+        plan: PlanTier = PlanTier.objects.create(name='Manifest', show_original_link=False,
+                                                 create_expiring_link=False, thumbnail_formats='jpeg,webp')
+        plan.thumbnail_sizes.set([ThumbnailSize.objects.create(height=50, width=0),
+                                  ThumbnailSize.objects.create(height=100, width=0)])
+        self.client = APIClient()
+        self.client.force_authenticate(user=create_test_user_with_plan(plan))
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        self.image = ImageInstance.objects.get()
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def list_without_lookups(self) -> dict:
+        """ Lists images, failing on any thumbnail lookup """
+        with mock.patch('image_browser.thumbnails.get_thumbnailer', side_effect=AssertionError('thumbnail lookup')), \
+                CaptureQueriesContext(connection) as context:
+            response = self.client.get('/images/')
+        self.assertFalse([query for query in context.captured_queries if 'easy_thumbnails' in query['sql']])
+        return response.data['results'][0]
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_rendered_thumbnails_are_listed_from_manifest(self):
+        self.assertEquals(sorted(self.image.thumbnail_manifest),
+                          ['0x100:jpeg:85', '0x100:webp:85', '0x50:jpeg:85', '0x50:webp:85'])
+        result = self.list_without_lookups()
+        self.assertTrue(result['thumbnail_50x0_url'].endswith(self.image.thumbnail_manifest['0x50:jpeg:85']))
+        self.assertTrue(result['thumbnail_100x0_variants']['webp'].endswith(
+            self.image.thumbnail_manifest['0x100:webp:85']))
+        self.assertTrue(self.image.image_file.thumbnail_storage.exists(self.image.thumbnail_manifest['0x50:jpeg:85']))
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_missing_manifests_are_filled(self):
+        manifest = self.image.thumbnail_manifest
+        ImageInstance.objects.update(thumbnail_manifest={})
+        call_command('backfillthumbnailmanifests')
+        self.assertEquals(ImageInstance.objects.get().thumbnail_manifest, manifest)
+
+        # images listed with incomplete manifest are looked up once
+        ImageInstance.objects.update(thumbnail_manifest={})
+        self.client.get('/images/')
+        self.assertEquals(ImageInstance.objects.get().thumbnail_manifest, manifest)
+        self.list_without_lookups()
+
+
+class ImageListPagination(TestCase):
+    client = None
+
+    def setUp(self) -> None:
+        plan: PlanTier = PlanTier.objects.create(name='Pages', show_original_link=True,
+                                                 create_expiring_link=False)
+        user = create_test_user_with_plan(plan)
+        self.client = APIClient()
+        self.client.force_authenticate(user=user)
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_pages_follow_upload_order(self):
+        for i in range(3):
+            upload_image_request('staticfiles/macara.jpg', f'macara{i}', self.client)
+
+        response = self.client.get('/images/', {'page_size': 2})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals([image['name'] for image in response.data['results']], ['macara0', 'macara1'])
+        self.assertIsNone(response.data['previous'])
+
+        response = self.client.get(response.data['next'])
+        self.assertEquals([image['name'] for image in response.data['results']], ['macara2'])
+        self.assertIsNone(response.data['next'])
+
+    @override_settings(IMAGE_LIST_MAX_PAGE_SIZE=2)
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_page_size_is_limited(self):
+        for i in range(3):
+            upload_image_request('staticfiles/macara.jpg', f'macara{i}', self.client)
+
+        response = self.client.get('/images/', {'page_size': 100})
+        self.assertEquals(len(response.data['results']), 2)
+        self.assertIsNotNone(response.data['next'])
+
+
+@override_settings(EXPIRING_LINK_MODE='signed')
+class SignedExpiringLink(TestCase):
+    client = None
+    client1 = None
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def setUp(self) -> None:
+        plan1: PlanTier = PlanTier.objects.create(name='Test', show_original_link=False,
+                                                  create_expiring_link=True)
+        user1 = create_test_user_with_plan(plan1)
+        self.client1 = APIClient()
+        self.client1.force_authenticate(user=user1)
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client1)
+        self.client = APIClient()
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_signed_link_is_not_stored(self):
+        response = create_temp_link('macara', self.client1, 300)
+        self.assertEquals(response.status_code, 201)
+        self.assertIn('/temp/signed/', response.data['expiring_link_url'])
+        self.assertFalse(TempUrl.objects.exists())
+
+        response = self.client.get(response.data['expiring_link_url'])
+        self.assertEquals(response.status_code, 200)
+        with open('staticfiles/macara.jpg', 'rb') as image:
+            self.assertEquals(b''.join(response.streaming_content), image.read())
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_forged_link_not_found(self):
+        link = create_temp_link('macara', self.client1, 300).data['expiring_link_url']
+        response = self.client.get(link + 'x')
+        self.assertEquals(response.status_code, 404)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_expired_link_not_found(self):
+        image = ImageInstance.objects.get(name='macara')
+        token = sign_image_link(image, timezone.now() - timedelta(seconds=1))
+        response = self.client.get(f'/temp/signed/{token}')
+        self.assertEquals(response.status_code, 404)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'), IMAGE_DEDUPLICATION=True)
+    def test_link_of_deleted_image_not_found(self):
+        upload_image_request('staticfiles/macara.jpg', 'copy', self.client1)
+        link = create_temp_link('copy', self.client1, 300).data['expiring_link_url']
+        self.assertEquals(self.client.get(link).status_code, 200)
+        # blob file of the deleted image is still stored (it is purged after commit, or kept for other images)
+        ImageInstance.objects.get(name='copy').delete()
+        self.assertEquals(self.client.get(link).status_code, 404)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_key_rotation(self):
+        image = ImageInstance.objects.get(name='macara')
+        with override_settings(EXPIRING_LINK_SIGNING_KEYS=['old-key']):
+            token = sign_image_link(image, timezone.now() + timedelta(seconds=300))
+        with override_settings(EXPIRING_LINK_SIGNING_KEYS=['new-key', 'old-key']):
+            self.assertEquals(self.client.get(f'/temp/signed/{token}').status_code, 200)
+        with override_settings(EXPIRING_LINK_SIGNING_KEYS=['new-key']):
+            self.assertEquals(self.client.get(f'/temp/signed/{token}').status_code, 404)
+
+
+class ExpiredLinksDeletion(TestCase):
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def setUp(self) -> None:
+        plan: PlanTier = PlanTier.objects.create(name='Test', show_original_link=False,
+                                                 create_expiring_link=True)
+        user = create_test_user_with_plan(plan)
+        client = APIClient()
+        client.force_authenticate(user=user)
+        upload_image_request('staticfiles/macara.jpg', 'macara', client)
+        image = ImageInstance.objects.get(name='macara')
+        now = timezone.now()
+        for i in range(5):
+            TempUrl.objects.create(url_hash=f'expired{i}', expiration_date=now - timedelta(seconds=1), image=image)
+        TempUrl.objects.create(url_hash='valid', expiration_date=now + timedelta(seconds=300), image=image)
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def test_deletes_only_expired_links_in_batches(self):
+        rows, size = delete_expired_links(batch_size=2)
+        self.assertEquals(rows, 5)
+        self.assertEquals(size, 5 * (24 + len('expired0')))
+        self.assertEquals(list(TempUrl.objects.values_list('url_hash', flat=True)), ['valid'])
+        self.assertEquals(delete_expired_links(), (0, 0))
+
+
+class ThumbnailPrerendering(TestCase):
+    client = None
+    plan = None
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def setUp(self) -> None:
+        self.plan: PlanTier = PlanTier.objects.create(name='Prerender', show_original_link=False,
+                                                      create_expiring_link=False)
+        user = create_test_user_with_plan(self.plan)
+        self.client = APIClient()
+        self.client.force_authenticate(user=user)
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        upload_image_request('staticfiles/rabbit.png', 'rabbit', self.client)
+        self.plan.thumbnail_sizes.add(ThumbnailSize.objects.create(height=0, width=50))
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def get_missing(self):
+        return get_missing_thumbnails(get_plan_images(self.plan), self.plan.thumbnail_sizes.all())
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_command_renders_missing_sizes(self):
+        self.assertEquals(len(self.get_missing()), 2)
+        checkpoint = TEST_DIR + '/checkpoint.json'
+        call_command('prewarmthumbnails', plan=['Prerender'], workers=0, checkpoint=checkpoint)
+        self.assertEquals(self.get_missing(), {})
+        rabbit_id = ImageInstance.objects.get(name='rabbit').id
+        with open(checkpoint) as checkpoint_file:
+            self.assertEquals(json.load(checkpoint_file), {'plan:Prerender': rabbit_id})
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_command_skips_missing_original(self):
+        macara = ImageInstance.objects.get(name='macara')
+        macara.image_file.storage.delete(macara.image_file.name)
+        checkpoint = TEST_DIR + '/checkpoint.json'
+        call_command('prewarmthumbnails', plan=['Prerender'], workers=0, checkpoint=checkpoint)
+        self.assertEquals(list(self.get_missing()), [macara.id])
+        # broken image is done, resumed run does not stop at it again
+        rabbit_id = ImageInstance.objects.get(name='rabbit').id
+        with open(checkpoint) as checkpoint_file:
+            self.assertEquals(json.load(checkpoint_file), {'plan:Prerender': rabbit_id})
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_queues_only_missing_sizes(self):
+        macara = ImageInstance.objects.get(name='macara')
+        macara.get_thumbnail(50, 0)
+        queued = enqueue_missing_thumbnails(get_plan_images(self.plan), self.plan.thumbnail_sizes.all())
+        self.assertEquals(queued, 1)
+        self.assertEquals(ThumbnailJob.objects.get().image.name, 'rabbit')
+
+
+class PyramidRendering(TestCase):
+    image = None
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def setUp(self) -> None:
+        plan: PlanTier = PlanTier.objects.create(name='Pyramid', show_original_link=False,
+                                                 create_expiring_link=False)
+        user = create_test_user_with_plan(plan)
+        client = APIClient()
+        client.force_authenticate(user=user)
+        upload_image_request('staticfiles/macara.jpg', 'macara', client)
+        self.image = ImageInstance.objects.get(name='macara')
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def test_target_size(self):
+        self.assertEquals(get_target_size((1085, 814), (0, 200)), (267, 200))
+        self.assertEquals(get_target_size((1085, 814), (50, 100)), (50, 38))
+        self.assertEquals(get_target_size((1085, 814), (2000, 0)), (1085, 814))
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_decodes_jpeg_in_reduced_size(self):
+        thumbnailer = get_thumbnailer(self.image.image_file)
+        with open_source_image(thumbnailer, [(0, 200)]) as (image, original_size):
+            self.assertEquals((image.size, original_size), ((272, 204), (1085, 814)))
+        with open_source_image(thumbnailer, [(0, 200), (0, 500)]) as (image, _):
+            self.assertEquals(image.size, (1085, 814))
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_renders_sizes_like_separate_rendering(self):
+        sizes = [ThumbnailSize(width=0, height=100), ThumbnailSize(width=0, height=400),
+                 ThumbnailSize(width=50, height=0)]
+        rendered = render_thumbnails(self.image, sizes)
+        self.assertEquals(get_missing_thumbnails([self.image], sizes), {})
+        for size in sizes:
+            thumbnail = self.image.get_thumbnail(size.width, size.height)
+            self.assertEquals(rendered[(size.width, size.height)].name, thumbnail.name)
+            self.assertEquals(rendered[(size.width, size.height)].image.size,
+                              get_target_size((1085, 814), (size.width, size.height)))
+
+
+class ImageMetadata(TestCase):
+    client = None
+
+    def setUp(self) -> None:
+        plan: PlanTier = PlanTier.objects.create(name='Metadata', show_original_link=False,
+                                                 create_expiring_link=False)
+        user = create_test_user_with_plan(plan)
+        self.client = APIClient()
+        self.client.force_authenticate(user=user)
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_metadata_stored_at_upload(self):
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        upload_image_request('staticfiles/rabbit.png', 'rabbit', self.client)
+        macara = ImageInstance.objects.get(name='macara')
+        with open('staticfiles/macara.jpg', 'rb') as data:
+            content = data.read()
+        self.assertEquals((macara.width, macara.height, macara.format), (1085, 814, 'JPEG'))
+        self.assertEquals(macara.file_size, len(content))
+        self.assertEquals(macara.content_hash, hashlib.sha256(content).hexdigest())
+        self.assertEquals(ImageInstance.objects.get(name='rabbit').format, 'PNG')
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_backfill_command(self):
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        ImageInstance.objects.update(width=None, height=None, format='', file_size=None, content_hash='')
+        call_command('backfillimagemetadata')
+        macara = ImageInstance.objects.get(name='macara')
+        self.assertEquals((macara.width, macara.height, macara.format), (1085, 814, 'JPEG'))
+        self.assertEquals(len(macara.content_hash), 64)
+
+
+@override_settings(PLAN_CACHE_ALIAS='default',
+                   CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PlanCache(TestCase):
+    user = None
+    plan = None
+
+    def setUp(self) -> None:
+        self.plan: PlanTier = PlanTier.objects.create(name='Cached', show_original_link=False,
+                                                      create_expiring_link=False)
+        self.plan.thumbnail_sizes.add(ThumbnailSize.objects.create(height=100, width=0))
+        self.user = create_test_user_with_plan(self.plan)
+
+    def test_plan_resolved_without_queries(self):
+        get_plan_by_user(self.user)
+        with self.assertNumQueries(0):
+            plan = get_plan_by_user(self.user)
+            self.assertEquals([str(size) for size in plan.thumbnail_sizes.all()], ['100x0'])
+
+    def test_invalidated_by_thumbnail_sizes_change(self):
+        get_plan_by_user(self.user)
+        self.plan.thumbnail_sizes.add(ThumbnailSize.objects.create(height=200, width=0))
+        self.assertEquals(len(get_plan_by_user(self.user).thumbnail_sizes.all()), 2)
+
+    def test_invalidated_by_user_plan_change(self):
+        other = PlanTier.objects.create(name='Other', show_original_link=True, create_expiring_link=True)
+        self.assertEquals(get_plan_by_user(self.user).name, 'Cached')
+        app_user = AppUser.objects.get(user=self.user)
+        app_user.plan = other
+        app_user.save()
+        self.assertEquals(get_plan_by_user(self.user).name, 'Other')
+
+    @override_settings(PLAN_CACHE_ALIAS=None)
+    def test_not_cached_without_shared_cache(self):
+        get_plan_by_user(self.user)
+        # change saved by another process (without invalidation in this one) is seen right away
+        PlanTier.objects.filter(pk=self.plan.pk).update(show_original_link=True)
+        self.assertTrue(get_plan_by_user(self.user).show_original_link)
+        self.assertEquals(len(plans._local_cache), 0)
+
+    def test_shared_cache(self):
+        get_plan_by_user(self.user)
+        plans._local_cache.clear()
+        with self.assertNumQueries(0):
+            self.assertEquals(get_plan_by_user(self.user).name, 'Cached')
+        self.plan.show_original_link = True
+        self.plan.save()
+        self.assertTrue(get_plan_by_user(self.user).show_original_link)
+
+
+class ConditionalGet(TestCase):
+    client = None
+    user = None
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def setUp(self) -> None:
+        plan: PlanTier = PlanTier.objects.create(name='Conditional', show_original_link=True,
+                                                 create_expiring_link=False)
+        plan.thumbnail_sizes.add(ThumbnailSize.objects.create(height=50, width=0))
+        self.user = create_test_user_with_plan(plan)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_list_not_modified_until_upload(self):
+        etag = self.client.get('/images/')['ETag']
+        response = self.client.get('/images/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(response['ETag'], etag)
+
+        upload_image_request('staticfiles/rabbit.png', 'rabbit', self.client)
+        response = self.client.get('/images/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(len(response.data['results']), 2)
+        self.assertNotEquals(response['ETag'], etag)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_detail_not_modified_until_plan_change(self):
+        image_id = ImageInstance.objects.get(name='macara').id
+        etag = self.client.get(f'/{image_id}/')['ETag']
+        self.assertEquals(self.client.get(f'/{image_id}/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        PlanTier.objects.filter(name='Conditional').get().thumbnail_sizes.add(
+            ThumbnailSize.objects.create(height=100, width=0))
+        self.assertEquals(self.client.get(f'/{image_id}/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_etag_is_the_same_in_every_process(self):
+        etag = self.client.get('/images/')['ETag']
+        # other process may see other generation of plan cache
+        with mock.patch('image_browser.plans.get_generation', return_value=1000):
+            response = self.client.get('/images/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(response['ETag'], etag)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_media_cache_headers(self):
+        data = self.client.get('/images/').data['results'][0]
+        thumbnail_path = data['thumbnail_50x0_url'].split('/media/', 1)[1]
+        original_path = data['image_url'].split('/media/', 1)[1]
+
+        response = media(RequestFactory().get('/media/' + thumbnail_path), thumbnail_path)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Cache-Control'], THUMBNAIL_CACHE_CONTROL)
+        request = RequestFactory().get('/media/' + thumbnail_path, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEquals(media(request, thumbnail_path).status_code, 304)
+
+        response = media(RequestFactory().get('/media/' + original_path), original_path)
+        self.assertEquals(response['Cache-Control'], MEDIA_CACHE_CONTROL)
+        with self.assertRaises(Http404):
+            media(RequestFactory().get('/media/../manage.py'), '../manage.py')
+
+
+class ResumableUpload(TestCase):
+    client = None
+    content = None
+
+    def setUp(self) -> None:
+        plan: PlanTier = PlanTier.objects.create(name='Resumable', show_original_link=True,
+                                                 create_expiring_link=False)
+        user = create_test_user_with_plan(plan)
+        self.client = APIClient()
+        self.client.force_authenticate(user=user)
+        with open('staticfiles/macara.jpg', 'rb') as image:
+            self.content = image.read()
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def create_session(self, filename='macara.jpg'):
+        return self.client.post('/images/uploads/', {'name': 'macara', 'filename': filename,
+                                                     'size': len(self.content)}, format='json')
+
+    def put_range(self, session_id, start, end):
+        return self.client.put(f'/images/uploads/{session_id}/', self.content[start:end + 1],
+                               content_type='application/octet-stream',
+                               HTTP_CONTENT_RANGE=f'bytes {start}-{end}/{len(self.content)}')
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_upload_in_ranges_and_resume(self):
+        session_id = self.create_session().data['id']
+        middle = len(self.content) // 2
+        self.assertEquals(self.put_range(session_id, 0, middle - 1).data['received'], middle)
+
+        # range sent again after lost response is refused with position to continue from
+        response = self.put_range(session_id, 0, middle - 1)
+        self.assertEquals(response.status_code, 409)
+        self.assertEquals(response.data['received'], middle)
+        self.assertEquals(self.client.get(f'/images/uploads/{session_id}/').data['received'], middle)
+
+        self.assertEquals(self.client.post(f'/images/uploads/{session_id}/finalize').status_code, 400)
+        self.put_range(session_id, middle, len(self.content) - 1)
+        response = self.client.post(f'/images/uploads/{session_id}/finalize')
+        self.assertEquals(response.status_code, 201)
+        self.assertEquals(response.data['name'], 'macara')
+
+        image = ImageInstance.objects.get(name='macara')
+        with image.image_file.open('rb') as image_file:
+            self.assertEquals(image_file.read(), self.content)
+        self.assertEquals(image.content_hash, hashlib.sha256(self.content).hexdigest())
+        self.assertFalse(UploadSession.objects.exists())
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_requests_of_session_are_serialized(self):
+        session_id = self.create_session().data['id']
+        middle = len(self.content) // 2
+        self.put_range(session_id, 0, middle - 1)
+
+        # retried range arriving while the first one is being written does not touch the part file
+        with key_lock(f'upload:{session_id}'):
+            response = self.put_range(session_id, middle, len(self.content) - 1)
+            self.assertEquals(response.status_code, 409)
+            self.assertEquals(response.data['received'], middle)
+            self.assertEquals(self.client.post(f'/images/uploads/{session_id}/finalize').status_code, 409)
+        self.assertEquals(UploadSession.objects.get().received, middle)
+
+        self.put_range(session_id, middle, len(self.content) - 1)
+        self.assertEquals(self.client.post(f'/images/uploads/{session_id}/finalize').status_code, 201)
+        # finalization sent again finds the session finished instead of its removed part file
+        self.assertEquals(self.client.post(f'/images/uploads/{session_id}/finalize').status_code, 404)
+        self.assertEquals(ImageInstance.objects.count(), 1)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_upload_directory_on_other_file_system(self):
+        def link(*args):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+        for deduplication in (False, True):
+            with override_settings(IMAGE_DEDUPLICATION=deduplication), mock.patch('os.link', link):
+                session_id = self.create_session().data['id']
+                self.put_range(session_id, 0, len(self.content) - 1)
+                response = self.client.post(f'/images/uploads/{session_id}/finalize')
+            self.assertEquals(response.status_code, 201)
+            with ImageInstance.objects.latest('id').image_file.open('rb') as image_file:
+                self.assertEquals(image_file.read(), self.content)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(os.listdir(get_upload_dir()))
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_refuses_content_which_is_not_image(self):
+        self.assertEquals(self.create_session('macara.gif').status_code, 400)
+        session_id = self.create_session('macara.png').data['id']
+        response = self.put_range(session_id, 0, 1023)
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(UploadSession.objects.get().received, 0)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_multipart_upload_checks_content(self):
+        fake_image = SimpleUploadedFile('script.png', b'#!/bin/sh\n' * 10)
+        response = self.client.post('/images/upload', {'name': 'script', 'image_file': fake_image},
+                                    format='multipart')
+        self.assertEquals(response.status_code, 400)
+        self.assertFalse(ImageInstance.objects.exists())
+
+
+class BatchUpload(TestCase):
+    client = None
+
+    def setUp(self) -> None:
+        plan: PlanTier = PlanTier.objects.create(name='Batch', show_original_link=True,
+                                                 create_expiring_link=False)
+        plan.thumbnail_sizes.add(ThumbnailSize.objects.create(height=50, width=0))
+        user = create_test_user_with_plan(plan)
+        self.client = APIClient()
+        self.client.force_authenticate(user=user)
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_uploads_many_files(self):
+        with open('staticfiles/macara.jpg', 'rb') as macara, open('staticfiles/rabbit.png', 'rb') as rabbit:
+            fake = SimpleUploadedFile('fake.png', b'not an image')
+            response = self.client.post('/images/upload/batch', {'image_file': [macara, rabbit, fake]},
+                                        format='multipart')
+        self.assertEquals(response.status_code, 207)
+        results = response.data['results']
+        self.assertEquals([result['filename'] for result in results], ['macara.jpg', 'rabbit.png', 'fake.png'])
+        self.assertIn('/media/user_test/', results[0]['image_url'])
+        self.assertIn('thumbnail_50x0_url', results[1])
+        self.assertIn('errors', results[2])
+        self.assertEquals(ImageInstance.objects.filter(owner__username=username).count(), 2)
+        self.assertEquals(ImageInstance.objects.get(name='macara.jpg').format, 'JPEG')
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_uploads_zip_archive(self):
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zip_archive:
+            zip_archive.write('staticfiles/macara.jpg', 'shoot/macara.jpg')
+            zip_archive.write('staticfiles/rabbit.png', 'shoot/rabbit.png')
+        response = self.client.post('/images/upload/batch',
+                                    {'archive': SimpleUploadedFile('shoot.zip', archive.getvalue())},
+                                    format='multipart')
+        self.assertEquals(response.status_code, 201)
+        names = sorted(ImageInstance.objects.values_list('image_file', flat=True))
+        self.assertEquals(names, ['user_test/macara.jpg', 'user_test/rabbit.png'])
+
+    def post_zip(self, members: dict):
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_DEFLATED) as zip_archive:
+            for name, content in members.items():
+                zip_archive.writestr(name, content)
+        return self.client.post('/images/upload/batch', {'archive': SimpleUploadedFile('bomb.zip', archive.getvalue())},
+                                format='multipart')
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'), UPLOAD_MAX_SIZE=100_000, BATCH_UPLOAD_MAX_FILES=3,
+                       BATCH_UPLOAD_MAX_SIZE=250_000)
+    def test_archive_limits_are_checked_while_extracting(self):
+        zeros = bytes(200_000)
+        response = self.post_zip({'bomb.png': zeros})
+        self.assertEquals(response.status_code, 400)
+        self.assertIn('bomb.png in archive is bigger than 100000 bytes', str(response.data))
+
+        # declared size is not trusted, only the read content
+        iter_members = batch_upload._iter_members
+        with mock.patch('image_browser.batch_upload._iter_members',
+                        lambda archive: ((name, 10, open_member) for name, _, open_member in iter_members(archive))):
+            self.assertEquals(self.post_zip({'bomb.png': zeros}).status_code, 400)
+
+        response = self.post_zip({f'{number}.png': bytes(90_000) for number in range(3)})
+        self.assertIn('bigger than 250000 bytes together', str(response.data))
+        response = self.post_zip({f'{number}.png': b'x' for number in range(4)})
+        self.assertIn('At most 3 images', str(response.data))
+        self.assertFalse(ImageInstance.objects.exists())
+
+
+class Deduplication(TestCase):
+    client = None
+    other_client = None
+
+    def setUp(self) -> None:
+        plan: PlanTier = PlanTier.objects.create(name='Dedup', show_original_link=True,
+                                                 create_expiring_link=False)
+        plan.thumbnail_sizes.add(ThumbnailSize.objects.create(height=50, width=0))
+        self.client = APIClient()
+        self.client.force_authenticate(user=create_test_user_with_plan(plan))
+        self.other_client = APIClient()
+        self.other_client.force_authenticate(user=create_test_user_with_plan(plan, username='other'))
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def stored_files(self):
+        # hidden directories (locks, render cache) are not stored images
+        return sorted(os.path.relpath(os.path.join(path, name), TEST_DIR + '/media')
+                      for path, _, names in os.walk(TEST_DIR + '/media') for name in names
+                      if '/.' not in os.path.relpath(path, TEST_DIR).replace(os.sep, '/'))
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'), IMAGE_DEDUPLICATION=True)
+    def test_same_content_is_stored_and_rendered_once(self):
+        first = upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        second = upload_image_request('staticfiles/macara.jpg', 'copy', self.other_client)
+        self.assertEquals(first.status_code, 201)
+        self.assertEquals(first.data['thumbnail_50x0_url'], second.data['thumbnail_50x0_url'])
+
+        blob = ImageBlob.objects.get()
+        self.assertEquals(blob.references, 2)
+        self.assertEquals(set(ImageInstance.objects.values_list('image_file', flat=True)), {blob.name})
+        self.assertEquals(len(self.stored_files()), 2)
+        self.assertIn(blob.name, self.stored_files())
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'), IMAGE_DEDUPLICATION=True)
+    def test_file_is_deleted_with_last_image(self):
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        upload_image_request('staticfiles/macara.jpg', 'copy', self.other_client)
+        blob = ImageBlob.objects.get()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ImageInstance.objects.get(name='macara').delete()
+        self.assertEquals(ImageBlob.objects.get().references, 1)
+        self.assertEquals(len(self.stored_files()), 2)
+
+        # rolled back deletion keeps the files, committed one deletes them only after the commit
+        with self.captureOnCommitCallbacks(execute=True), self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                User.objects.get(username='other').delete()
+                raise RuntimeError
+        self.assertEquals(ImageBlob.objects.get().references, 1)
+        self.assertEquals(len(self.stored_files()), 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                User.objects.get(username='other').delete()
+                self.assertEquals(len(self.stored_files()), 2)
+        self.assertFalse(ImageBlob.objects.exists())
+        self.assertEquals(self.stored_files(), [])
+
+        # the same content uploaded again is stored again
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        self.assertEquals(ImageBlob.objects.get().name, blob.name)
+        self.assertIn(blob.name, self.stored_files())
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'), IMAGE_DEDUPLICATION=True)
+    def test_batch_and_resumable_uploads_share_blobs(self):
+        with open('staticfiles/macara.jpg', 'rb') as macara, open('staticfiles/macara.jpg', 'rb') as copy, \
+                open('staticfiles/rabbit.png', 'rb') as rabbit:
+            response = self.client.post('/images/upload/batch', {'image_file': [macara, copy, rabbit]},
+                                        format='multipart')
+        self.assertEquals(response.status_code, 201)
+        self.assertEquals(ImageInstance.objects.filter(owner__username=username).count(), 3)
+
+        with open('staticfiles/macara.jpg', 'rb') as image:
+            content = image.read()
+        session_id = self.other_client.post('/images/uploads/', {'filename': 'macara.jpg', 'size': len(content)},
+                                            format='json').data['id']
+        self.other_client.put(f'/images/uploads/{session_id}/', content, content_type='application/octet-stream',
+                              HTTP_CONTENT_RANGE=f'bytes 0-{len(content) - 1}/{len(content)}')
+        self.assertEquals(self.other_client.post(f'/images/uploads/{session_id}/finalize').status_code, 201)
+
+        references = dict(ImageBlob.objects.values_list('name', 'references'))
+        self.assertEquals(sorted(references.values()), [1, 3])
+        self.assertTrue(all(name.startswith('blobs/') for name in references))
+        # thumbnails are stored next to originals, under names shorter than content hashes
+        originals = [name for name in self.stored_files() if len(os.path.basename(name).split('.')[0]) == 64]
+        self.assertEquals(sorted(originals), sorted(references))
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_existing_images_are_deduplicated(self):
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        upload_image_request('staticfiles/macara.jpg', 'copy', self.other_client)
+        self.assertFalse(ImageBlob.objects.exists())
+
+        call_command('deduplicateimages')
+        blob = ImageBlob.objects.get()
+        self.assertEquals(blob.references, 2)
+        self.assertEquals(list(ImageInstance.objects.values_list('blob', flat=True)), [blob.id, blob.id])
+        self.assertEquals(self.stored_files(), [blob.name])
+
+
+class SimilarImages(TestCase):
+    client = None
+
+    def setUp(self) -> None:
+        plan: PlanTier = PlanTier.objects.create(name='Similar', show_original_link=False,
+                                                 create_expiring_link=False)
+        plan.thumbnail_sizes.add(ThumbnailSize.objects.create(height=50, width=0))
+        self.client = APIClient()
+        self.client.force_authenticate(user=create_test_user_with_plan(plan))
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def create_smaller_copy(self) -> str:
+        os.makedirs(TEST_DIR, exist_ok=True)
+        path = TEST_DIR + '/macara_small.jpg'
+        with Image.open('staticfiles/macara.jpg') as image:
+            image.resize((400, 300)).save(path, quality=60)
+        return path
+
+    def test_hash_survives_scaling_and_recompression(self):
+        with Image.open('staticfiles/macara.jpg') as macara, Image.open(self.create_smaller_copy()) as copy, \
+                Image.open('staticfiles/rabbit.png') as rabbit:
+            macara_hash = compute_perceptual_hash(macara)
+            distances = get_hamming_distances(macara_hash, np.array([compute_perceptual_hash(copy),
+                                                                     compute_perceptual_hash(rabbit)]))
+        self.assertLessEqual(distances[0], 4)
+        self.assertGreater(distances[1], 16)
+
+    def test_chunk_neighbours(self):
+        neighbours = get_chunk_neighbours(0b1010, 2)
+        self.assertEquals(len(neighbours), 1 + 16 + 120)
+        self.assertEquals(len(set(neighbours)), len(neighbours))
+        self.assertIn(0b1011, neighbours)
+        self.assertIn(0b0000, neighbours)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_finds_near_duplicates_of_owner(self):
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        upload_image_request(self.create_smaller_copy(), 'copy', self.client)
+        upload_image_request('staticfiles/rabbit.png', 'rabbit', self.client)
+        # hashes are computed from thumbnails rendered at upload
+        self.assertFalse(ImageInstance.objects.filter(phash_0__isnull=True).exists())
+
+        image_id = ImageInstance.objects.get(name='macara').id
+        response = self.client.get(f'/{image_id}/similar/')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals([result['name'] for result in response.data['results']], ['copy'])
+        self.assertIn('thumbnail_50x0_url', response.data['results'][0])
+        self.assertLessEqual(response.data['results'][0]['distance'], 4)
+
+        self.assertEquals(self.client.get(f'/{image_id}/similar/?distance=64').status_code, 400)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_hash_is_computed_for_images_without_thumbnails(self):
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        ImageInstance.objects.update(phash_0=None, phash_1=None, phash_2=None, phash_3=None)
+        call_command('indexperceptualhashes')
+        self.assertFalse(ImageInstance.objects.filter(phash_0__isnull=True).exists())
+
+
+class ImageStorageLayout(TestCase):
+    client = None
+
+    def setUp(self) -> None:
+        plan: PlanTier = PlanTier.objects.create(name='Storage', show_original_link=True,
+                                                 create_expiring_link=False)
+        plan.thumbnail_sizes.add(ThumbnailSize.objects.create(height=50, width=0))
+        self.client = APIClient()
+        self.client.force_authenticate(user=create_test_user_with_plan(plan))
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'), IMAGE_PATH_LAYOUT='sharded')
+    def test_sharded_layout(self):
+        response = upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        name = ImageInstance.objects.get().image_file.name
+        self.assertRegex(name, r'^user_test/[0-9a-f]{2}/[0-9a-f]{2}/macara\.jpg$')
+        # thumbnails are stored next to their original
+        self.assertIn('/media/' + os.path.dirname(name) + '/', response.data['thumbnail_50x0_url'])
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_existing_files_are_resharded(self):
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        old_name = ImageInstance.objects.get().image_file.name
+        self.assertEquals(old_name, 'user_test/macara.jpg')
+
+        with override_settings(IMAGE_PATH_LAYOUT='sharded'):
+            call_command('reshardimages')
+            image = ImageInstance.objects.get()
+            self.assertRegex(image.image_file.name, r'^user_test/[0-9a-f]{2}/[0-9a-f]{2}/macara\.jpg$')
+            self.assertTrue(image.image_file.storage.exists(image.image_file.name))
+            self.assertFalse(image.image_file.storage.exists(old_name))
+            self.assertEquals(os.listdir(TEST_DIR + '/media/user_test'), [image.image_file.name.split('/')[1]])
+
+            response = self.client.get(f'/{image.id}/')
+            self.assertIn('/media/' + os.path.dirname(image.image_file.name) + '/',
+                          response.data['thumbnail_50x0_url'])
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'), IMAGE_STORAGE='image_browser.storage.LocalObjectStorage',
+                       IMAGE_STORAGE_OPTIONS={'location': TEST_DIR + '/bucket'})
+    def test_object_storage(self):
+        response = upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        self.assertEquals(response.status_code, 201)
+        image = ImageInstance.objects.get()
+        with self.assertRaises(NotImplementedError):
+            image.image_file.path
+        # objects have flat keys, originals and thumbnails are in the bucket
+        keys = os.listdir(TEST_DIR + '/bucket')
+        self.assertIn('user_test%2Fmacara.jpg', keys)
+        self.assertEquals(len(keys), 2)
+        self.assertFalse(os.path.exists(TEST_DIR + '/media/user_test'))
+
+        thumbnail_path = re.search(r'/media/(.*)$', response.data['thumbnail_50x0_url']).group(1)
+        response = media(RequestFactory().get('/media/' + thumbnail_path), thumbnail_path)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Cache-Control'], THUMBNAIL_CACHE_CONTROL)
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'\xff\xd8'))
+
+        # resumable upload is copied into the storage
+        with open('staticfiles/rabbit.png', 'rb') as rabbit:
+            content = rabbit.read()
+        session_id = self.client.post('/images/uploads/', {'filename': 'rabbit.png', 'size': len(content)},
+                                      format='json').data['id']
+        self.client.put(f'/images/uploads/{session_id}/', content, content_type='application/octet-stream',
+                        HTTP_CONTENT_RANGE=f'bytes 0-{len(content) - 1}/{len(content)}')
+        self.assertEquals(self.client.post(f'/images/uploads/{session_id}/finalize').status_code, 201)
+        self.assertIn('user_test%2Frabbit.png', os.listdir(TEST_DIR + '/bucket'))
+
+
+class ProtectedOriginal(TestCase):
+    client = None
+    image_id = None
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def setUp(self) -> None:
+        plan: PlanTier = PlanTier.objects.create(name='Originals', show_original_link=True,
+                                                 create_expiring_link=False)
+        self.client = APIClient()
+        self.client.force_authenticate(user=create_test_user_with_plan(plan))
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        self.image_id = ImageInstance.objects.get().id
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_owner_gets_streamed_original(self):
+        response = self.client.get(f'/{self.image_id}/original/')
+        self.assertEquals(response.status_code, 200)
+        with open('staticfiles/macara.jpg', 'rb') as image:
+            self.assertEquals(b''.join(response.streaming_content), image.read())
+        self.assertEquals(response['Cache-Control'], 'private, no-cache')
+        response = self.client.get(f'/{self.image_id}/original/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEquals(response.status_code, 304)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_access_is_checked(self):
+        self.assertEquals(APIClient().get(f'/{self.image_id}/original/').status_code, 403)
+
+        other_client = APIClient()
+        other_client.force_authenticate(user=create_test_user_with_plan(PlanTier.objects.get(name='Originals'), username='other'))
+        self.assertEquals(other_client.get(f'/{self.image_id}/original/').status_code, 403)
+
+        plan: PlanTier = PlanTier.objects.create(name='No originals', show_original_link=False,
+                                                 create_expiring_link=False)
+        AppUser.objects.filter(user__username=username).update(plan=plan)
+        self.assertEquals(self.client.get(f'/{self.image_id}/original/').status_code, 403)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'), MEDIA_SENDFILE_BACKEND='x-accel-redirect')
+    def test_original_is_sent_by_front_end_server(self):
+        response = self.client.get(f'/{self.image_id}/')
+        self.assertTrue(response.data['image_url'].endswith(f'/{self.image_id}/original/'))
+
+        response = self.client.get(f'/{self.image_id}/original/')
+        self.assertEquals(response['X-Accel-Redirect'], '/protected-media/user_test/macara.jpg')
+        self.assertEquals(response.content, b'')
+
+        with override_settings(MEDIA_SENDFILE_BACKEND='x-sendfile'):
+            response = self.client.get(f'/{self.image_id}/original/')
+        self.assertEquals(response['X-Sendfile'], os.path.abspath(TEST_DIR + '/media/user_test/macara.jpg'))
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'), MEDIA_SENDFILE_BACKEND='x-accel-redirect')
+    def test_media_view_serves_only_thumbnails(self):
+        original_path = 'user_test/macara.jpg'
+        with self.assertRaises(Http404):
+            media(RequestFactory().get('/media/' + original_path), original_path)
+        thumbnail_path = ImageInstance.objects.get().get_thumbnail(50, 0).name
+        self.assertEquals(media(RequestFactory().get('/media/' + thumbnail_path), thumbnail_path).status_code, 200)
+
+
+def asgi_get(path: str, headers=()) -> list:
+    """ Sends GET request through ASGI handler, returns sent ASGI messages """
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'root_path': '',
+             'headers': [(b'host', b'testserver')] + list(headers), 'server': ('testserver', 80),
+             'client': ('127.0.0.1', 40000)}
+    async_to_sync(ASGIHandler())(scope, receive, send)
+    return messages
+
+
+@override_settings(ROOT_URLCONF='image_browser.tests')
+class AsyncViews(TransactionTestCase):
+    link_hash = None
+    image_id = None
+    authorization = None
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def setUp(self) -> None:
+        plan: PlanTier = PlanTier.objects.create(name='Async', show_original_link=True,
+                                                 create_expiring_link=True)
+        plan.thumbnail_sizes.add(ThumbnailSize.objects.create(height=50, width=0))
+        user = create_test_user_with_plan(plan)
+        user.set_password(password)
+        user.save()
+        self.authorization = (b'authorization', b'Basic ' + base64.b64encode(f'{username}:{password}'.encode()))
+        client = APIClient()
+        client.force_authenticate(user=user)
+        upload_image_request('staticfiles/macara.jpg', 'macara', client)
+        self.image_id = ImageInstance.objects.get().id
+        self.link_hash = create_temp_link('macara', client, 300).data['expiring_link_url'].rstrip('/').split('/')[-1]
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_link_is_streamed_asynchronously(self):
+        with open('staticfiles/macara.jpg', 'rb') as image:
+            content = image.read()
+        start, *body = asgi_get(f'/temp/{self.link_hash}')
+        self.assertEquals(start['status'], 200)
+        self.assertIn((b'Content-Length', str(len(content)).encode()), start['headers'])
+        self.assertGreater(len(body), 2)
+        self.assertEquals(b''.join(message.get('body', b'') for message in body), content)
+
+        start, *body = asgi_get(f'/temp/{self.link_hash}', [(b'range', b'bytes=10-19')])
+        self.assertEquals(start['status'], 206)
+        self.assertEquals(b''.join(message.get('body', b'') for message in body), content[10:20])
+
+        self.assertEquals(asgi_get('/temp/missing')[0]['status'], 404)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_list_and_detail(self):
+        start, *body = asgi_get('/images/', [self.authorization])
+        self.assertEquals(start['status'], 200)
+        results = json.loads(b''.join(message.get('body', b'') for message in body))['results']
+        self.assertEquals([result['name'] for result in results], ['macara'])
+        self.assertIn('thumbnail_50x0_url', results[0])
+
+        start, *_ = asgi_get(f'/{self.image_id}/', [self.authorization])
+        self.assertEquals(start['status'], 200)
+        etag = dict(start['headers'])[b'ETag']
+        start, *_ = asgi_get(f'/{self.image_id}/', [self.authorization, (b'if-none-match', etag)])
+        self.assertEquals(start['status'], 304)
+
+        self.assertEquals(asgi_get(f'/{self.image_id}/')[0]['status'], 403)
+
+
+class SingleFlightThumbnails(TransactionTestCase):
+    plan = None
+    user = None
+    image = None
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def setUp(self) -> None:
+        self.plan = PlanTier.objects.create(name='SingleFlight', show_original_link=False,
+                                            create_expiring_link=False)
+        self.plan.thumbnail_sizes.add(ThumbnailSize.objects.create(height=50, width=0))
+        self.user = create_test_user_with_plan(self.plan)
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        upload_image_request('staticfiles/macara.jpg', 'macara', client)
+        self.image = ImageInstance.objects.get()
+        # thumbnails of the new size are missing in every following list request
+        self.plan.thumbnail_sizes.add(ThumbnailSize.objects.create(height=120, width=0))
+        plans.invalidate_plans()
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+        plans.invalidate_plans()
+
+    def list_images(self) -> dict:
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        try:
+            return client.get('/images/').data['results'][0]
+        finally:
+            connection.close()
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_concurrent_requests_render_once(self):
+        renders = []
+
+        def slow_generate(thumbnailer, options):
+            renders.append([option['size'] for option in options])
+            time.sleep(0.2)
+            return generate_thumbnails(thumbnailer, options)
+
+        barrier = threading.Barrier(8)
+
+        def request():
+            barrier.wait()
+            return self.list_images()
+
+        with mock.patch('image_browser.thumbnails.generate_thumbnails', slow_generate):
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                results = list(pool.map(lambda _: request(), range(8)))
+        self.assertEquals(renders, [[(0, 120)]])
+        self.assertEquals(len({result['thumbnail_120x0_url'] for result in results}), 1)
+        self.assertTrue(results[0]['thumbnail_120x0_url'].endswith('.jpg'))
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'), THUMBNAIL_RENDER_WAIT=0)
+    def test_waiting_request_gets_pending_url(self):
+        with key_lock(f'thumbnails:{self.image.image_file.name}'):
+            result = self.list_images()
+        self.assertTrue(result['thumbnail_120x0_url'].endswith(f'/{self.image.id}/thumbnails/120x0/'))
+        # rendered thumbnails keep their URLs
+        self.assertTrue(result['thumbnail_50x0_url'].endswith('.jpg'))
+        self.assertTrue(self.list_images()['thumbnail_120x0_url'].endswith('.jpg'))
+
+
+class ApiBenchmark(TestCase):
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_report_of_every_plan_and_endpoint(self):
+        report = run_benchmark([2, 3], users=3, requests=2, image_size=(120, 90))
+        self.assertEquals([result['library_size'] for result in report['results']], [2, 3])
+        self.assertEquals(ImageInstance.objects.count(), 9)
+        plans = report['results'][1]['plans']
+        self.assertEquals(set(plans), {'Basic', 'Premium', 'Enterprise'})
+        self.assertEquals(set(plans['Basic']), {'upload', 'list', 'detail'})
+        self.assertEquals(set(plans['Enterprise']), {'upload', 'list', 'detail', 'make_temp', 'temp'})
+        self.assertEquals(plans['Enterprise']['temp']['statuses'], {'200': 2})
+        self.assertGreater(plans['Basic']['list']['queries']['mean'], 0)
+        json.dumps(report)
+
+        rows = compare_reports(report, report)
+        self.assertIn((3, 'Basic', 'list', 'queries', plans['Basic']['list']['queries']['mean'],
+                       plans['Basic']['list']['queries']['mean']), rows)
+
+
+class Profiling(TestCase):
+    client = None
+    plan = None
+
+    def setUp(self) -> None:
+        self.plan = PlanTier.objects.create(name='Profiled', show_original_link=True, create_expiring_link=False)
+        self.plan.thumbnail_sizes.add(ThumbnailSize.objects.create(height=50, width=0))
+        self.client = APIClient()
+        self.client.force_authenticate(user=create_test_user_with_plan(self.plan))
+        profiling.metrics.clear()
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    @staticmethod
+    def get_server_timing(response) -> dict:
+        return {entry.split(';')[0]: entry for entry in re.findall(r'[\w-]+;dur=[\d.]+(?:;desc="[^"]*")?',
+                                                                   response['Server-Timing'])}
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'), PROFILING=True, PROFILING_SERVER_TIMING=True)
+    def test_request_sections_are_timed(self):
+        response = upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        timing = self.get_server_timing(response)
+        # original and its thumbnail
+        self.assertRegex(timing['storage_write'], r'desc="2 calls, \d+ bytes"$')
+        self.assertGreater(profiling.metrics.get('section_bytes_total', section='storage_write'),
+                           os.path.getsize('staticfiles/macara.jpg'))
+
+        # new plan size makes the list render the thumbnail
+        self.plan.thumbnail_sizes.add(ThumbnailSize.objects.create(height=20, width=0))
+        response = self.client.get('/images/')
+        timing = self.get_server_timing(response)
+        for section in ('sql', 'plan', 'serialize', 'storage_read', 'thumbnail_decode', 'thumbnail_resize',
+                        'thumbnail_encode', 'total'):
+            self.assertIn(section, timing)
+        self.assertRegex(timing['sql'], r'^sql;dur=[\d.]+;desc="\d+ calls"$')
+
+        self.assertEquals(profiling.metrics.get('requests_total', view='image-list', status='200'), 1)
+        self.assertEquals(profiling.metrics.get('section_calls_total', section='thumbnail_decode'), 2)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'), PROFILING=True)
+    def test_metrics_endpoint(self):
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        response = views.metrics(RequestFactory().get('/metrics'))
+        text = response.content.decode()
+        self.assertEquals(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        self.assertIn('# TYPE image_browser_requests_total counter', text)
+        self.assertRegex(text, r'image_browser_section_seconds_total\{section="sql"\} [\d.e-]+\n')
+
+        with self.assertRaises(Http404):
+            views.metrics(RequestFactory().get('/metrics', REMOTE_ADDR='10.0.0.1'))
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_disabled_by_default(self):
+        response = upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        self.assertFalse(response.has_header('Server-Timing'))
+        self.assertEquals(profiling.metrics.render(), '\n')
+
+    def test_asynchronous_requests_are_concurrent(self):
+        async def view(request):
+            await asyncio.sleep(0.3)
+            return HttpResponse()
+
+        middleware = profiling.ProfilingMiddleware(view)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+
+        async def send_requests():
+            return await asyncio.gather(*(middleware(RequestFactory().get('/')) for _ in range(5)))
+
+        for enabled in (False, True):
+            with override_settings(PROFILING=enabled, PROFILING_SERVER_TIMING=True):
+                started = time.perf_counter()
+                responses = async_to_sync(send_requests)()
+                self.assertLess(time.perf_counter() - started, 1)
+                self.assertEquals([response.has_header('Server-Timing') for response in responses], [enabled] * 5)
+
+
+class ThumbnailFormats(TestCase):
+    client = None
+    plan = None
+
+    def setUp(self) -> None:
+        self.plan = PlanTier.objects.create(name='Formats', show_original_link=False, create_expiring_link=False,
+                                            thumbnail_formats='webp,jpeg', thumbnail_quality=70)
+        self.plan.thumbnail_sizes.add(ThumbnailSize.objects.create(height=100, width=0))
+        self.client = APIClient()
+        self.client.force_authenticate(user=create_test_user_with_plan(self.plan))
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    @staticmethod
+    def open_thumbnail(url: str) -> Image.Image:
+        return Image.open(TEST_DIR + '/media/' + url.split('/media/', 1)[1])
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_format_is_negotiated_by_accept_header(self):
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        result = self.client.get('/images/', HTTP_ACCEPT='application/json, image/webp').data['results'][0]
+        self.assertTrue(result['thumbnail_100x0_url'].endswith('.webp'))
+        self.assertEquals(set(result['thumbnail_100x0_variants']), {'webp', 'jpeg'})
+        self.assertEquals(result['thumbnail_100x0_variants']['webp'], result['thumbnail_100x0_url'])
+        self.assertEquals(self.open_thumbnail(result['thumbnail_100x0_url']).format, 'WEBP')
+
+        response = self.client.get('/images/', HTTP_ACCEPT='application/json')
+        self.assertIn('Accept', response['Vary'])
+        result = response.data['results'][0]
+        self.assertEquals(result['thumbnail_100x0_url'], result['thumbnail_100x0_variants']['jpeg'])
+        jpeg = self.open_thumbnail(result['thumbnail_100x0_url'])
+        self.assertEquals((jpeg.format, jpeg.size[1]), ('JPEG', 100))
+        self.assertTrue(jpeg.info.get('progressive'))
+
+        image = ImageInstance.objects.get()
+        self.assertEquals(get_missing_thumbnails([image], self.plan.thumbnail_sizes.all(),
+                                                 get_plan_encodings(self.plan)), {})
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_plan_without_formats_keeps_default_format(self):
+        self.plan.thumbnail_formats = ''
+        self.plan.save()
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        result = self.client.get('/images/', HTTP_ACCEPT='application/json, image/webp').data['results'][0]
+        self.assertTrue(result['thumbnail_100x0_url'].endswith('.jpg'))
+        self.assertNotIn('thumbnail_100x0_variants', result)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'), THUMBNAIL_BACKGROUND_RENDERING=True)
+    def test_background_thumbnail_redirects_to_negotiated_format(self):
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        render_pending_jobs()
+        image_id = ImageInstance.objects.get().id
+        response = self.client.get(f'/{image_id}/thumbnails/100x0/', HTTP_ACCEPT='image/avif,image/webp,*/*')
+        self.assertEquals(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith('.webp'))
+        self.assertEquals(response['Vary'], 'Accept')
+        self.assertTrue(self.client.get(f'/{image_id}/thumbnails/100x0/', HTTP_ACCEPT='*/*')['Location']
+                        .endswith('.jpg'))
+        self.assertTrue(self.client.get(f'/{image_id}/thumbnails/100x0/?output=jpeg')['Location'].endswith('.jpg'))
+        self.assertEquals(self.client.get(f'/{image_id}/thumbnails/100x0/?output=gif').status_code, 404)
+
+    def test_accept_parsing_and_plan_validation(self):
+        encodings = get_plan_encodings(self.plan)
+        self.assertEquals(encodings, [ThumbnailEncoding('webp', 70), ThumbnailEncoding('jpeg', 70)])
+        self.assertEquals(choose_encoding(encodings, 'image/webp;q=0, image/jpeg'), encodings[1])
+        self.assertEquals(choose_encoding(encodings, 'image/*'), encodings[1])
+        self.assertIsNone(choose_encoding([], 'image/webp'))
+        with self.assertRaises(DjangoValidationError):
+            PlanTier(name='Gif', show_original_link=False, create_expiring_link=False,
+                     thumbnail_formats='webp,gif').full_clean()
+
+
+class DynamicRendering(TestCase):
+    client = None
+    plan = None
+    image = None
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def setUp(self) -> None:
+        self.plan = PlanTier.objects.create(name='Rendering', show_original_link=False, create_expiring_link=False,
+                                            render_max_dimension=500)
+        self.client = APIClient()
+        self.client.force_authenticate(user=create_test_user_with_plan(self.plan))
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        self.image = ImageInstance.objects.get()
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def render(self, query: str, **headers):
+        return self.client.get(f'/{self.image.id}/render/?{query}', **headers)
+
+    @staticmethod
+    def read_image(response) -> Image.Image:
+        return Image.open(BytesIO(b''.join(response.streaming_content)))
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_sizes_are_snapped_to_buckets_and_cached(self):
+        response = self.render('w=100')
+        self.assertEquals((response.status_code, response['X-Render-Cache']), (200, 'miss'))
+        self.assertEquals(self.read_image(response).size, (128, 96))
+
+        again = self.render('w=120')
+        self.assertEquals((again['X-Render-Cache'], again['ETag']), ('hit', response['ETag']))
+        self.assertEquals(self.render('w=120', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        # sizes above the biggest bucket below plan maximum are snapped to the maximum
+        self.assertEquals(self.read_image(self.render('w=300')).size, (500, 375))
+        cover = self.render('w=100&h=100&fit=cover')
+        self.assertEquals((cover['Content-Type'], self.read_image(cover).size), ('image/jpeg', (128, 128)))
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_snapping_keeps_requested_aspect_ratio(self):
+        for (width, height), size in (((300, 200), (500, 333)), ((30, 100), (38, 128)), ((100, 300), (167, 500))):
+            rendered = self.read_image(self.render(f'w={width}&h={height}&fit=cover'))
+            self.assertEquals(rendered.size, size)
+            self.assertAlmostEqual(rendered.width / rendered.height, width / height, places=2)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_requests_are_checked_against_plan(self):
+        self.assertEquals(self.render('w=501').status_code, 400)
+        self.assertEquals(self.render('h=0').status_code, 400)
+        self.assertEquals(self.render('w=100&fit=cover').status_code, 400)
+        self.assertEquals(self.render('w=100&fit=stretch').status_code, 400)
+        PlanTier.objects.filter(pk=self.plan.pk).update(render_max_dimension=0)
+        plans.invalidate_plans()
+        self.assertEquals(self.render('w=100').status_code, 403)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_concurrent_misses_render_once(self):
+        calls = []
+
+        def slow_render(*args):
+            calls.append(args)
+            time.sleep(0.2)
+            return b'rendered'
+
+        barrier = threading.Barrier(8)
+
+        def request():
+            barrier.wait()
+            return get_rendered_file(self.image, 128, 0, 'contain', None)
+
+        with mock.patch('image_browser.dynamic_rendering.render_image', slow_render):
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                results = list(pool.map(lambda _: request(), range(8)))
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(sorted(result.cached for result in results), [False] + [True] * 7)
+        self.assertEquals(len({result.path for result in results}), 1)
+
+    def test_cache_evicts_least_recently_used(self):
+        cache = RenderCache(TEST_DIR + '/cache', max_size=250)
+        paths = [cache.put(key * 64, 'jpg', b'x' * 100) for key in 'ab']
+        for age, path in zip((200, 100), paths):
+            os.utime(path, (time.time() - age, time.time() - age))
+        # reading the oldest file makes the other one least recently used
+        cache.get('a' * 64, 'jpg')
+        cache.put('c' * 64, 'jpg', b'x' * 100)
+        self.assertIsNotNone(cache.get('a' * 64, 'jpg'))
+        self.assertIsNone(cache.get('b' * 64, 'jpg'))
+        self.assertIsNotNone(cache.get('c' * 64, 'jpg'))
+
+
+def create_png_header(width: int, height: int) -> bytes:
+    """ Returns PNG with given dimensions in its header and no pixel data """
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(b'')) + chunk(b'IEND', b'')
+
+
+class DecodingPolicy(TestCase):
+    client = None
+    plan = None
+
+    def setUp(self) -> None:
+        self.plan = PlanTier.objects.create(name='Decoding', show_original_link=True, create_expiring_link=False,
+                                            max_image_pixels=1_000_000)
+        self.plan.thumbnail_sizes.add(ThumbnailSize.objects.create(height=50, width=0))
+        self.client = APIClient()
+        self.client.force_authenticate(user=create_test_user_with_plan(self.plan))
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+        plans.invalidate_plans()
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_too_large_images_are_refused_before_decoding(self):
+        # refused by Pillow already when the upload is validated as an image
+        bomb = SimpleUploadedFile('bomb.png', create_png_header(30000, 30000), content_type='image/png')
+        response = self.client.post('/images/upload', {'name': 'bomb', 'image_file': bomb}, format='multipart')
+        self.assertEquals(response.status_code, 400)
+        # below Pillow limit, refused by plan limit from the header
+        large = SimpleUploadedFile('large.png', create_png_header(8000, 8000), content_type='image/png')
+        response = self.client.post('/images/upload', {'name': 'large', 'image_file': large}, format='multipart')
+        self.assertEquals(response.status_code, 400)
+        self.assertIn('at most 1000000 pixels', str(response.data))
+
+        PlanTier.objects.filter(pk=self.plan.pk).update(max_image_pixels=500_000)
+        plans.invalidate_plans()
+        self.assertEquals(upload_image_request('staticfiles/macara.jpg', 'macara', self.client).status_code, 400)
+        self.assertFalse(ImageInstance.objects.exists())
+
+        # plan limit never exceeds global limit
+        with override_settings(IMAGE_MAX_PIXELS=800_000):
+            PlanTier.objects.filter(pk=self.plan.pk).update(max_image_pixels=0)
+            plans.invalidate_plans()
+            self.assertEquals(upload_image_request('staticfiles/macara.jpg', 'macara', self.client).status_code, 400)
+        self.assertEquals(upload_image_request('staticfiles/macara.jpg', 'macara', self.client).status_code, 201)
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_resumable_upload_is_refused_before_it_is_stored(self):
+        content = create_png_header(8000, 8000)
+        session_id = self.client.post('/images/uploads/', {'name': 'large', 'filename': 'large.png',
+                                                           'size': len(content)}, format='json').data['id']
+        self.client.put(f'/images/uploads/{session_id}/', content, content_type='application/octet-stream',
+                        HTTP_CONTENT_RANGE=f'bytes 0-{len(content) - 1}/{len(content)}')
+        response = self.client.post(f'/images/uploads/{session_id}/finalize')
+        self.assertEquals(response.status_code, 400)
+        self.assertIn('at most 1000000 pixels', str(response.data))
+        self.assertFalse(ImageInstance.objects.exists())
+        stored = [name for _, _, names in os.walk(TEST_DIR) for name in names]
+        self.assertNotIn('large.png', stored)
+        self.assertTrue(os.path.exists(get_part_path(UploadSession.objects.get())))
+
+    @override_settings(MEDIA_ROOT=(TEST_DIR + '/media'))
+    def test_decoded_size_is_limited_after_reduced_decoding(self):
+        upload_image_request('staticfiles/macara.jpg', 'macara', self.client)
+        thumbnailer = get_thumbnailer(ImageInstance.objects.get().image_file)
+        with override_settings(IMAGE_MAX_PIXELS=100_000):
+            with open_source_image(thumbnailer, [(0, 200)]) as (image, _):
+                self.assertEquals(image.size, (272, 204))
+            with self.assertRaises(ImageTooLarge):
+                with open_source_image(thumbnailer, [(0, 500)]):
+                    pass
+
+    def test_memory_budget_waits_for_released_memory(self):
+        budget = MemoryBudget(100)
+        events = []
+
+        def decode():
+            with budget.reserve(50):
+                events.append('second decoded')
+
+        with budget.reserve(80):
+            thread = threading.Thread(target=decode)
+            thread.start()
+            time.sleep(0.1)
+            events.append('first released')
+        thread.join()
+        self.assertEquals(events, ['first released', 'second decoded'])
+
+        # image bigger than the whole budget is decoded alone
+        with budget.reserve(500):
+            self.assertEquals(budget.available, 0)
+        self.assertEquals(budget.available, 100)
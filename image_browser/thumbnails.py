@@ -0,0 +1,363 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q, QuerySet
+from django.utils import timezone
+from easy_thumbnails.files import ThumbnailFile, get_thumbnailer
+from easy_thumbnails.models import Thumbnail
+
+from image_browser.encodings import ThumbnailEncoding, get_plan_encodings
+from image_browser.locks import key_lock
+from image_browser.models import ImageInstance, ThumbnailJob, ThumbnailSize, User
+from image_browser.rendering import generate_thumbnails, get_thumbnail_name
+from image_browser.similarity import store_thumbnail_perceptual_hash
+from image_browser.storage import get_storage_hash
+from image_browser.utils import get_plan_by_user
+
+# (image id, width, height) of a thumbnail
+ThumbnailKey = Tuple[int, int, int]
+# (image id, width, height, format) of a thumbnail in an output format ('' for default format)
+VariantKey = Tuple[int, int, int, str]
+
+# encodings of plans without output formats - only default format of easy_thumbnails
+DEFAULT_ENCODINGS = (None,)
+
+# number of names sent in one query for thumbnails lookup
+LOOKUP_BATCH_SIZE = 400
+
+# transparent 1x1 GIF served while thumbnail is not rendered yet
+PLACEHOLDER_GIF = (b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\x00\x00\x00'
+                   b'!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00'
+                   b'\x00\x02\x02D\x01\x00;')
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """ Returns local worker pool used for thumbnail rendering.
+        Threads are enough here - Pillow releases GIL while decoding and resizing. """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.THUMBNAIL_WORKERS,
+                                       thread_name_prefix='thumbnails')
+    return _executor
+
+
+def enqueue_thumbnails(image: ImageInstance, sizes: Iterable[ThumbnailSize]) -> List[ThumbnailJob]:
+    """ Creates pending jobs for given thumbnail sizes of an image
+        and hands them to the worker pool after transaction commit. """
+    return enqueue_images_thumbnails([image], sizes)
+
+
+def enqueue_images_thumbnails(images: List[ImageInstance], sizes: Iterable[ThumbnailSize]) -> List[ThumbnailJob]:
+    """ Creates pending jobs for given thumbnail sizes of all images at once """
+    sizes = list(sizes)
+    jobs = [ThumbnailJob(image=image, width=size.width, height=size.height) for image in images for size in sizes]
+    ThumbnailJob.objects.bulk_create(jobs, ignore_conflicts=True)
+    if sizes:
+        # rendered jobs are repeated, e.g. when thumbnails of new plan formats are missing
+        same_sizes = Q()
+        for size in sizes:
+            same_sizes |= Q(width=size.width, height=size.height)
+        ThumbnailJob.objects.filter(same_sizes, image__in=images).exclude(status=ThumbnailJob.PENDING) \
+            .update(status=ThumbnailJob.PENDING, error='', attempts=0)
+    jobs = list(ThumbnailJob.objects.filter(image__in=images, status=ThumbnailJob.PENDING))
+    job_ids = [job.id for job in jobs]
+    transaction.on_commit(lambda: submit_jobs(job_ids))
+    return jobs
+
+
+def submit_jobs(job_ids: Iterable[int]) -> None:
+    """ Submits jobs with given ids to the local worker pool """
+    executor = get_executor()
+    for job_id in job_ids:
+        executor.submit(_run_in_worker, job_id)
+
+
+def _run_in_worker(job_id: int) -> None:
+    try:
+        render_thumbnail_job(job_id)
+    finally:
+        # worker threads open their own connections, they have to be released
+        connection.close()
+
+
+def claim_jobs(job_id: int) -> List[ThumbnailJob]:
+    """ Marks pending job, with other pending jobs of the same image, as running.
+        Jobs locked by another worker (or not pending anymore) are skipped.
+        :return claimed jobs """
+    with transaction.atomic():
+        job = (ThumbnailJob.objects.select_for_update(skip_locked=True)
+               .select_related('image__owner')
+               .filter(pk=job_id, status=ThumbnailJob.PENDING)
+               .first())
+        if job is None:
+            return []
+        jobs = [job] + list(ThumbnailJob.objects.select_for_update(skip_locked=True)
+                            .filter(image_id=job.image_id, status=ThumbnailJob.PENDING)
+                            .exclude(pk=job.pk))
+        ThumbnailJob.objects.filter(pk__in=[job.pk for job in jobs]) \
+            .update(status=ThumbnailJob.RUNNING, attempts=F('attempts') + 1, updated=timezone.now())
+    for job in jobs:
+        job.status = ThumbnailJob.RUNNING
+        job.attempts += 1
+    return jobs
+
+
+def render_thumbnail_job(job_id: int) -> List[ThumbnailJob]:
+    """ Renders thumbnail of a pending job and saves its status.
+        Other pending jobs of the same image are rendered together with it, decoding the original once.
+        Jobs are claimed and saved in short transactions, no row is locked while they are rendered.
+        :return processed jobs """
+    jobs = claim_jobs(job_id)
+    if not jobs:
+        return []
+    image = jobs[0].image
+    try:
+        # thumbnails are rendered in all formats of the owner's plan, job keeps name of the preferred one
+        encodings = get_plan_encodings(get_plan_by_user(image.owner)) or DEFAULT_ENCODINGS
+        names = render_thumbnails_once(image, [ThumbnailSize(width=job.width, height=job.height) for job in jobs],
+                                       encodings)
+        for job in jobs:
+            job.thumbnail_name = names[(job.width, job.height, get_format_code(encodings[0]))]
+            job.status = ThumbnailJob.READY
+            job.error = ''
+    except Exception as e:
+        for job in jobs:
+            job.status = ThumbnailJob.FAILED
+            job.error = str(e)
+    with transaction.atomic():
+        for job in jobs:
+            # job enqueued again while it was rendered stays pending
+            ThumbnailJob.objects.filter(pk=job.pk, status=ThumbnailJob.RUNNING).update(
+                status=job.status, thumbnail_name=job.thumbnail_name, error=job.error, updated=timezone.now())
+        # listed statuses of thumbnails changed
+        User.bump_library_version(image.owner_id)
+    return jobs
+
+
+def retry_jobs() -> int:
+    """ Makes pending again jobs which failed (after THUMBNAIL_JOB_RETRY_DELAY, up to THUMBNAIL_JOB_MAX_ATTEMPTS)
+        or kept running over THUMBNAIL_JOB_TIMEOUT because their worker died.
+        :return number of retried jobs """
+    now = timezone.now()
+    failed = Q(status=ThumbnailJob.FAILED, attempts__lt=settings.THUMBNAIL_JOB_MAX_ATTEMPTS,
+               updated__lt=now - timedelta(seconds=settings.THUMBNAIL_JOB_RETRY_DELAY))
+    abandoned = Q(status=ThumbnailJob.RUNNING, updated__lt=now - timedelta(seconds=settings.THUMBNAIL_JOB_TIMEOUT))
+    return ThumbnailJob.objects.filter(failed | abandoned).update(status=ThumbnailJob.PENDING, updated=now)
+
+
+def render_pending_jobs(limit: int = 100) -> int:
+    """ Renders up to `limit` pending jobs in current process, failed and abandoned jobs are retried first.
+        :return number of processed jobs """
+    retry_jobs()
+    job_ids = (ThumbnailJob.objects.filter(status=ThumbnailJob.PENDING)
+               .order_by('id')
+               .values_list('id', flat=True)[:limit])
+    return sum(len(render_thumbnail_job(job_id)) for job_id in list(job_ids))
+
+
+def get_format_code(encoding: Optional[ThumbnailEncoding]) -> str:
+    return encoding.format if encoding else ''
+
+
+def get_existing_thumbnails(images: Iterable[ImageInstance], sizes: Iterable[ThumbnailSize],
+                            encodings: Optional[Sequence[Optional[ThumbnailEncoding]]] = None) -> Dict[tuple, str]:
+    """ Finds already rendered thumbnails of given images in easy_thumbnails cache table.
+        Whole page of images is looked up at once instead of querying (or checking storage)
+        for every image and size separately.
+        :return names of found thumbnails by (image id, width, height) - or by (image id, width, height, format)
+                if encodings are given """
+    sizes = list(sizes)
+    with_format = encodings is not None
+    encodings = DEFAULT_ENCODINGS if encodings is None else encodings
+    candidates: Dict[str, List[tuple]] = {}
+    storage_hash = None
+    for image in images:
+        thumbnailer = get_thumbnailer(image.image_file)
+        storage_hash = storage_hash or get_storage_hash(thumbnailer.thumbnail_storage)
+        for size in sizes:
+            for encoding in encodings:
+                key = (image.id, size.width, size.height)
+                if with_format:
+                    key += (get_format_code(encoding),)
+                options = thumbnailer.get_options(image.get_thumbnail_options(size.width, size.height, encoding))
+                # thumbnail of transparent image has different extension (unless it has output format),
+                # JPEG is never transparent
+                for transparent in ((False,) if image.format == 'JPEG' or encoding else (False, True)):
+                    name = get_thumbnail_name(thumbnailer, options, transparent=transparent)
+                    candidates.setdefault(name, []).append(key)
+
+    names = list(candidates)
+    found = {}
+    for start in range(0, len(names), LOOKUP_BATCH_SIZE):
+        batch = names[start:start + LOOKUP_BATCH_SIZE]
+        for name in Thumbnail.objects.filter(storage_hash=storage_hash, name__in=batch) \
+                .values_list('name', flat=True):
+            for key in candidates[name]:
+                found[key] = name
+    return found
+
+
+def get_manifest_thumbnails(images: Iterable[ImageInstance], sizes: Iterable[ThumbnailSize],
+                            encodings: Sequence[Optional[ThumbnailEncoding]]) -> Dict[VariantKey, str]:
+    """ Returns names of thumbnails listed in manifests of given images, without any query or storage access
+        :return names of found thumbnails by (image id, width, height, format) """
+    sizes = list(sizes)
+    found = {}
+    for image in images:
+        for size in sizes:
+            for encoding in encodings:
+                name = image.thumbnail_manifest.get(image.get_manifest_key(size.width, size.height, encoding))
+                if name:
+                    found[(image.id, size.width, size.height, get_format_code(encoding))] = name
+    return found
+
+
+def add_manifest_entries(image: ImageInstance, names: Dict[Tuple[int, int, str], str],
+                         encodings: Sequence[Optional[ThumbnailEncoding]]) -> bool:
+    """ Adds thumbnails named by (width, height, format) to the manifest of the image (not saved).
+        :return True if the manifest changed """
+    encodings_by_code = {get_format_code(encoding): encoding for encoding in encodings}
+    entries = {image.get_manifest_key(width, height, encodings_by_code[code]): name
+               for (width, height, code), name in names.items() if code in encodings_by_code}
+    if all(image.thumbnail_manifest.get(key) == name for key, name in entries.items()):
+        return False
+    image.thumbnail_manifest = {**image.thumbnail_manifest, **entries}
+    return True
+
+
+def store_manifest_entries(image: ImageInstance, names: Dict[Tuple[int, int, str], str],
+                           encodings: Sequence[Optional[ThumbnailEncoding]]) -> None:
+    """ Adds thumbnails to the manifest of the image and saves it, if any of them is new.
+        Manifest is only a cache of easy_thumbnails table - entry lost by concurrent update is found there again. """
+    if add_manifest_entries(image, names, encodings):
+        ImageInstance.objects.filter(pk=image.pk).update(thumbnail_manifest=image.thumbnail_manifest)
+
+
+def get_thumbnail_names(images: List[ImageInstance], sizes: Iterable[ThumbnailSize],
+                        encodings: Sequence[Optional[ThumbnailEncoding]]) -> Dict[VariantKey, str]:
+    """ Returns names of rendered thumbnails of given images from their manifests.
+        Images with incomplete manifests (uploaded before manifests, or missing new plan sizes) are looked up
+        in easy_thumbnails table and found thumbnails are added to their manifests, in one query.
+        :return names of found thumbnails by (image id, width, height, format) """
+    sizes = list(sizes)
+    names = get_manifest_thumbnails(images, sizes, encodings)
+    incomplete = [image for image in images
+                  if any((image.id, size.width, size.height, get_format_code(encoding)) not in names
+                         for size in sizes for encoding in encodings)]
+    if not incomplete:
+        return names
+    existing = get_existing_thumbnails(incomplete, sizes, encodings)
+    names.update(existing)
+    image_names: Dict[int, Dict[Tuple[int, int, str], str]] = {}
+    for (image_id, width, height, code), name in existing.items():
+        image_names.setdefault(image_id, {})[(width, height, code)] = name
+    updated = [image for image in incomplete
+               if image.id in image_names and add_manifest_entries(image, image_names[image.id], encodings)]
+    if updated:
+        ImageInstance.objects.bulk_update(updated, ['thumbnail_manifest'])
+    return names
+
+
+def get_thumbnail_variant_name(image: ImageInstance, width: int, height: int, encoding: ThumbnailEncoding) -> str:
+    """ Returns name of thumbnail in output format - it does not depend on transparency of the image """
+    thumbnailer = get_thumbnailer(image.image_file)
+    return get_thumbnail_name(thumbnailer, thumbnailer.get_options(image.get_thumbnail_options(width, height,
+                                                                                               encoding)))
+
+
+def get_thumbnail_statuses(images: Iterable[ImageInstance]) -> Dict[ThumbnailKey, str]:
+    """ Returns background rendering statuses of thumbnails of given images in one query """
+    jobs = ThumbnailJob.objects.filter(image__in=list(images)).values_list('image_id', 'width', 'height', 'status')
+    return {(image_id, width, height): status for image_id, width, height, status in jobs}
+
+
+def get_missing_thumbnails(images: Iterable[ImageInstance], sizes: Iterable[ThumbnailSize],
+                           encodings: Sequence[Optional[ThumbnailEncoding]] = DEFAULT_ENCODINGS
+                           ) -> Dict[int, List[ThumbnailSize]]:
+    """ Returns sizes which are not rendered yet (in some of given encodings) for every given image id """
+    images, sizes = list(images), list(sizes)
+    existing = get_existing_thumbnails(images, sizes, list(encodings))
+    missing = {}
+    for image in images:
+        image_sizes = [size for size in sizes
+                       if any((image.id, size.width, size.height, get_format_code(encoding)) not in existing
+                              for encoding in encodings)]
+        if image_sizes:
+            missing[image.id] = image_sizes
+    return missing
+
+
+def render_thumbnails(image: ImageInstance, sizes: Iterable[ThumbnailSize]) -> Dict[Tuple[int, int], ThumbnailFile]:
+    """ Renders and saves thumbnails of given sizes of an image, decoding the original only once.
+        :return saved thumbnails by (width, height) """
+    return {(width, height): thumbnail
+            for (width, height, _), thumbnail in render_thumbnail_variants(image, sizes, DEFAULT_ENCODINGS).items()}
+
+
+def render_thumbnail_variants(image: ImageInstance, sizes: Iterable[ThumbnailSize],
+                              encodings: Sequence[Optional[ThumbnailEncoding]]
+                              ) -> Dict[Tuple[int, int, str], ThumbnailFile]:
+    """ Renders and saves thumbnails of given sizes of an image in every given encoding.
+        The original is decoded only once and every size is scaled once for all encodings.
+        :return saved thumbnails by (width, height, format) """
+    variants = [(size, encoding) for size in sizes for encoding in encodings]
+    if not variants:
+        return {}
+    thumbnailer = get_thumbnailer(image.image_file)
+    thumbnails = generate_thumbnails(thumbnailer, [image.get_thumbnail_options(size.width, size.height, encoding)
+                                                   for size, encoding in variants])
+    rendered = {}
+    for (size, encoding), thumbnail in zip(variants, thumbnails):
+        thumbnailer.save_thumbnail(thumbnail)
+        rendered[(size.width, size.height, get_format_code(encoding))] = thumbnail
+    store_manifest_entries(image, {key: thumbnail.name for key, thumbnail in rendered.items()}, encodings)
+    # decoded thumbnails are small enough to hash the image without decoding the original again
+    store_thumbnail_perceptual_hash(image, [thumbnail.image for thumbnail in thumbnails])
+    return rendered
+
+
+def render_thumbnails_once(image: ImageInstance, sizes: Iterable[ThumbnailSize],
+                           encodings: Sequence[Optional[ThumbnailEncoding]] = DEFAULT_ENCODINGS,
+                           timeout: Optional[float] = None) -> Dict[Tuple[int, int, str], str]:
+    """ Renders thumbnails of an image which are not rendered yet, in one process (and thread) at a time.
+        Concurrent requests of a new image wait for the first one and find its thumbnails already rendered,
+        instead of decoding the original again and writing the same files.
+        Lock is held per original, so images sharing a deduplicated original share it too.
+        :return names of thumbnails of all given sizes and encodings by (width, height, format)
+        :raises LockTimeout if thumbnails are rendered by someone else for longer than `timeout` seconds """
+    sizes = list(sizes)
+    with key_lock(f'thumbnails:{image.image_file.name}', timeout):
+        names = {(width, height, code): name for (_, width, height, code), name
+                 in get_existing_thumbnails([image], sizes, encodings).items()}
+        missing = [size for size in sizes
+                   if any((size.width, size.height, get_format_code(encoding)) not in names for encoding in encodings)]
+        # thumbnails rendered for another image sharing the original are added to the manifest too
+        store_manifest_entries(image, names, encodings)
+        for key, thumbnail in render_thumbnail_variants(image, missing, encodings).items():
+            names[key] = thumbnail.name
+    return names
+
+
+def enqueue_missing_thumbnails(images: QuerySet, sizes: Iterable[ThumbnailSize],
+                               encodings: Sequence[Optional[ThumbnailEncoding]] = DEFAULT_ENCODINGS,
+                               batch_size: int = 500) -> int:
+    """ Creates background rendering jobs for thumbnails of given images which are not rendered yet
+        (in some of given encodings).
+        :return number of queued thumbnails """
+    sizes = list(sizes)
+    queued = 0
+    last_id = 0
+    while True:
+        batch = list(images.filter(id__gt=last_id).order_by('id')[:batch_size])
+        if not batch:
+            return queued
+        missing = get_missing_thumbnails(batch, sizes, encodings)
+        for image in batch:
+            if image.id in missing:
+                queued += len(enqueue_thumbnails(image, missing[image.id]))
+        last_id = batch[-1].id
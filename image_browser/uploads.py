@@ -0,0 +1,238 @@
+""" Resumable uploads.
+    Client creates an upload session, sends the file in byte ranges (each appended to a part file on disk)
+    and finalizes the session, which moves the part file into the storage as a new ImageInstance
+    (or drops it, if deduplicated original with the same content is already stored). """
+import os
+import re
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.exceptions import NotFound, ValidationError
+
+from image_browser import decoding
+from image_browser.locks import LockTimeout, key_lock
+from image_browser.models import (ImageBlob, ImageInstance, UploadSession, get_image_signature_format,
+                                  store_blob_file, user_directory_path)
+from image_browser.responses import CHUNK_SIZE
+from image_browser.storage import is_local
+from image_browser.utils import cut_image_name
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+# number of leading bytes checked before anything is written
+SIGNATURE_LENGTH = 8
+
+# formats of images by file name extension
+EXTENSION_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG'}
+
+
+class UploadConflict(Exception):
+    """ Raised when received range does not continue already received part of the file """
+
+    def __init__(self, received: int):
+        super().__init__(f'Upload has to continue from byte {received}')
+        self.received = received
+
+
+def get_upload_dir() -> str:
+    # part files are kept next to media files by default, so finalizing moves them without copying
+    return settings.UPLOAD_SESSION_DIR or os.path.join(settings.MEDIA_ROOT, '.uploads')
+
+
+def get_part_path(session: UploadSession) -> str:
+    return os.path.join(get_upload_dir(), f'{session.id}.part')
+
+
+def parse_content_range(header: Optional[str]) -> Tuple[int, int, int]:
+    """ Parses Content-Range header of uploaded chunk.
+        :return first byte, last byte and size of the whole file """
+    match = CONTENT_RANGE_RE.match(header.strip()) if header else None
+    if not match:
+        raise ValidationError('Content-Range header "bytes FIRST-LAST/SIZE" is required')
+    start, end, size = (int(value) for value in match.groups())
+    if start > end:
+        raise ValidationError('Invalid Content-Range')
+    return start, end, size
+
+
+def get_session_lock_key(session: UploadSession) -> str:
+    return f'upload:{session.pk}'
+
+
+@contextmanager
+def session_lock(session: UploadSession):
+    """ Holds lock of the session, so its ranges and finalization are not processed concurrently
+        (e.g. with a retried request). Session is reloaded under the lock.
+        :raises UploadConflict if another request of the session is being processed
+        :raises NotFound if the session was finalized or deleted in the meantime """
+    try:
+        with key_lock(get_session_lock_key(session), timeout=0):
+            try:
+                session.refresh_from_db()
+            except UploadSession.DoesNotExist:
+                raise NotFound('Upload session does not exist')
+            yield
+    except LockTimeout:
+        raise UploadConflict(session.received)
+
+
+def write_chunk(session: UploadSession, stream, content_range: Optional[str]) -> UploadSession:
+    """ Appends chunk read from request stream to the part file of the session.
+        Chunk is written while it is received, without keeping it in memory.
+        :raises UploadConflict if chunk does not start where received part ends
+                               or another request of the session is being processed """
+    start, end, size = parse_content_range(content_range)
+    with session_lock(session):
+        _write_chunk(session, stream, start, end, size)
+    return session
+
+
+def _write_chunk(session: UploadSession, stream, start: int, end: int, size: int) -> None:
+    if size != session.size or end >= size:
+        raise ValidationError(f'Range has to lie within the declared file size {session.size}')
+    if start != session.received:
+        raise UploadConflict(session.received)
+
+    length = end - start + 1
+    if start == 0 and length < min(SIGNATURE_LENGTH, size):
+        raise ValidationError(f'First chunk has to contain at least {SIGNATURE_LENGTH} bytes')
+    os.makedirs(get_upload_dir(), exist_ok=True)
+    with open(get_part_path(session), 'r+b' if start else 'wb') as part:
+        part.seek(start)
+        part.truncate()
+        read = written = 0
+        header = b''
+        while read < length:
+            chunk = stream.read(min(CHUNK_SIZE, length - read)) if stream else b''
+            if not chunk:
+                break
+            read += len(chunk)
+            if start == 0 and written == 0:
+                # nothing is written before leading bytes of the file are checked
+                header += chunk
+                if len(header) < SIGNATURE_LENGTH and read < length:
+                    continue
+                validate_signature(session, header)
+                chunk = header
+            part.write(chunk)
+            written += len(chunk)
+
+    UploadSession.objects.filter(pk=session.pk).update(received=start + written)
+    session.received = start + written
+
+
+def validate_signature(session: UploadSession, header: bytes) -> None:
+    """ Checks leading bytes of uploaded file, so a file which is not an image is refused at its first chunk """
+    extension = os.path.splitext(session.filename)[1].lower()
+    if get_image_signature_format(header) != EXTENSION_FORMATS.get(extension):
+        raise ValidationError('file content is not a .jpg or .png image matching its extension')
+
+
+def finalize_upload(session: UploadSession) -> ImageInstance:
+    """ Creates ImageInstance of completely received file.
+        Part file is moved into the storage when it is local, so the file is not copied again.
+        :raises UploadConflict if another request of the session is being processed """
+    with session_lock(session):
+        return _finalize_upload(session)
+
+
+def _finalize_upload(session: UploadSession) -> ImageInstance:
+    if session.received != session.size:
+        raise ValidationError(f'Only {session.received} of {session.size} bytes were received')
+    part_path = get_part_path(session)
+    image = ImageInstance(owner=session.owner, name=session.name or cut_image_name(session.filename))
+    try:
+        with decoding.open_image(part_path) as part_image:
+            # pixel limit of the owner is checked before the part is stored
+            decoding.check_pixels(part_image.size, image.get_max_pixels())
+            part_image.verify()
+    except decoding.ImageTooLarge as e:
+        raise ValidationError(str(e))
+    except Exception:
+        raise ValidationError('Uploaded file is not a valid image')
+
+    if settings.IMAGE_DEDUPLICATION:
+        with open(part_path, 'rb') as part:
+            image.image_file = File(part, name=session.filename)
+            image.read_file_metadata()
+            with transaction.atomic():
+                ImageBlob.acquire(image, lambda name: store_part_file(image.image_file.storage, part_path, name))
+                image.save()
+        os.remove(part_path)
+        session.delete()
+        return image
+
+    storage = image.image_file.storage
+    if is_local(storage):
+        image.image_file.name = move_into_storage(storage, part_path, user_directory_path(image, session.filename))
+    else:
+        # remote storage - file has to be uploaded
+        with open(part_path, 'rb') as part:
+            image.image_file.save(session.filename, File(part), save=False)
+    os.remove(part_path)
+    image.read_file_metadata()
+    image.save()
+    session.delete()
+    return image
+
+
+def store_part_file(storage, part_path: str, name: str) -> None:
+    """ Stores part file as a blob, linking it into local storage without copying (when it is on the same
+        file system) """
+    if is_local(storage):
+        target_path = storage.path(name)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        try:
+            os.link(part_path, target_path)
+            return
+        except FileExistsError:
+            # blob file has the same content
+            return
+        except OSError:
+            # upload directory on another file system (or one without hard links) - the file is copied
+            pass
+    with open(part_path, 'rb') as part:
+        store_blob_file(storage, name, File(part))
+
+
+def move_into_storage(storage, path: str, name: str) -> str:
+    """ Links file into local storage under available name, without copying its content.
+        Linking fails if the name was taken in the meantime, so then another name is tried.
+        File on another file system (or one without hard links) is copied by the storage.
+        :return name of the file in the storage """
+    while True:
+        available_name = storage.get_available_name(name)
+        target_path = storage.path(available_name)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        try:
+            os.link(path, target_path)
+        except FileExistsError:
+            continue
+        except OSError:
+            with open(path, 'rb') as file:
+                return storage.save(name, File(file))
+        return available_name
+
+
+def discard_session(session: UploadSession) -> None:
+    """ Deletes upload session with its part file, after its request being processed (if any) ends """
+    with key_lock(get_session_lock_key(session)):
+        try:
+            os.remove(get_part_path(session))
+        except FileNotFoundError:
+            pass
+        UploadSession.objects.filter(pk=session.pk).delete()
+
+
+def delete_stale_sessions(max_age: timedelta) -> int:
+    """ Deletes upload sessions (with their part files) not finalized for `max_age`.
+        :return number of deleted sessions """
+    stale = list(UploadSession.objects.filter(created__lt=timezone.now() - max_age))
+    for session in stale:
+        discard_session(session)
+    return len(stale)
@@ -1,7 +1,11 @@
+from django.db.models import Q, QuerySet
 from django.urls import reverse
 from rest_framework.request import Request
 
-from image_browser.models import User, PlanTier, AppUser, ImageInstance
+from image_browser import profiling
+from image_browser.builtin_plans import enterprise_plan
+from image_browser.models import User, PlanTier, ImageInstance
+from image_browser.plans import get_plan, get_user_plan_name
 
 
 def cut_image_name(name: str) -> str:
@@ -10,11 +14,22 @@ def cut_image_name(name: str) -> str:
     return name if len(name) <= 50 else '...' + name[len(name) - 47:]
 
 
+@profiling.timed('plan')
 def get_plan_by_user(user: User) -> PlanTier:
-    """ Gets user plan for authenticated user """
+    """ Gets user plan for authenticated user.
+        Plans are cached (see image_browser.plans), so in steady state it does not query the database. """
     if user.is_staff:
-        return PlanTier.objects.get(name='Enterprise')
-    return AppUser.objects.get(user=user).plan
+        return get_plan(enterprise_plan.name)
+    return get_plan(get_user_plan_name(user.id))
+
+
+def get_plan_images(plan: PlanTier) -> QuerySet:
+    """ Gets images of all users with given plan """
+    owners = Q(owner__appuser__plan=plan)
+    if plan.name == enterprise_plan.name:
+        # staff users always use enterprise plan
+        owners |= Q(owner__is_staff=True)
+    return ImageInstance.objects.filter(owners)
 
 
 def create_expiring_link(image_instance: ImageInstance, request: Request) -> str:
@@ -1,18 +1,42 @@
+import hashlib
+import posixpath
+import time
 from datetime import timedelta
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, HttpResponse, HttpResponseRedirect, Http404
+from django.utils.cache import get_conditional_response
 from django.utils import timezone
+from easy_thumbnails.models import Thumbnail
 from rest_framework import generics, permissions, status
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from rest_framework.generics import get_object_or_404
+from rest_framework.parsers import MultiPartParser
 from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
 
-from image_browser.models import ImageInstance, TempUrl
-from image_browser.permissions import IsOwnerOrAdmin, CanCreateExpiringLink, IsOwnerByUrlImageId
+from image_browser.batch_upload import iter_archive, upload_batch
+from image_browser.caching import ConditionalGetMixin, get_media_cache_control
+from image_browser.decoding import ImageTooLarge
+from image_browser.dynamic_rendering import get_rendered_file, parse_render_request
+from image_browser.encodings import choose_encoding, get_plan_encodings
+from image_browser.links import sign_image_link, unsign_image_link
+from image_browser.models import ImageInstance, TempUrl, ThumbnailJob, ThumbnailSize, User, UploadSession
+from image_browser.pagination import ImageCursorPagination
+from image_browser.profiling import metrics as profiling_metrics
+from image_browser.permissions import IsOwnerOrAdmin, CanCreateExpiringLink, IsOwnerByUrlImageId, CanSeeOriginal
+from image_browser.responses import stream_file, stream_stored_file, get_content_etag
 from image_browser.serializers import PostImageInstanceSerializer, TempLinkSerializer, \
-    ShowTempLinkSerializer, ArbitraryPlanSerializer
-from image_browser.utils import cut_image_name
+    ShowTempLinkSerializer, ArbitraryPlanSerializer, UploadSessionSerializer
+from image_browser.similarity import find_similar_images
+from image_browser.storage import get_file_stat, get_image_storage
+from image_browser.thumbnails import enqueue_thumbnails, enqueue_images_thumbnails, get_thumbnail_variant_name, \
+    PLACEHOLDER_GIF
+from image_browser.uploads import UploadConflict, discard_session, finalize_upload, write_chunk
+from image_browser.utils import cut_image_name, get_plan_by_user
 
 
 class ApiRoot(generics.GenericAPIView):
@@ -21,10 +45,23 @@ class ApiRoot(generics.GenericAPIView):
     def get(self, request, *args, **kwargs):
         return Response({
             'image-list': reverse(ImageInstanceList.name, request=request),
-            'upload-image': reverse(ImageInstanceCreation.name, request=request)
+            'upload-image': reverse(ImageInstanceCreation.name, request=request),
+            'upload-batch': reverse(ImageBatchCreation.name, request=request),
+            'upload-session': reverse(UploadSessionCreation.name, request=request),
         })
 
 
+def uploaded_image_response(request: Request, image: ImageInstance, headers=None) -> Response:
+    """ Response to finished upload of an image """
+    # thumbnails are rendered by worker pool, response does not wait for them
+    if settings.THUMBNAIL_BACKGROUND_RENDERING:
+        enqueue_thumbnails(image, get_plan_by_user(request.user).thumbnail_sizes.all())
+
+    # after upload user has to see links dependent on plan
+    new_data = ArbitraryPlanSerializer(image, context={'request': request}).data
+    return Response(new_data, status=status.HTTP_201_CREATED, headers=headers)
+
+
 class ImageInstanceCreation(generics.CreateAPIView):
     """ Create ImageInstance - here one can upload their image"""
     permission_classes = [permissions.IsAuthenticated]
@@ -38,12 +75,7 @@ class ImageInstanceCreation(generics.CreateAPIView):
         serializer.is_valid(raise_exception=True)
         created = self.perform_create(serializer)
         headers = self.get_success_headers(serializer.validated_data)
-        new_context = {'request': request}
-
-        # after upload user has to see links dependent on plan
-        view_serializer = ArbitraryPlanSerializer
-        new_data = view_serializer(created, context=new_context).data
-        return Response(new_data, status=status.HTTP_201_CREATED, headers=headers)
+        return uploaded_image_response(request, created, headers)
 
     def perform_create(self, serializer):
         owner = self.request.user
@@ -56,25 +88,243 @@ class ImageInstanceCreation(generics.CreateAPIView):
         return serializer.save(owner=owner, name=name)
 
 
-class ImageInstanceDetail(generics.RetrieveAPIView):
+class ImageBatchCreation(generics.GenericAPIView):
+    """ Upload of many images at once - as multiple `image_file` parts or as zip/tar `archive`.
+        Every file gets its own result, invalid files do not stop the others. """
+    permission_classes = [permissions.IsAuthenticated]
+    parser_classes = [MultiPartParser]
+    name = 'upload-batch'
+
+    def post(self, request, *args, **kwargs):
+        files = [(file.name, file) for file in request.FILES.getlist('image_file')]
+        if len(files) > settings.BATCH_UPLOAD_MAX_FILES:
+            raise ValidationError(f'At most {settings.BATCH_UPLOAD_MAX_FILES} images can be uploaded at once')
+        if 'archive' in request.FILES:
+            try:
+                for name, file in iter_archive(request.FILES['archive'], settings.BATCH_UPLOAD_MAX_FILES - len(files),
+                                               settings.BATCH_UPLOAD_MAX_SIZE):
+                    files.append((name, file))
+            except ValidationError:
+                for _, file in files:
+                    file.close()
+                raise
+        if not files:
+            raise ValidationError('No image_file or archive was sent')
+
+        items = upload_batch(request.user, files)
+        images = [item.image for item in items if item.image]
+        if settings.THUMBNAIL_BACKGROUND_RENDERING:
+            enqueue_images_thumbnails(images, get_plan_by_user(request.user).thumbnail_sizes.all())
+
+        # plan and thumbnails are resolved once for all images
+        representations = iter(ArbitraryPlanSerializer(images, many=True, context={'request': request}).data)
+        results = [dict(next(representations), filename=item.filename) if item.image
+                   else {'filename': item.filename, 'errors': item.errors}
+                   for item in items]
+        if len(images) == len(items):
+            response_status = status.HTTP_201_CREATED
+        else:
+            response_status = status.HTTP_207_MULTI_STATUS if images else status.HTTP_400_BAD_REQUEST
+        return Response({'results': results}, status=response_status)
+
+
+class UploadSessionCreation(generics.CreateAPIView):
+    """ Start of resumable upload - declares name and size of the file which is then sent in ranges """
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = UploadSessionSerializer
+    name = 'upload-session'
+
+    def perform_create(self, serializer):
+        serializer.save(owner=self.request.user)
+
+
+class UploadSessionDetail(generics.RetrieveDestroyAPIView):
+    """ Resumable upload session. GET shows how many bytes were received,
+        PUT with Content-Range header sends the next range of the file. """
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = UploadSessionSerializer
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(owner=self.request.user)
+
+    def put(self, request, *args, **kwargs):
+        session = self.get_object()
+        try:
+            # body is read as a stream, it is not parsed or buffered by the request
+            write_chunk(session, request.stream, request.META.get('HTTP_CONTENT_RANGE'))
+        except UploadConflict as e:
+            return Response({'detail': str(e), 'received': e.received}, status=status.HTTP_409_CONFLICT)
+        return Response(self.get_serializer(session).data)
+
+    def perform_destroy(self, session):
+        discard_session(session)
+
+
+class UploadSessionFinalization(generics.GenericAPIView):
+    """ End of resumable upload - received file becomes an image """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(owner=self.request.user)
+
+    def post(self, request, *args, **kwargs):
+        try:
+            image = finalize_upload(self.get_object())
+        except UploadConflict as e:
+            return Response({'detail': str(e), 'received': e.received}, status=status.HTTP_409_CONFLICT)
+        return uploaded_image_response(request, image)
+
+
+class ImageInstanceDetail(ConditionalGetMixin, generics.RetrieveAPIView):
     """ View od ImageInstance detail - visible fields are dependent on the user plan"""
 
     serializer_class = ArbitraryPlanSerializer
 
     # user has to be authenticated and be owner of given image
+    permission_classes = [permissions.IsAuthenticated, IsOwnerOrAdmin]
+    queryset = ImageInstance.objects.select_related('owner')
+
+    def get_object(self):
+        # image is needed for ETag before the response is created
+        if not hasattr(self, '_object'):
+            self._object = super().get_object()
+        return self._object
+
+    def get_library_version(self) -> int:
+        return self.get_object().owner.library_version
+
+
+class ImageOriginal(generics.RetrieveAPIView):
+    """ Original file of ImageInstance, for its owner with original links in the plan.
+        Django only authorizes the request - with MEDIA_SENDFILE_BACKEND the file is sent by front-end server. """
+
+    permission_classes = [permissions.IsAuthenticated, CanSeeOriginal, IsOwnerOrAdmin]
+    queryset = ImageInstance.objects.all()
+
+    def retrieve(self, request, *args, **kwargs):
+        image: ImageInstance = self.get_object()
+        response = stream_file(request, image.image_file, image.file_size, get_content_etag(image.content_hash))
+        # access is checked again on every request, unchanged file is answered with 304
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+
+class SimilarImages(generics.RetrieveAPIView):
+    """ Near-duplicates of ImageInstance in its owner library, the most similar first.
+        `distance` query parameter is maximal number of different bits of perceptual hashes. """
+
+    permission_classes = [permissions.IsAuthenticated, IsOwnerOrAdmin]
+    queryset = ImageInstance.objects.all()
+
+    def retrieve(self, request, *args, **kwargs):
+        image: ImageInstance = self.get_object()
+        try:
+            distance = int(request.query_params.get('distance', settings.SIMILAR_IMAGES_DISTANCE))
+        except ValueError:
+            raise ValidationError('distance has to be a number')
+        if not 0 <= distance <= settings.SIMILAR_IMAGES_MAX_DISTANCE:
+            raise ValidationError(f'distance has to be between 0 and {settings.SIMILAR_IMAGES_MAX_DISTANCE}')
+
+        similar = find_similar_images(image, distance, settings.SIMILAR_IMAGES_LIMIT)
+        # plan and thumbnails are resolved once for all images
+        representations = ArbitraryPlanSerializer([similar_image for similar_image, _ in similar], many=True,
+                                                  context={'request': request}).data
+        results = [dict(data, detail_url=reverse('detail', kwargs={'pk': similar_image.pk}, request=request),
+                        distance=similar_distance)
+                   for data, (similar_image, similar_distance) in zip(representations, similar)]
+        return Response({'results': results})
+
+
+class ImageThumbnail(generics.RetrieveAPIView):
+    """ Thumbnail of ImageInstance rendered in background.
+        Redirects to thumbnail when it is ready, otherwise serves a placeholder.
+        If the plan has output formats, thumbnail is in format of `output` query parameter or negotiated by Accept. """
+
+    permission_classes = [permissions.IsAuthenticated, IsOwnerOrAdmin]
+    queryset = ImageInstance.objects.all()
+
+    def retrieve(self, request, *args, **kwargs):
+        image: ImageInstance = self.get_object()
+        # only sizes from user plan can be rendered
+        size: ThumbnailSize = next((size for size in get_plan_by_user(request.user).thumbnail_sizes.all()
+                                    if (size.width, size.height) == (kwargs['width'], kwargs['height'])), None)
+        if size is None:
+            raise Http404('Thumbnail size is not in user plan')
+        encodings = get_plan_encodings(get_plan_by_user(request.user))
+        # `format` parameter is taken by DRF renderers
+        if 'output' in request.query_params:
+            encoding = next((encoding for encoding in encodings
+                             if encoding.format == request.query_params['output']), None)
+            if encoding is None:
+                raise Http404('Thumbnail format is not in user plan')
+        else:
+            encoding = choose_encoding(encodings, request.META.get('HTTP_ACCEPT'))
+        job = ThumbnailJob.objects.filter(image=image, width=size.width, height=size.height).first()
+        if job is None:
+            # images uploaded before background rendering was enabled have no jobs yet
+            enqueue_thumbnails(image, [size])
+        elif job.status == ThumbnailJob.READY:
+            # job renders all plan formats
+            name = job.thumbnail_name if encoding is None else \
+                get_thumbnail_variant_name(image, size.width, size.height, encoding)
+            response = HttpResponseRedirect(image.image_file.thumbnail_storage.url(name))
+            if encodings:
+                response['Vary'] = 'Accept'
+            return response
+
+        response = HttpResponse(PLACEHOLDER_GIF, content_type='image/gif')
+        response['X-Thumbnail-Status'] = job.status if job else ThumbnailJob.PENDING
+        response['Cache-Control'] = 'no-store'
+        return response
+
+
+class ImageRender(generics.RetrieveAPIView):
+    """ Image rendered on demand in requested size (snapped to size buckets) and fit,
+        in plan format negotiated by Accept. Rendered images are cached on disk. """
+
     permission_classes = [permissions.IsAuthenticated, IsOwnerOrAdmin]
     queryset = ImageInstance.objects.all()
 
+    def retrieve(self, request, *args, **kwargs):
+        image: ImageInstance = self.get_object()
+        plan = get_plan_by_user(request.user)
+        if not plan.render_max_dimension:
+            raise PermissionDenied('Rendering in requested sizes is not in user plan')
+        width, height, fit = parse_render_request(request.query_params, plan.render_max_dimension)
+        encodings = get_plan_encodings(plan)
+        try:
+            rendered = get_rendered_file(image, width, height, fit,
+                                         choose_encoding(encodings, request.META.get('HTTP_ACCEPT')))
+        except ImageTooLarge as e:
+            raise ValidationError(str(e))
+
+        etag = f'"{rendered.key}"'
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = FileResponse(open(rendered.path, 'rb'), content_type=rendered.content_type)
+            response['X-Render-Cache'] = 'hit' if rendered.cached else 'miss'
+        response['ETag'] = etag
+        # rendered image of the same parameters never changes, new original has a different key
+        response['Cache-Control'] = 'private, max-age=86400'
+        if encodings:
+            response['Vary'] = 'Accept'
+        return response
 
-class ImageInstanceList(generics.ListAPIView):
+
+class ImageInstanceList(ConditionalGetMixin, generics.ListAPIView):
     """ View of ImageInstance list - visible fields are dependent on the user plan"""
 
     serializer_class = ArbitraryPlanSerializer
+    pagination_class = ImageCursorPagination
     name = 'image-list'
 
     def get_queryset(self):
         return ImageInstance.objects.filter(owner=self.request.user)
 
+    def get_library_version(self) -> int:
+        # read from database, because authenticated user may be loaded before the last change
+        return User.objects.values_list('library_version', flat=True).get(pk=self.request.user.pk)
+
     permission_classes = [permissions.IsAuthenticated]
 
 
@@ -108,15 +358,83 @@ class TempLinkCreation(generics.CreateAPIView):
 
         # expiring time is computed
         date = timezone.now() + timedelta(seconds=int(time_seconds))
+
+        if settings.EXPIRING_LINK_MODE == 'signed':
+            # signed link is not stored - its token is shown in place of hash
+            return TempUrl(url_hash=sign_image_link(image, date), expiration_date=date, image=image)
+
         url_hash = image.get_hash()
-        binary_image = image.get_binary()
+        return serializer.save(url_hash=url_hash, expiration_date=date, image=image)
 
-        return serializer.save(url_hash=url_hash, expiration_date=date, image=binary_image)
+
+def get_valid_temp_url(url_hash: str) -> TempUrl:
+    """ Returns expiring link with its image, raises Http404 if it does not exist or has expired """
+    return get_object_or_404(TempUrl.objects.select_related('image'), url_hash=url_hash,
+                             expiration_date__gte=timezone.now()
+                             )
+
+
+def get_temp_link_cache_control(url: TempUrl) -> str:
+    # link stays valid until it expires, so the image can be cached that long
+    max_age = max(int((url.expiration_date - timezone.now()).total_seconds()), 0)
+    return f'private, max-age={max_age}'
 
 
 def temp_link(request: Request, hash: str):
-    """ View of binary image. Link does not work if it is passed its expiration date """
-    url: TempUrl = get_object_or_404(TempUrl, url_hash=hash,
-                                     expiration_date__gte=timezone.now()
-                                     )
-    return HttpResponse({url.image})
+    """ View of image file. Link does not work if it is passed its expiration date """
+    url = get_valid_temp_url(hash)
+    image: ImageInstance = url.image
+    response = stream_file(request, image.image_file, image.file_size, get_content_etag(image.content_hash))
+    response['Cache-Control'] = get_temp_link_cache_control(url)
+    return response
+
+
+def signed_temp_link(request: Request, token: str):
+    """ View of image file behind signed expiring link.
+        Link is verified by its signature, the database is only asked if the image was not deleted. """
+    try:
+        payload = unsign_image_link(token)
+    except signing.BadSignature:
+        raise Http404('Link does not exist or has expired')
+    # deleted image may still have its file (shared blob, orphaned original)
+    if not ImageInstance.objects.filter(pk=payload['i'], image_file=payload['f']).exists():
+        raise Http404('Image does not exist')
+    image = ImageInstance(id=payload['i'], image_file=payload['f'])
+    try:
+        response = stream_file(request, image.image_file, payload.get('s'), get_content_etag(payload.get('h')))
+    except FileNotFoundError:
+        raise Http404('Image does not exist')
+    response['Cache-Control'] = f'private, max-age={max(payload["e"] - int(time.time()), 0)}'
+    return response
+
+
+def media(request: Request, path: str):
+    """ View of media files (originals and thumbnails) with validators and cache lifetime.
+        Thumbnails of hashed namer never change, so they are cached as immutable.
+        With MEDIA_SENDFILE_BACKEND originals are sent only by views checking access, so only thumbnails are served. """
+    name = posixpath.normpath(path).lstrip('/')
+    if any(part.startswith('.') for part in name.split('/')):
+        # hidden directories keep files which are not served, like partially uploaded ones
+        raise Http404('File does not exist')
+    if settings.MEDIA_SENDFILE_BACKEND and not Thumbnail.objects.filter(name=name).exists():
+        raise Http404('File does not exist')
+    storage = get_image_storage()
+    try:
+        stat = get_file_stat(storage, name)
+    except SuspiciousFileOperation:
+        raise Http404('File does not exist')
+    if stat is None:
+        raise Http404('File does not exist')
+    size, modified = stat
+    # names of media files are unique, so name, size and modification time identify the content
+    etag = '"%s"' % hashlib.md5(f'{name}:{size}:{modified.timestamp()}'.encode('utf-8')).hexdigest()
+    response = stream_stored_file(request, storage, name, size, etag, modified)
+    response['Cache-Control'] = get_media_cache_control(name)
+    return response
+
+
+def metrics(request: Request):
+    """ Profiling counters in Prometheus text format, only for local scrapers """
+    if request.META.get('REMOTE_ADDR') not in settings.PROFILING_METRICS_IPS:
+        raise Http404()
+    return HttpResponse(profiling_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
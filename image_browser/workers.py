@@ -0,0 +1,30 @@
+""" Entry points of worker processes.
+    Workers are spawned, not forked, so they do not share database connections with the parent,
+    and Django is set up in every worker before any model is imported. """
+from typing import List, Optional, Tuple
+
+import django
+
+
+def init_worker() -> None:
+    django.setup()
+    from django.conf import settings
+    from image_browser.decoding import limit_process_memory
+
+    # decoding which does not fit fails with MemoryError in the worker, instead of exhausting memory of the host
+    limit_process_memory(settings.WORKER_MEMORY_LIMIT)
+
+
+def prerender_image(image_id: int, sizes: List[Tuple[int, int]],
+                    encodings: Optional[List[Optional[Tuple[str, int]]]] = None) -> int:
+    """ Renders thumbnails of (width, height) sizes of an image with given id,
+        in (format, quality) encodings (default format if not given).
+        :return number of rendered thumbnails """
+    from image_browser.encodings import ThumbnailEncoding
+    from image_browser.models import ImageInstance, ThumbnailSize
+    from image_browser.thumbnails import DEFAULT_ENCODINGS, render_thumbnail_variants
+
+    image = ImageInstance.objects.get(pk=image_id)
+    encodings = [ThumbnailEncoding(*encoding) if encoding else None for encoding in encodings or DEFAULT_ENCODINGS]
+    return len(render_thumbnail_variants(image, [ThumbnailSize(width=width, height=height) for width, height in sizes],
+                                         encodings))
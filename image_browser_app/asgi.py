@@ -9,8 +9,13 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'image_browser_app.settings')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+# handler which sends asynchronous responses of async views (ASYNC_VIEWS=true)
+from image_browser.asgi import ASGIHandler  # noqa: E402
+
+application = ASGIHandler()
@@ -9,6 +9,7 @@ https://docs.djangoproject.com/en/4.1/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
+import json
 import os
 from pathlib import Path
 
@@ -43,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'image_browser.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -139,3 +141,105 @@ ADMINS = (
 )
 
 THUMBNAIL_NAMER = 'easy_thumbnails.namers.hashed'
+
+REST_FRAMEWORK = {
+    'DEFAULT_PAGINATION_CLASS': 'image_browser.pagination.ImageCursorPagination',
+    'PAGE_SIZE': int(os.environ.get('IMAGE_LIST_PAGE_SIZE', 50)),
+}
+
+# upper limit for page size requested by client with `page_size` query parameter
+IMAGE_LIST_MAX_PAGE_SIZE = int(os.environ.get('IMAGE_LIST_MAX_PAGE_SIZE', 200))
+
+# 'database' keeps a TempUrl row per expiring link, 'signed' encodes link in HMAC-signed token
+EXPIRING_LINK_MODE = os.environ.get('EXPIRING_LINK_MODE', 'database')
+# comma separated keys of signed links (SECRET_KEY if empty) - the first one signs new links,
+# all of them are accepted, so a key is rotated by putting the new one in front
+EXPIRING_LINK_SIGNING_KEYS = [key for key in os.environ.get('EXPIRING_LINK_SIGNING_KEYS', '').split(',') if key]
+# seconds between deletions of expired links done in server process, 0 disables them
+# (they can be deleted with `purgeexpiredlinks` command instead)
+EXPIRED_LINKS_REAP_INTERVAL = int(os.environ.get('EXPIRED_LINKS_REAP_INTERVAL', 0))
+
+# if enabled uploads do not wait for thumbnails - they are rendered by local worker pool
+THUMBNAIL_BACKGROUND_RENDERING = os.environ.get('THUMBNAIL_BACKGROUND_RENDERING', '').lower() == 'true'
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', 2))
+# concurrent requests of a new image wait (up to that many seconds) until one of them renders its thumbnails,
+# after that they show URLs of pending thumbnails
+THUMBNAIL_RENDER_WAIT = float(os.environ.get('THUMBNAIL_RENDER_WAIT', 10))
+# failed thumbnail jobs are retried by the worker after THUMBNAIL_JOB_RETRY_DELAY seconds, up to
+# THUMBNAIL_JOB_MAX_ATTEMPTS renders; jobs running longer than THUMBNAIL_JOB_TIMEOUT seconds (worker died) are retried too
+THUMBNAIL_JOB_MAX_ATTEMPTS = int(os.environ.get('THUMBNAIL_JOB_MAX_ATTEMPTS', 3))
+THUMBNAIL_JOB_RETRY_DELAY = int(os.environ.get('THUMBNAIL_JOB_RETRY_DELAY', 60))
+THUMBNAIL_JOB_TIMEOUT = int(os.environ.get('THUMBNAIL_JOB_TIMEOUT', 600))
+
+# on demand rendering (/<id>/render/?w=&h=&fit=) - requested dimensions are snapped up to these buckets
+# (and to plan maximum), rendered images are kept in RENDER_CACHE_DIR (MEDIA_ROOT/.render-cache by default)
+# evicting least recently used ones above RENDER_CACHE_MAX_SIZE bytes
+RENDER_SIZE_BUCKETS = [int(size) for size in
+                       os.environ.get('RENDER_SIZE_BUCKETS', '64,128,256,512,768,1024,1536,2048').split(',')]
+RENDER_CACHE_DIR = os.environ.get('RENDER_CACHE_DIR') or None
+RENDER_CACHE_MAX_SIZE = int(os.environ.get('RENDER_CACHE_MAX_SIZE', 1024 * 1024 * 1024))
+# directory of lock files used across processes (MEDIA_ROOT/.locks by default), it has to be local
+LOCK_DIR = os.environ.get('LOCK_DIR') or None
+
+# async versions of image list, detail and expiring link views - for ASGI deployment
+# (e.g. `uvicorn image_browser_app.asgi:application`), where a slow client does not hold a thread
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS', '').lower() == 'true'
+
+# per request profiling - SQL queries, storage reads and writes, thumbnail rendering, plan resolving and
+# serialization are timed and summed in counters served at /metrics (Prometheus text format) to PROFILING_METRICS_IPS
+PROFILING = os.environ.get('PROFILING', '').lower() == 'true'
+PROFILING_METRICS_IPS = [ip for ip in os.environ.get('PROFILING_METRICS_IPS', '127.0.0.1,::1').split(',') if ip]
+# timings of every request are also sent in Server-Timing response header
+PROFILING_SERVER_TIMING = os.environ.get('PROFILING_SERVER_TIMING', '').lower() == 'true'
+
+# resolved user plans are cached in every process (up to PLAN_CACHE_SIZE entries) and in Django cache with given
+# alias, which tells all processes about plan changes; without the alias plans are not cached at all, so revoked
+# rights take effect right away in every process
+PLAN_CACHE_SIZE = int(os.environ.get('PLAN_CACHE_SIZE', 1024))
+PLAN_CACHE_ALIAS = os.environ.get('PLAN_CACHE_ALIAS') or None
+PLAN_CACHE_TIMEOUT = int(os.environ.get('PLAN_CACHE_TIMEOUT', 60))
+
+# resumable uploads - maximal file size and directory of partially received files
+# (MEDIA_ROOT/.uploads by default, it has to be on the same filesystem as MEDIA_ROOT to move files without copying)
+UPLOAD_MAX_SIZE = int(os.environ.get('UPLOAD_MAX_SIZE', 100 * 1024 * 1024))
+# decoding policy - images with more pixels are refused at upload (plans can allow less with max_image_pixels)
+# and never decoded; Pillow refuses images above twice its own MAX_IMAGE_PIXELS (about 179 million) anyway
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 50_000_000))
+# bytes of decoded pixels held at once by rendering threads of a process (0 - no limit),
+# and address space limit of thumbnail prerendering worker processes (0 - no limit)
+DECODE_MEMORY_BUDGET = int(os.environ.get('DECODE_MEMORY_BUDGET', 1024 * 1024 * 1024))
+WORKER_MEMORY_LIMIT = int(os.environ.get('WORKER_MEMORY_LIMIT', 0))
+UPLOAD_SESSION_DIR = os.environ.get('UPLOAD_SESSION_DIR') or None
+# unfinished upload sessions older than that (in seconds) are deleted by `purgeuploadsessions`
+UPLOAD_SESSION_MAX_AGE = int(os.environ.get('UPLOAD_SESSION_MAX_AGE', 24 * 3600))
+
+# storage of originals and thumbnails (class and its keyword arguments as JSON) - local filesystem by default,
+# 'image_browser.storage.LocalObjectStorage' stands in for an object store
+IMAGE_STORAGE = os.environ.get('IMAGE_STORAGE', 'django.core.files.storage.FileSystemStorage')
+IMAGE_STORAGE_OPTIONS = json.loads(os.environ.get('IMAGE_STORAGE_OPTIONS', '{}'))
+# 'flat' keeps all originals of a user in user_<username>/, 'sharded' spreads them over user_<username>/ab/cd/
+# (existing files are moved with `reshardimages`)
+IMAGE_PATH_LAYOUT = os.environ.get('IMAGE_PATH_LAYOUT', 'flat')
+
+# originals (behind /<id>/original/) and expiring links are sent by front-end server instead of Django:
+# 'x-accel-redirect' (nginx - MEDIA_SENDFILE_PREFIX has to be its `internal` location aliased to MEDIA_ROOT)
+# or 'x-sendfile' (Apache, lighttpd); without it Django streams the files
+MEDIA_SENDFILE_BACKEND = os.environ.get('MEDIA_SENDFILE_BACKEND', '').lower() or None
+MEDIA_SENDFILE_PREFIX = os.environ.get('MEDIA_SENDFILE_PREFIX', '/protected-media/')
+
+# if enabled originals are stored by content hash (MEDIA_ROOT/blobs/), so identical files uploaded
+# by any users are stored and thumbnailed only once
+IMAGE_DEDUPLICATION = os.environ.get('IMAGE_DEDUPLICATION', '').lower() == 'true'
+
+# near-duplicate search - default and maximal Hamming distance of perceptual hashes (of 64 bits)
+# and maximal number of returned images
+SIMILAR_IMAGES_DISTANCE = int(os.environ.get('SIMILAR_IMAGES_DISTANCE', 6))
+SIMILAR_IMAGES_MAX_DISTANCE = int(os.environ.get('SIMILAR_IMAGES_MAX_DISTANCE', 11))
+SIMILAR_IMAGES_LIMIT = int(os.environ.get('SIMILAR_IMAGES_LIMIT', 50))
+
+# batch upload - maximal number of images in one request, maximal size of files extracted from an archive together
+# (every one of them is limited by UPLOAD_MAX_SIZE) and number of threads saving them
+BATCH_UPLOAD_MAX_FILES = int(os.environ.get('BATCH_UPLOAD_MAX_FILES', 500))
+BATCH_UPLOAD_MAX_SIZE = int(os.environ.get('BATCH_UPLOAD_MAX_SIZE', 1024 * 1024 * 1024))
+BATCH_UPLOAD_WORKERS = int(os.environ.get('BATCH_UPLOAD_WORKERS', 4))
+DATA_UPLOAD_MAX_NUMBER_FILES = BATCH_UPLOAD_MAX_FILES
@@ -13,24 +13,48 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import re
+
 from django.conf import settings
-from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include, re_path
 
-from image_browser import views
+from image_browser import async_views, views
 
 urlpatterns = [
     path('', views.ApiRoot.as_view(), name=views.ApiRoot.name),
     path('admin/', admin.site.urls),
     path('api-auth/', include('rest_framework.urls')),
     path('images/upload', views.ImageInstanceCreation.as_view(), name=views.ImageInstanceCreation.name),
+    path('images/upload/batch', views.ImageBatchCreation.as_view(), name=views.ImageBatchCreation.name),
+    path('images/uploads/', views.UploadSessionCreation.as_view(), name=views.UploadSessionCreation.name),
+    path('images/uploads/<uuid:pk>/', views.UploadSessionDetail.as_view(), name='upload_session'),
+    path('images/uploads/<uuid:pk>/finalize', views.UploadSessionFinalization.as_view(), name='finalize_upload'),
     path('<int:pk>/', views.ImageInstanceDetail.as_view(), name='detail'),
+    path('<int:pk>/original/', views.ImageOriginal.as_view(), name='original'),
+    path('<int:pk>/similar/', views.SimilarImages.as_view(), name='similar'),
+    path('<int:pk>/thumbnails/<int:height>x<int:width>/', views.ImageThumbnail.as_view(), name='thumbnail'),
+    path('<int:pk>/render/', views.ImageRender.as_view(), name='render'),
     path('images/', views.ImageInstanceList.as_view(), name=views.ImageInstanceList.name),
     path('make_temp/<int:pk>/', views.TempLinkCreation.as_view(), name='create_temp_link'),
     re_path(r'^temp/(?P<hash>\w+)/?$', views.temp_link, name='temp_link'),
+    path('temp/signed/<str:token>', views.signed_temp_link, name='signed_temp_link'),
+
+]
 
+# async versions of views serving many clients, for ASGI deployment
+async_urlpatterns = [
+    path('<int:pk>/', async_views.image_detail, name='detail'),
+    path('images/', async_views.image_list, name=views.ImageInstanceList.name),
+    re_path(r'^temp/(?P<hash>\w+)/?$', async_views.temp_link, name='temp_link'),
 ]
 
+if settings.ASYNC_VIEWS:
+    urlpatterns = async_urlpatterns + urlpatterns
+
+if settings.PROFILING:
+    urlpatterns.append(path('metrics', views.metrics, name='metrics'))
+
 if settings.DEBUG:
-     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+    # media are served with ETags and cache headers, unlike with static()
+    urlpatterns += [re_path(r'^%s(?P<path>.*)$' % re.escape(settings.MEDIA_URL.lstrip('/')), views.media, name='media')]
\ No newline at end of file